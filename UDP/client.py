@@ -3,77 +3,115 @@ import os
 import threading
 import json
 
+from reliable import HEADER, OP_DATA, OP_ERROR, PACKET_SIZE, PAYLOAD_SIZE, pack_request, pack_ack
+
 SERVER_IP = "127.0.0.1"
 SERVER_PORT = 8888
-BUFFER_SIZE = 4096
 NUM_CHUNKS = 5  # Số lượng chunk để download đồng thời
-
-def download_chunk(sock, filename, chunk_id, offset_start, offset_end, output_filename):
-    request = f"{filename} ({chunk_id},{offset_start},{offset_end})"
-    sock.sendto(request.encode(), (SERVER_IP, SERVER_PORT))
-
-    while True:
-        try:
-            response, _ = sock.recvfrom(BUFFER_SIZE * 16) # Tăng buffer size cho client
-            response = response.decode()
-
-            received_chunk_id_str, data = response.split("|", 1)
-            received_chunk_id, chunk_size_str = map(str, received_chunk_id_str.split(","))
-
-
-            if int(received_chunk_id) != chunk_id:
-                print(f"Received wrong chunk ID: {received_chunk_id}, expected: {chunk_id}")
-                continue # Bỏ qua nếu nhận sai chunk ID
-
-
-            chunk_data = data.encode(errors='ignore') # Encode lại chunk data
-
-
-            with open(output_filename, "r+b") as f:
-                f.seek(offset_start)
-                f.write(chunk_data)
-            print(f"Chunk {chunk_id} downloaded successfully.")
-            break
-
-        except socket.timeout:
-            print(f"Timeout for chunk {chunk_id}, retrying...")
-            sock.sendto(request.encode(), (SERVER_IP, SERVER_PORT))
-
-
-def download_file(filename, output_filename):
+ACK_EVERY = 2  # In order packets received per ACK, packets out of order are acknowledged at once
+ACK_TIMEOUT = 0.2  # Seconds without packets before the last ACK is sent again
+MAX_RETRIES = 25  # Timeouts in a row before a chunk is given up
+
+
+def download_chunk(filename, chunk_id, offset_start, offset_end, output_filename, server_address):
+    """
+    Receive a chunk as sequenced packets on its own socket, writing each one to its place in the output file.
+    Every ACK carries a SACK bitmap of the packets received past the first missing one, so the server only
+    resends the packets actually lost
+
+    :return: Whether the whole chunk arrived
+    """
+    request = pack_request(chunk_id, filename, offset_start, offset_end)
+    expected = 0  # Every packet before it is written
+    received = set()  # Packets written after expected
+    count = 0  # Packets in the chunk, known from the first DATA packet
+    unacked = 0
+    retries = 0
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock, open(output_filename, "r+b") as f:
+        sock.settimeout(ACK_TIMEOUT)
+        sock.sendto(request, server_address)
+        while not count or expected < count:
+            try:
+                packet, _ = sock.recvfrom(PACKET_SIZE)
+            except socket.timeout:
+                retries += 1
+                if retries > MAX_RETRIES:
+                    print(f"Chunk {chunk_id} timed out")
+                    return False
+                # Nothing arrived yet, the request may be lost. Otherwise the ACKs may be
+                sock.sendto(pack_ack(chunk_id, expected, received, count) if count else request, server_address)
+                continue
+            retries = 0
+
+            if len(packet) < HEADER.size:
+                continue
+            opcode, received_chunk_id, seq, packet_count = HEADER.unpack_from(packet)
+            if received_chunk_id != chunk_id:
+                continue
+            if opcode == OP_ERROR:
+                print(f"Chunk {chunk_id} failed: {packet[HEADER.size:].decode(errors='replace')}")
+                return False
+            if opcode != OP_DATA:
+                continue
+
+            count = packet_count
+            in_order = seq == expected
+            if seq >= expected and seq not in received:
+                f.seek(offset_start + seq * PAYLOAD_SIZE)
+                f.write(memoryview(packet)[HEADER.size:])
+                received.add(seq)
+                while expected in received:
+                    received.remove(expected)
+                    expected += 1
+
+            unacked += 1
+            if not in_order or unacked >= ACK_EVERY or expected >= count:
+                sock.sendto(pack_ack(chunk_id, expected, received, count), server_address)
+                unacked = 0
+
+    print(f"Chunk {chunk_id} downloaded successfully.")
+    return True
+
+
+def download_file(filename, output_filename, server_address=(SERVER_IP, SERVER_PORT)):
     with open("filelist.json", "r") as f:
         filelist = json.load(f)
 
     if filename not in filelist:
         print("File not found")
-        return
+        return False
 
     filesize = filelist[filename]
     chunk_size = filesize // NUM_CHUNKS
 
     # Tạo file output với kích thước bằng file gốc
     with open(output_filename, "wb") as f:
-        f.seek(filesize - 1)
-        f.write(b"\0")
-
+        f.truncate(filesize)
 
+    results = [False] * NUM_CHUNKS
     threads = []
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-        sock.settimeout(5) # Set timeout cho socket
-        for i in range(NUM_CHUNKS):
-            offset_start = i * chunk_size
-            offset_end = (i + 1) * chunk_size
-            if i == NUM_CHUNKS - 1:
-                offset_end = filesize  # Đảm bảo chunk cuối cùng bao gồm toàn bộ dữ liệu còn lại
+    for i in range(NUM_CHUNKS):
+        offset_start = i * chunk_size
+        offset_end = (i + 1) * chunk_size
+        if i == NUM_CHUNKS - 1:
+            offset_end = filesize  # Đảm bảo chunk cuối cùng bao gồm toàn bộ dữ liệu còn lại
+
+        def download(i=i, offset_start=offset_start, offset_end=offset_end):
+            results[i] = download_chunk(filename, i, offset_start, offset_end, output_filename, server_address)
 
-            thread = threading.Thread(target=download_chunk, args=(sock, filename, i, offset_start, offset_end, output_filename))
-            threads.append(thread)
-            thread.start()
+        thread = threading.Thread(target=download)
+        threads.append(thread)
+        thread.start()
 
-        for thread in threads:
-            thread.join()
+    for thread in threads:
+        thread.join()
 
+    if not all(results):
+        print(f"File {filename} failed to download")
+        return False
     print(f"File {filename} downloaded successfully as {output_filename}")
+    return True
 
 
 def main():
@@ -82,4 +120,4 @@ def main():
     download_file(filename, output_filename)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
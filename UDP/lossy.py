@@ -0,0 +1,68 @@
+import argparse
+import heapq
+import random
+import select
+import socket
+import time
+
+BUFFER_SIZE = 65536
+
+
+def relay(listen_address, server_address, loss, delay, jitter):
+    """
+    Forward datagrams between clients and the server, dropping and delaying them at random, to test on a lossy loopback.
+    Each client address gets its own socket towards the server, so replies find their way back
+
+    :param listen_address: Address clients send to
+    :param server_address: Address of the real server
+    :param loss: Probability a datagram is dropped, in each direction
+    :param delay: Seconds every datagram is held
+    :param jitter: Extra random delay up to this many seconds, reorders datagrams
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    listener.bind(listen_address)
+    upstreams = {}  # client address: socket towards the server
+    clients = {}  # socket towards the server: client address
+    pending = []  # Heap of (due time, sequence, socket, datagram, destination)
+    sequence = 0
+
+    while True:
+        timeout = max(0.0, pending[0][0] - time.monotonic()) if pending else None
+        readable, _, _ = select.select([listener, *clients], [], [], timeout)
+        for sock in readable:
+            data, addr = sock.recvfrom(BUFFER_SIZE)
+            if sock is listener:
+                if addr not in upstreams:
+                    upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    upstreams[addr], clients[upstream] = upstream, addr
+                out, destination = upstreams[addr], server_address
+            else:
+                out, destination = listener, clients[sock]
+
+            if random.random() < loss:
+                continue
+            sequence += 1
+            heapq.heappush(pending, (time.monotonic() + delay + random.uniform(0, jitter), sequence, out, data, destination))
+
+        now = time.monotonic()
+        while pending and pending[0][0] <= now:
+            _, _, out, data, destination = heapq.heappop(pending)
+            out.sendto(data, destination)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lossy UDP relay in front of the server")
+    parser.add_argument("--listen", type=int, default=8889, help="Port clients send to")
+    parser.add_argument("--server", default="127.0.0.1:8888", help="Server address")
+    parser.add_argument("--loss", type=float, default=0.05, help="Probability a datagram is dropped")
+    parser.add_argument("--delay", type=float, default=0.005, help="Seconds every datagram is held")
+    parser.add_argument("--jitter", type=float, default=0.002, help="Extra random delay up to this many seconds")
+    args = parser.parse_args()
+
+    host, port = args.server.rsplit(":", 1)
+    print(f"Relaying 127.0.0.1:{args.listen} -> {args.server} with {args.loss:.0%} loss")
+    relay(("127.0.0.1", args.listen), (host, int(port)), args.loss, args.delay, args.jitter)
+
+
+if __name__ == "__main__":
+    main()
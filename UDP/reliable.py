@@ -0,0 +1,74 @@
+import struct
+
+# Every packet starts with HEADER: opcode, chunk id, sequence number, packet count
+# REQUEST  client -> server  seq 0, count 0, payload: RANGE (offset start, offset end) + file name
+# DATA     server -> client  seq of the packet, count of packets in the chunk, payload: file bytes
+# ACK      client -> server  seq = next packet expected (cumulative), payload: SACK bitmap of the packets after it.
+#                            Holes below the highest bit set are packets the client is missing (NACK)
+# ERROR    server -> client  payload: message
+HEADER = struct.Struct("!BHII")
+RANGE = struct.Struct("!QQ")
+
+OP_REQUEST = 1
+OP_DATA = 2
+OP_ACK = 3
+OP_ERROR = 4
+
+PACKET_SIZE = 1472  # Ethernet MTU minus IP and UDP headers, so packets are never fragmented
+PAYLOAD_SIZE = PACKET_SIZE - HEADER.size
+SACK_BITS = 256  # Packets after the cumulative ACK a SACK bitmap covers
+SACK_SIZE = SACK_BITS // 8
+
+INITIAL_WINDOW = 16  # Packets in flight when a chunk starts
+MIN_WINDOW = 2
+MAX_WINDOW = SACK_BITS  # Never more in flight than an ACK can report on
+DUP_THRESHOLD = 3  # Packets SACKed after a missing one before it is considered lost
+
+INITIAL_RTO = 0.5  # Seconds without progress before everything in flight is resent
+MIN_RTO = 0.05
+MAX_RTO = 4.0
+SESSION_TIMEOUT = 10  # Seconds the server keeps a chunk without hearing from its client
+
+
+def packet_count(size):
+    """
+    Number of DATA packets of a chunk, an empty chunk still sends one empty packet so the client learns it ended
+    """
+    return max(1, -(-size // PAYLOAD_SIZE))
+
+
+def pack_request(chunk_id, filename, offset_start, offset_end):
+    return HEADER.pack(OP_REQUEST, chunk_id, 0, 0) + RANGE.pack(offset_start, offset_end) + filename.encode()
+
+
+def unpack_request(payload):
+    offset_start, offset_end = RANGE.unpack_from(payload)
+    return payload[RANGE.size:].decode(), offset_start, offset_end
+
+
+def pack_ack(chunk_id, expected, received, count):
+    """
+    ACK of every packet before expected, and a SACK bitmap of the packets received after it
+
+    :param chunk_id: Chunk id
+    :param expected: Next packet the client needs
+    :param received: Sequence numbers received after expected
+    :param count: Packet count of the chunk, 0 if not known yet
+    :return: Packet
+    """
+    bitmap = 0
+    for seq in received:
+        if expected < seq <= expected + SACK_BITS:
+            bitmap |= 1 << (seq - expected - 1)
+    return HEADER.pack(OP_ACK, chunk_id, expected, count) + bitmap.to_bytes(SACK_SIZE, "big")
+
+
+def sacked(expected, payload):
+    """
+    Sequence numbers a SACK bitmap reports as received, lowest first
+    """
+    bitmap = int.from_bytes(payload[:SACK_SIZE], "big")
+    while bitmap:
+        lowest = bitmap & -bitmap
+        yield expected + lowest.bit_length()
+        bitmap ^= lowest
@@ -1,53 +1,399 @@
 import socket
+import select
 import json
 import os
+import time
+import struct
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from reliable import HEADER, OP_REQUEST, OP_DATA, OP_ACK, OP_ERROR, PAYLOAD_SIZE, INITIAL_WINDOW, MIN_WINDOW, MAX_WINDOW, \
+    DUP_THRESHOLD, INITIAL_RTO, MIN_RTO, MAX_RTO, SESSION_TIMEOUT, packet_count, unpack_request, sacked
 
 SERVER_IP = "127.0.0.1"
 SERVER_PORT = 8888
 BUFFER_SIZE = 4096  # Kích thước buffer để nhận dữ liệu
+WORKERS = 4  # Threads reading file blocks from disk
+MAX_OPEN_FILES = 32  # File handles kept open between requests
+PACKETS_PER_BLOCK = 64  # Packets of a chunk read from disk at once
+BLOCK_SIZE = PACKETS_PER_BLOCK * PAYLOAD_SIZE
+READ_AHEAD_BLOCKS = 2  # Blocks read past the one being sent
+INDEX_CHECK_INTERVAL = 1  # Seconds between checks of filelist.json for changes
+STATS_INTERVAL = 5  # Seconds between rate reports
+
+
+class FileIndex:
+    def __init__(self, path="filelist.json"):
+        """
+        filelist.json kept in memory, parsed again only when its modification time changes
+        """
+        self.path = path
+        self.files = {}
+        self.mtime = None
+        self.checked_at = None
+
+    def get(self, filename):
+        now = time.monotonic()
+        if self.checked_at is None or now - self.checked_at >= INDEX_CHECK_INTERVAL:
+            self.checked_at = now
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+                if mtime != self.mtime:
+                    with open(self.path, "r") as f:
+                        self.files = json.load(f)
+                    self.mtime = mtime
+            except (OSError, ValueError):  # Missing or being rewritten, keep the last index and retry next request
+                self.checked_at = None
+        return self.files.get(filename)
+
+
+class HandlePool:
+    def __init__(self, capacity=MAX_OPEN_FILES):
+        """
+        Open files shared by every chunk of the same file. Handles nobody uses stay open for later requests,
+        the least recently used is closed once more than capacity are open
+        """
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.seek_lock = threading.Lock()  # Only needed where seek + read replaces pread
+        self.handles = OrderedDict()  # filename: [file, number of sessions using it], least recently used first
+
+    def acquire(self, filename):
+        with self.lock:
+            if filename in self.handles:
+                self.handles.move_to_end(filename)
+            else:
+                self.handles[filename] = [open(os.path.join("files", filename), "rb"), 0]
+            handle = self.handles[filename]
+            handle[1] += 1
+            for name, (f, users) in list(self.handles.items()):
+                if len(self.handles) <= self.capacity:
+                    break
+                if not users:
+                    f.close()
+                    del self.handles[name]
+            return handle[0]
+
+    def release(self, filename):
+        with self.lock:
+            self.handles[filename][1] -= 1
+
+    def read(self, f, offset, size):
+        if hasattr(os, "pread"):  # Several workers may read the same handle at once
+            return os.pread(f.fileno(), size, offset)
+        with self.seek_lock:
+            f.seek(offset)
+            return f.read(size)
+
+
+file_index = FileIndex()
+handles = HandlePool()
+executor = ThreadPoolExecutor(max_workers=WORKERS)
+finished_reads = queue.SimpleQueue()  # (session key, session, block index, data or None) of reads done by workers
+wakeup_reader, wakeup_writer = socket.socketpair()
+wakeup_reader.setblocking(False)
+wakeup_writer.setblocking(False)
+stats = {"requests": 0, "packets_in": 0, "packets_out": 0, "retransmits": 0}
+
+# Chunks being sent
+# dict = {
+#     (client address, chunk id): {
+#         "filename": file name, "file": handle from the pool, "offset": offset of the chunk in the file, "size": chunk size,
+#         "count": packets in the chunk, "next_seq": next packet never sent, "acked": packets before it are acknowledged,
+#         "in_flight": {seq: [last sent time, whether it was retransmitted]} in sequence order,
+#         "lost": seqs to retransmit, "cwnd": congestion window in packets, "ssthresh": slow start threshold,
+#         "recovery": packets below it were in flight at the last window cut, "srtt", "rttvar", "rto": round trip estimates,
+#         "deadline": time everything in flight is considered lost without progress, "heard": last time the client was heard,
+#         "blocks": {block index: data} read from disk and not yet acknowledged, "reading": block indexes being read
+#     }
+# }
+sessions = {}
+
+
+def send_error(sock, addr, chunk_id, message):
+    sock.sendto(HEADER.pack(OP_ERROR, chunk_id, 0, 0) + message.encode(), addr)
+
+
+def start_session(sock, addr, chunk_id, payload):
+    """
+    Start sending the requested range of a file, a repeated request of a chunk being sent is ignored
+    """
+    stats["requests"] += 1
+    if (addr, chunk_id) in sessions:
+        return
+
+    try:
+        filename, offset_start, offset_end = unpack_request(payload)
+    except (ValueError, UnicodeDecodeError, IndexError, struct.error):
+        send_error(sock, addr, chunk_id, "Invalid request")
+        return
+
+    filesize = file_index.get(filename)
+    if filesize is None:
+        send_error(sock, addr, chunk_id, "File not found")
+        return
+
+    try:
+        f = handles.acquire(filename)
+    except OSError:
+        send_error(sock, addr, chunk_id, "File not found")
+        return
+
+    offset_end = min(offset_end, filesize)
+    size = max(0, offset_end - offset_start)
+    now = time.monotonic()
+    sessions[(addr, chunk_id)] = {
+        "filename": filename,
+        "file": f,
+        "offset": offset_start,
+        "size": size,
+        "count": packet_count(size),
+        "next_seq": 0,
+        "acked": 0,
+        "in_flight": {},
+        "lost": [],
+        "cwnd": float(INITIAL_WINDOW),
+        "ssthresh": float(MAX_WINDOW),
+        "recovery": 0,
+        "srtt": None,
+        "rttvar": None,
+        "rto": INITIAL_RTO,
+        "deadline": now + INITIAL_RTO,
+        "heard": now,
+        "blocks": {},
+        "reading": set()
+    }
+
+
+def close_session(key):
+    handles.release(sessions.pop(key)["filename"])
+
+
+def cut_window(session, timeout=False):
+    """
+    Halve the congestion window on loss, once per window of packets. A timeout restarts slow start from MIN_WINDOW
+    """
+    session["ssthresh"] = max(session["cwnd"] / 2, MIN_WINDOW)
+    session["cwnd"] = float(MIN_WINDOW) if timeout else session["ssthresh"]
+    session["recovery"] = session["next_seq"]
+
+
+def handle_ack(session, expected, payload):
+    """
+    Drop acknowledged packets from flight, sample the round trip time, grow the window, detect lost packets
+    """
+    now = time.monotonic()
+    session["heard"] = now
+    in_flight = session["in_flight"]
+    acked = []
+    while in_flight and next(iter(in_flight)) < expected:
+        seq = next(iter(in_flight))
+        acked.append((seq, in_flight.pop(seq)))
+    highest = None
+    for seq in sacked(expected, payload):
+        if seq in in_flight:
+            acked.append((seq, in_flight.pop(seq)))
+        highest = seq
+    if acked and session["lost"]:
+        session["lost"] = [seq for seq in session["lost"] if seq in in_flight]
+
+    progress = expected > session["acked"] or acked
+    session["acked"] = max(session["acked"], expected)
+    for seq, (sent_at, retransmitted) in acked:
+        if not retransmitted:  # Karn's algorithm, a retransmitted packet's ACK can't tell which copy arrived
+            sample = now - sent_at
+            if session["srtt"] is None:
+                session["srtt"], session["rttvar"] = sample, sample / 2
+            else:
+                session["rttvar"] = 0.75 * session["rttvar"] + 0.25 * abs(session["srtt"] - sample)
+                session["srtt"] = 0.875 * session["srtt"] + 0.125 * sample
+            session["rto"] = min(MAX_RTO, max(MIN_RTO, session["srtt"] + 4 * session["rttvar"]))
+        if session["cwnd"] < session["ssthresh"]:  # Slow start
+            session["cwnd"] += 1
+        else:  # Congestion avoidance, one more packet per window
+            session["cwnd"] += 1 / session["cwnd"]
+    session["cwnd"] = min(session["cwnd"], MAX_WINDOW)
+    if progress:
+        session["deadline"] = now + session["rto"]
+
+    # Blocks every packet of which is acknowledged are not needed anymore
+    for block in [block for block in session["blocks"] if (block + 1) * PACKETS_PER_BLOCK <= session["acked"]]:
+        del session["blocks"][block]
+
+    # Packets missing below the highest SACKed one, with enough SACKed after them, are lost
+    if highest is not None:
+        for seq, (sent_at, retransmitted) in in_flight.items():
+            if seq > highest - DUP_THRESHOLD:
+                break
+            if retransmitted:  # Already resent, left to the retransmission timeout
+                continue
+            if seq >= session["recovery"]:
+                cut_window(session)
+            in_flight[seq][1] = True
+            session["lost"].append(seq)
+
+
+def read_block(key, session, block):
+    """
+    Read a block of a chunk in a worker, the event loop picks it up from finished_reads
+    """
+    def work():
+        start = block * BLOCK_SIZE
+        try:
+            data = handles.read(session["file"], session["offset"] + start, min(BLOCK_SIZE, session["size"] - start))
+        except (OSError, ValueError):  # Handle closed under a session that ended
+            data = None
+        finished_reads.put((key, session, block, data))
+        try:
+            wakeup_writer.send(b"\0")
+        except BlockingIOError:  # Already woken up
+            pass
+
+    session["reading"].add(block)
+    executor.submit(work)
+
+
+def finish_reads():
+    try:
+        while wakeup_reader.recv(BUFFER_SIZE):
+            pass
+    except BlockingIOError:
+        pass
 
-def handle_client(sock):
     while True:
         try:
-            data, addr = sock.recvfrom(BUFFER_SIZE)
-            request = data.decode().strip()
+            key, session, block, data = finished_reads.get_nowait()
+        except queue.Empty:
+            return
+        session["reading"].discard(block)
+        if sessions.get(key) is session and data is not None and (block + 1) * PACKETS_PER_BLOCK > session["acked"]:
+            session["blocks"][block] = data
+
+
+def next_packet(session):
+    """
+    Packet the session may send now: a lost one first, then a new one, if the window is open and its block is read
+
+    :return: Sequence number, None if nothing can be sent
+    """
+    if len(session["in_flight"]) - len(session["lost"]) >= session["cwnd"]:
+        return None
+    if session["lost"]:
+        seq = session["lost"][0]
+    elif session["next_seq"] < session["count"]:
+        seq = session["next_seq"]
+    else:
+        return None
+    return seq if seq // PACKETS_PER_BLOCK in session["blocks"] else None
+
+
+def send_packet(sock, addr, chunk_id, session, seq):
+    start = (seq % PACKETS_PER_BLOCK) * PAYLOAD_SIZE
+    data = memoryview(session["blocks"][seq // PACKETS_PER_BLOCK])[start:start + PAYLOAD_SIZE]
+    sock.sendto(HEADER.pack(OP_DATA, chunk_id, seq, session["count"]) + data, addr)
+    stats["packets_out"] += 1
 
-            try:
-                filename, chunk_info = request.split(" ", 1)
-                chunk_id, offset_start, offset_end = map(int, chunk_info[1:-1].split(","))
 
-                with open("filelist.json", "r") as f:
-                    filelist = json.load(f)
+def pump(sock, key, session):
+    """
+    Resend lost packets, then send new ones, as long as the congestion window allows. Blocks about to be sent are read
+    ahead by the workers, packets whose block isn't read yet wait for it
 
-                if filename not in filelist:
-                    sock.sendto(b"File not found\n", addr)
-                    continue
+    :return: Whether the socket could take every packet the window allowed
+    """
+    addr, chunk_id = key
+    now = time.monotonic()
+    in_flight = session["in_flight"]
+    if in_flight and now >= session["deadline"]:  # No progress for a whole RTO, resend everything in flight
+        cut_window(session, timeout=True)
+        session["rto"] = min(MAX_RTO, session["rto"] * 2)
+        session["deadline"] = now + session["rto"]
+        session["lost"] = list(in_flight)
+        for entry in in_flight.values():
+            entry[1] = True
 
-                filepath = os.path.join("files", filename)
-                filesize = filelist[filename]
+    for seq in session["lost"][:1] + [session["next_seq"]]:
+        first = seq // PACKETS_PER_BLOCK
+        for block in range(first, first + 1 + READ_AHEAD_BLOCKS):
+            if block * PACKETS_PER_BLOCK >= session["count"]:
+                break
+            if block not in session["blocks"] and block not in session["reading"]:
+                read_block(key, session, block)
 
-                if offset_end > filesize:
-                    offset_end = filesize
+    try:
+        while (seq := next_packet(session)) is not None:
+            send_packet(sock, addr, chunk_id, session, seq)
+            if session["lost"] and seq == session["lost"][0]:
+                session["lost"].pop(0)
+                in_flight[seq][0] = time.monotonic()
+                stats["retransmits"] += 1
+            else:
+                in_flight[seq] = [time.monotonic(), False]
+                session["next_seq"] += 1
+    except BlockingIOError:  # Send buffer full, wait until the socket is writable
+        return False
+    if not in_flight:
+        session["deadline"] = now + session["rto"]
+    return True
 
-                with open(filepath, "rb") as f:
-                    f.seek(offset_start)
-                    chunk_data = f.read(offset_end - offset_start)
 
-                response = f"{chunk_id},{len(chunk_data)}|{chunk_data.decode(errors='ignore')}" # Gửi kèm chunk_id và kích thước chunk
-                sock.sendto(response.encode(), addr)
+def report_stats(elapsed):
+    print(f"{stats['requests'] / elapsed:.1f} requests/s | {stats['packets_in'] / elapsed:.0f} packets in/s | "
+          f"{stats['packets_out'] / elapsed:.0f} packets out/s | {stats['retransmits'] / elapsed:.0f} retransmits/s | "
+          f"{len(sessions)} chunks | {len(handles.handles)} open files")
+    for name in stats:
+        stats[name] = 0
+
+
+def handle_client(sock):
+    reported_at = time.monotonic()
+    while True:
+        # Wake up for packets, finished disk reads, the socket becoming writable, or the nearest retransmission deadline
+        now = time.monotonic()
+        timeout = min((session["deadline"] for session in sessions.values()), default=now + 1) - now
+        writable = [sock] if any(next_packet(session) is not None for session in sessions.values()) else []
+        readable, writable, _ = select.select([sock, wakeup_reader], writable, [], max(0.0, min(timeout, 1)))
+
+        if wakeup_reader in readable:
+            finish_reads()
+        while sock in readable:
+            try:
+                data, addr = sock.recvfrom(BUFFER_SIZE)
+            except BlockingIOError:
+                break
+            except ConnectionResetError:
+                continue  # Client went away, its chunks time out
 
+            stats["packets_in"] += 1
+            if len(data) < HEADER.size:
+                continue
+            opcode, chunk_id, seq, _ = HEADER.unpack_from(data)
+            if opcode == OP_REQUEST:
+                start_session(sock, addr, chunk_id, data[HEADER.size:])
+            elif opcode == OP_ACK and (session := sessions.get((addr, chunk_id))) is not None:
+                handle_ack(session, seq, data[HEADER.size:])
+                if session["acked"] >= session["count"]:
+                    close_session((addr, chunk_id))
 
-            except (ValueError, IndexError):
-                sock.sendto(b"Invalid request\n", addr)
+        now = time.monotonic()
+        for key, session in list(sessions.items()):
+            if now - session["heard"] > SESSION_TIMEOUT:
+                print(f"Client {key[0]} disconnected.")
+                close_session(key)
+            elif not pump(sock, key, session):
+                break
 
-        except ConnectionResetError:
-            print(f"Client {addr} disconnected.")
-            break  # Thoát khỏi vòng lặp khi client ngắt kết nối
+        if now - reported_at >= STATS_INTERVAL:
+            report_stats(now - reported_at)
+            reported_at = now
 
 
 def main():
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.bind((SERVER_IP, SERVER_PORT))
+    sock.setblocking(False)
     print(f"Server started on {SERVER_IP}:{SERVER_PORT}")
 
     while True:
@@ -55,4 +401,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
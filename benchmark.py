@@ -0,0 +1,367 @@
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import itertools
+import tracemalloc
+import threading
+import subprocess
+from contextlib import redirect_stdout
+from typing import Optional
+
+FILE_SIZE_SUFFIXES = {"K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30}
+HIGHER_IS_BETTER = {"throughput": True, "ttfb": False, "peak_rss": False, "cpu_per_gb": False}
+
+
+def parse_size(text: str) -> int:
+	"""
+	Parse a size like 64K, 1M or 1G
+
+	:param text: Size with an optional K, M or G suffix
+	:return: Size in bytes
+	"""
+	text = text.strip().upper()
+	if text[-1:] in FILE_SIZE_SUFFIXES:
+		return int(float(text[:-1]) * FILE_SIZE_SUFFIXES[text[-1]])
+	return int(text)
+
+
+def case_name(case: dict) -> str:
+	return f"size={case['size']} segments={case['segments']} buffer={case['buffer']} clients={case['clients']} writer={case.get('writer', 'pwrite')}"
+
+
+def generate_data(directory: str, sizes: list[int]) -> None:
+	"""
+	Write an incompressible file per size to directory/data, files of the right size are kept between runs
+
+	:param directory: Benchmark directory
+	:param sizes: File sizes in bytes
+	:return: None
+	"""
+	data_directory = os.path.join(directory, "data")
+	os.makedirs(data_directory, exist_ok=True)
+	os.makedirs(os.path.join(directory, "work"), exist_ok=True)
+	for size in sizes:
+		file_path = os.path.join(data_directory, f"bench_{size}.bin")
+		if os.path.exists(file_path) and os.path.getsize(file_path) == size:
+			continue
+		with open(file_path, "wb") as file:
+			for start in range(0, size, 2 ** 20):
+				file.write(os.urandom(min(2 ** 20, size - start)))
+	return None
+
+
+def run_case(directory: str, case: dict) -> dict:
+	"""
+	Serve one file on an ephemeral localhost port and download it with concurrent clients, in this process
+
+	:param directory: Benchmark directory holding data, work and download directories
+	:param case: Dict of file size, segment count, buffer size, client count and writer backend
+	:return: Dict of throughput in MB/s and time to first byte in seconds
+	"""
+	os.chdir(os.path.join(directory, "work"))  # Server paths are relative to the working directory
+	sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+	import client
+	import server
+	import buffers
+	import writers
+	import scheduler
+
+	file_name = f"bench_{case['size']}.bin"
+	with open("file_permission.json", "w") as file:
+		json.dump({"permitted_files": {file_name: f"{case['size']}B"}}, file)
+
+	# Parameters under test
+	scheduler.MAX_SEGMENT_CONNECTIONS = case["segments"]
+	client.MAX_CONNECTIONS = case["segments"]
+	buffers.RECEIVE_BUFFER_SIZE = case["buffer"]
+	server.SEND_QUANTUM = case["buffer"]
+
+	first_bytes = {}  # Time of the first write per output file, each client downloads one
+
+	class BenchmarkWriter(writers.WRITERS[case["writer"]]):
+		def write_at(self, offset: int, data) -> None:
+			first_bytes.setdefault(id(self), time.perf_counter())
+			return super().write_at(offset, data)
+
+		def receive(self, reader, offset: int, size: int):
+			first_bytes.setdefault(id(self), time.perf_counter())
+			return super().receive(reader, offset, size)
+
+	writers.WRITERS[case["writer"]] = BenchmarkWriter
+
+	control_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	control_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	control_socket.bind(("127.0.0.1", 0))
+	port = control_socket.getsockname()[1]
+
+	with redirect_stdout(open(os.devnull, "w")):
+		benchmark_server = server.Server("127.0.0.1", port, control_socket)
+		server_thread = threading.Thread(target=benchmark_server.run)
+		server_thread.start()
+
+		clients = [client.Client(sinks=[], writer=case["writer"]) for _ in range(case["clients"])]
+		directories = []
+		for index in range(case["clients"]):
+			to_directory = os.path.join(directory, "download", str(index))
+			shutil.rmtree(to_directory, ignore_errors=True)
+			os.makedirs(to_directory)
+			directories.append(to_directory)
+
+		threads = [threading.Thread(target=benchmark_client.run, args=("127.0.0.1", port), kwargs={"to_directory": to_directory})
+				   for benchmark_client, to_directory in zip(clients, directories)]
+		started_at = time.perf_counter()
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		elapsed = time.perf_counter() - started_at
+
+		benchmark_server.stop()
+		server_thread.join()
+
+	for to_directory in directories:
+		file_path = os.path.join(to_directory, f"RECV_{file_name}")
+		if not os.path.exists(file_path) or os.path.getsize(file_path) != case["size"]:
+			raise RuntimeError(f"Download of {file_name} to {to_directory} is incomplete")
+		shutil.rmtree(to_directory)
+
+	first_bytes = [first_byte_at - started_at for first_byte_at in first_bytes.values()]
+	return {
+		"elapsed": elapsed,
+		"throughput": case["size"] * case["clients"] / elapsed / 2 ** 20,
+		"ttfb": sum(first_bytes) / len(first_bytes) if first_bytes else elapsed
+	}
+
+
+def measure_case(directory: str, case: dict) -> dict:
+	"""
+	Run a case in a fresh interpreter, so its peak memory and CPU time are its own
+
+	:param directory: Benchmark directory
+	:param case: Case to run
+	:return: Dict of case parameters and metrics
+	"""
+	process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--directory", directory, "--case", json.dumps(case)],
+							   stdout=subprocess.PIPE)
+	output = process.stdout.read()
+	_, status, usage = os.wait4(process.pid, 0)
+	process.returncode = os.waitstatus_to_exitcode(status)
+	if process.returncode:
+		raise RuntimeError(f"Case {case_name(case)} failed with exit code {process.returncode}")
+
+	result = json.loads(output)
+	peak_rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 2 ** 10  # Linux reports KiB
+	transferred = case["size"] * case["clients"]
+	return {
+		**case,
+		"throughput": result["throughput"],
+		"ttfb": result["ttfb"],
+		"peak_rss": peak_rss,
+		"cpu_per_gb": (usage.ru_utime + usage.ru_stime) / (transferred / 2 ** 30) if transferred else 0.0
+	}
+
+
+def build_stream(kind: str, size: int) -> bytes:
+	"""
+	Bytes a server sends for one RETR of size bytes
+
+	:param kind: "raw" for protocol 1 mode "R", "framed" for protocol 1 mode "S",
+		"frames" for protocol 2 data frames, "checksum" for protocol 2 data frames with checksums
+	:param size: Number of file bytes
+	:return: Stream
+	"""
+	from protocol import OP_DATA, OP_END, FLAG_CHECKSUM, pack_frame
+
+	def message(text: str) -> bytes:
+		return len(text).to_bytes(4, "big") + text.encode()
+
+	block = os.urandom(2 ** 16)
+	if kind == "raw":
+		return message(f"150 Opening raw data transfer ({size} bytes)") + block * (size // len(block)) + message("226 Transfer complete")
+	if kind == "framed":
+		frame = b"".join(message_block for start in range(0, len(block), 4096)
+						 for message_block in (len(block[start:start + 4096]).to_bytes(4, "big"), block[start:start + 4096]))
+		return message("150 File status ok") + frame * (size // len(block)) + message("EOF") + message("226 Transfer complete")
+	flags = FLAG_CHECKSUM if kind == "checksum" else 0
+	return b"".join(pack_frame(OP_DATA, block, offset, flags) for offset in range(0, size, len(block))) + pack_frame(OP_END, offset=size)
+
+
+def copy_receive(sock: socket.socket, size: int, writer) -> int:
+	"""
+	Receive a protocol 1 mode "S" stream the way the client did before its receive buffer, a fresh bytearray per frame
+
+	:param sock: Socket to receive
+	:param size: Number of file bytes
+	:param writer: Writer of the data
+	:return: Number of bytes received
+	"""
+	def recv_n(count: int) -> bytearray:
+		data = bytearray()
+		while len(data) < count:
+			data.extend(sock.recv(count - len(data)))
+		return data
+
+	def recv_message() -> bytearray:
+		return recv_n(int.from_bytes(recv_n(4), "big"))
+
+	recv_message()
+	total_received = 0
+	while (data := recv_message()) != b"EOF":
+		writer.write_at(total_received, data)
+		total_received += len(data)
+	recv_message()
+	return total_received
+
+
+def receive_benchmark(megabytes: int) -> list[dict]:
+	"""
+	Measure the client receive path alone over a socket pair: throughput, and the bytes allocated while receiving,
+	taken as the traced memory peak between two writes above what was alive at the first one
+
+	:param megabytes: Megabytes received per path
+	:return: Result per path
+	"""
+	sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+	import client
+	from pool import Connection
+	from scheduler import Segment
+
+	size = megabytes * 2 ** 20
+	receiver = client.Client(sinks=[])
+
+	class NullWriter:
+		def __init__(self, trace: bool):
+			self.trace = trace
+			self.last = tracemalloc.get_traced_memory()[0] if trace else 0
+			self.allocated = 0
+
+		def write_at(self, offset: int, data) -> None:
+			if self.trace:  # Highest traced memory since the previous write, above what was alive then
+				current, peak = tracemalloc.get_traced_memory()
+				self.allocated += max(0, peak - self.last)
+				self.last = current
+				tracemalloc.reset_peak()
+			return None
+
+		def receive(self, reader, offset: int, size: int):
+			if (data := reader.read_some(size)) is not None:  # View of the connection's own receive buffer
+				self.write_at(offset, data)
+			return data
+
+	def run(kind: str, trace: bool) -> tuple[float, int]:
+		stream = build_stream("framed" if kind == "copy" else kind, size)
+		server_socket, client_socket = socket.socketpair()
+		sender = threading.Thread(target=server_socket.sendall, args=(stream,), daemon=True)
+		protocol, mode = (2, "S") if kind in ("frames", "checksum") else (1, "R" if kind == "raw" else "S")
+		connection = Connection(client_socket, ("", 0), mode, None, protocol, kind == "checksum")
+		if trace:
+			tracemalloc.start()
+		writer = NullWriter(trace)
+		sender.start()
+		started_at = time.perf_counter()
+		if kind == "copy":
+			received = copy_receive(client_socket, size, writer)
+		else:
+			received = receiver._handle_chunk(connection, 0, size, writer, Segment(0, size))
+		elapsed = time.perf_counter() - started_at
+		if trace:
+			tracemalloc.stop()
+		sender.join()
+		server_socket.close()
+		client_socket.close()
+		if received != size:
+			raise RuntimeError(f"Receive path {kind} got {received} of {size} bytes")
+		return elapsed, writer.allocated
+
+	results = []
+	for kind in ("copy", "framed", "raw", "frames", "checksum"):
+		elapsed, _ = run(kind, False)
+		_, allocated = run(kind, True)
+		results.append({"path": kind, "throughput": size / elapsed / 2 ** 20, "allocated_per_mb": allocated / megabytes})
+	return results
+
+
+def compare(results: list[dict], baseline: list[dict], tolerance: float) -> list[str]:
+	"""
+	Find metrics that got worse than the baseline by more than the tolerance
+
+	:param results: Results of this run
+	:param baseline: Results of a previous run
+	:param tolerance: Allowed relative change, e.g. 0.1 for 10%
+	:return: Description of every regression
+	"""
+	baseline_cases = {case_name(result): result for result in baseline}
+	regressions = []
+	for result in results:
+		previous = baseline_cases.get(case_name(result))
+		if previous is None:
+			continue
+		for metric, higher_is_better in HIGHER_IS_BETTER.items():
+			old, new = previous[metric], result[metric]
+			if not old:
+				continue
+			change = (new - old) / old
+			if (-change if higher_is_better else change) > tolerance:
+				regressions.append(f"{case_name(result)}: {metric} {old:.4g} -> {new:.4g} ({change:+.1%})")
+	return regressions
+
+
+def main(arguments: Optional[list[str]] = None) -> int:
+	parser = argparse.ArgumentParser(description="Benchmark Server and Client downloads over localhost")
+	parser.add_argument("--sizes", default="1K,1M,64M,1G", help="Comma separated file sizes")
+	parser.add_argument("--segments", default="1,4,8", help="Comma separated segment connection counts")
+	parser.add_argument("--buffers", default="16K,64K,256K", help="Comma separated send and receive buffer sizes")
+	parser.add_argument("--clients", default="1,4", help="Comma separated concurrent client counts")
+	parser.add_argument("--writers", default="pwrite,mmap", help="Comma separated client writer backends")
+	parser.add_argument("--directory", default=os.path.join(tempfile.gettempdir(), "download-manager-benchmark"),
+						help="Directory of generated data, kept between runs")
+	parser.add_argument("--output", default="benchmark.json", help="Path of the JSON results")
+	parser.add_argument("--baseline", help="JSON results of a previous run to compare against")
+	parser.add_argument("--tolerance", type=float, default=0.1, help="Relative change flagged as a regression")
+	parser.add_argument("--receive", type=int, metavar="MB",
+						help="Only run the receive path microbenchmark over a socket pair with this many megabytes")
+	parser.add_argument("--case", help=argparse.SUPPRESS)
+	args = parser.parse_args(arguments)
+	directory = os.path.abspath(args.directory)
+
+	if args.case is not None:  # Child process running a single case
+		print(json.dumps(run_case(directory, json.loads(args.case))))
+		return 0
+	if args.receive is not None:
+		for result in receive_benchmark(args.receive):
+			print(f"{result['path']}: {result['throughput']:.1f} MB/s | {result['allocated_per_mb'] / 2 ** 10:.2f} KB allocated per MB")
+		return 0
+
+	sizes = [parse_size(size) for size in args.sizes.split(",")]
+	generate_data(directory, sizes)
+	cases = [{"size": size, "segments": int(segments), "buffer": parse_size(buffer), "clients": int(clients), "writer": writer}
+			 for size, segments, buffer, clients, writer in itertools.product(sizes, args.segments.split(","), args.buffers.split(","),
+																			 args.clients.split(","), args.writers.split(","))]
+
+	results = []
+	for case in cases:
+		result = measure_case(directory, case)
+		results.append(result)
+		print(f"{case_name(case)}: {result['throughput']:.1f} MB/s | TTFB {result['ttfb'] * 1000:.1f} ms | "
+			  f"RSS {result['peak_rss'] / 2 ** 20:.1f} MB | {result['cpu_per_gb']:.2f} CPU s/GB")
+
+	with open(args.output, "w") as file:
+		json.dump({"created_at": time.time(), "results": results}, file, indent=4)
+	print(f"Results written to {args.output}")
+
+	if args.baseline is None:
+		return 0
+	with open(args.baseline, "r") as file:
+		regressions = compare(results, json.load(file)["results"], args.tolerance)
+	for regression in regressions:
+		print(f"Regression: {regression}")
+	return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
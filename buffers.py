@@ -0,0 +1,98 @@
+import socket
+from typing import Optional
+
+from constants import RECEIVE_BUFFER_SIZE
+
+
+class ReceiveBuffer:
+	def __init__(self,
+				 sock: socket.socket,
+				 size: Optional[int] = None):
+		"""
+		Preallocated receive buffer of a connection. read and read_some hand out memoryview slices of it,
+		which stay valid until the next read, so received bytes reach the consumer without being copied
+
+		:param sock: Connected socket
+		:param size: Initial buffer size, default to RECEIVE_BUFFER_SIZE, grown when a single read needs more
+		"""
+		self._socket = sock
+		self._buffer = bytearray(size or RECEIVE_BUFFER_SIZE)
+		self._view = memoryview(self._buffer)
+		self._start = 0  # Buffered bytes not yet handed out are self._buffer[self._start:self._end]
+		self._end = 0
+
+	@property
+	def buffered(self) -> int:
+		return self._end - self._start
+
+	def _fill(self, size: int) -> bool:
+		"""
+		Receive until at least size bytes are buffered, more may arrive in the same call
+
+		:param size: Number of bytes needed
+		:return: Whether enough bytes arrived before the connection closed
+		"""
+		buffered = self._end - self._start
+		if buffered >= size:
+			return True
+
+		if self._start + size > len(self._buffer):  # Not enough room after the buffered bytes
+			if size > len(self._buffer):
+				buffer = bytearray(size)
+				buffer[:buffered] = self._view[self._start:self._end]
+				self._buffer, self._view = buffer, memoryview(buffer)
+			else:
+				self._view[:buffered] = self._view[self._start:self._end]
+			self._start, self._end = 0, buffered
+
+		while self._end - self._start < size:
+			current_received = self._socket.recv_into(self._view[self._end:])
+			if not current_received:
+				return False
+			self._end += current_received
+		return True
+
+	def read(self, size: int) -> Optional[memoryview]:
+		"""
+		Take exactly size bytes
+
+		:param size: Number of bytes
+		:return: View of the bytes, None if connection closed first
+		"""
+		if not self._fill(size):
+			return None
+		view = self._view[self._start:self._start + size]
+		self._start += size
+		return view
+
+	def read_some(self, size: int) -> Optional[memoryview]:
+		"""
+		Take at least one and at most size bytes, for payloads consumed as they arrive
+
+		:param size: Maximum number of bytes
+		:return: View of the bytes, None if connection closed
+		"""
+		if self._start == self._end:
+			self._start = self._end = 0
+			if not self._fill(1):
+				return None
+		view = self._view[self._start:min(self._end, self._start + size)]
+		self._start += len(view)
+		return view
+
+	def recv_into(self, buffer: bytearray | memoryview, size: int = 0) -> int:
+		"""
+		Same as socket.recv_into, buffered bytes come first
+
+		:param buffer: Buffer to receive into
+		:param size: Maximum number of bytes, default to the buffer size
+		:return: Number of bytes received, 0 if connection closed
+		"""
+		size = size or len(buffer)
+		if self._start == self._end:
+			return self._socket.recv_into(buffer, size)
+
+		size = min(size, self._end - self._start)
+		buffer[:size] = self._view[self._start:self._start + size]
+		self._start += size
+		return size
@@ -0,0 +1,63 @@
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+from constants import BLOCK_CACHE_SIZE
+
+
+class BlockCache:
+	def __init__(self, capacity: int = BLOCK_CACHE_SIZE):
+		"""
+		Least recently used cache of file blocks, bounded by the total size of the blocks it holds.
+		Only used from the server event loop, so it takes no lock
+
+		:param capacity: Maximum number of bytes held
+		"""
+		self.capacity = capacity
+		self.size = 0
+		self._blocks = OrderedDict()
+		"""
+		OrderedDict = {
+			(file name, file version, block index): block bytes, least recently used first
+		}
+		"""
+
+	def __len__(self) -> int:
+		return len(self._blocks)
+
+	def __contains__(self, key: Hashable) -> bool:
+		return key in self._blocks
+
+	def get(self, key: Hashable) -> Optional[bytes]:
+		"""
+		Look up a block, marking it as most recently used
+
+		:param key: Block key
+		:return: Block, None if not cached
+		"""
+		block = self._blocks.get(key)
+		if block is not None:
+			self._blocks.move_to_end(key)
+		return block
+
+	def put(self, key: Hashable, block: bytes) -> int:
+		"""
+		Add a block, evicting least recently used blocks until the cache fits its capacity again
+
+		:param key: Block key
+		:param block: Block bytes
+		:return: Number of blocks evicted
+		"""
+		if len(block) > self.capacity:
+			return 0
+
+		if (previous := self._blocks.pop(key, None)) is not None:
+			self.size -= len(previous)
+		self._blocks[key] = block
+		self.size += len(block)
+
+		evicted = 0
+		while self.size > self.capacity:
+			_, block = self._blocks.popitem(last=False)
+			self.size -= len(block)
+			evicted += 1
+		return evicted
@@ -0,0 +1,185 @@
+import os
+import json
+import bisect
+import fnmatch
+import threading
+from typing import Optional
+
+from constants import DATA_DIRECTORY, LIST_PAGE_SIZE
+
+
+class Catalog:
+	def __init__(self,
+				 permission_path: str = "file_permission.json",
+				 data_directory: str = DATA_DIRECTORY):
+		"""
+		In-memory index of permitted files, refreshed by polling file status instead of reloading everything
+
+		:param permission_path: Path of the file permission list
+		:param data_directory: Directory of served files
+		"""
+		self._permission_path = permission_path
+		self._data_directory = data_directory
+
+		self._lock = threading.Lock()
+		self._permitted = set()
+		self._permission_mtime = None
+		self.version = 0
+
+		self._entries = {}
+		"""
+		dict = {
+			file name: {
+				"size": file size in bytes,
+				"mtime": modification time in nanoseconds,
+				"version": catalog version of the last change,
+				"etag": tag changing whenever the file content may have changed
+			}
+		}
+		"""
+		self._removed = {}
+		"""
+		dict = {
+			file name: catalog version it was removed in
+		}
+		"""
+		self._names = []  # Sorted names of the entries, pages are cut from it
+		self.refresh()
+
+	def __len__(self) -> int:
+		return len(self._entries)
+
+	def _load_permissions(self) -> None:
+		"""
+		Reload the file permission list if it changed since last load
+
+		:return: None
+		"""
+		try:
+			mtime = os.stat(self._permission_path).st_mtime_ns
+		except OSError:
+			return None
+		if mtime == self._permission_mtime:
+			return None
+
+		try:
+			with open(self._permission_path, "r") as file:
+				data = json.load(file).get("permitted_files") or {}
+		except (OSError, ValueError):  # Being rewritten, try again next refresh
+			return None
+		self._permitted = set(data.keys())
+		self._permission_mtime = mtime
+		return None
+
+	def refresh(self) -> int:
+		"""
+		Stat every permitted file, bump the catalog version if any of them changed, appeared or disappeared.
+		Safe to call from a thread other than the one serving clients
+
+		:return: Number of changed entries
+		"""
+		self._load_permissions()
+		current = {}
+		# One pass over the directory instead of a lookup per permitted file, the listing already tells files apart
+		try:
+			with os.scandir(self._data_directory) as entries:
+				for entry in entries:
+					if entry.name in self._permitted and entry.is_file():
+						try:
+							file_stat = entry.stat()
+						except OSError:
+							continue
+						current[entry.name] = (file_stat.st_size, file_stat.st_mtime_ns)
+		except OSError:
+			pass
+		for file_name in self._permitted:
+			if file_name not in current and os.path.dirname(file_name):  # Permitted file in a sub directory
+				try:
+					file_stat = os.stat(os.path.join(self._data_directory, file_name))
+				except OSError:
+					continue
+				current[file_name] = (file_stat.st_size, file_stat.st_mtime_ns)
+
+		with self._lock:
+			changed = [file_name for file_name, status in current.items()
+					   if (entry := self._entries.get(file_name)) is None or (entry["size"], entry["mtime"]) != status]
+			removed = [file_name for file_name in self._entries if file_name not in current]
+			if not changed and not removed:
+				return 0
+
+			self.version += 1
+			for file_name in changed:
+				size, mtime = current[file_name]
+				self._entries[file_name] = {"size": size, "mtime": mtime, "version": self.version, "etag": f"{size:x}-{mtime:x}"}
+				self._removed.pop(file_name, None)
+			for file_name in removed:
+				del self._entries[file_name]
+				self._removed[file_name] = self.version
+			if removed or len(self._names) != len(self._entries):  # Names came or went
+				self._names = sorted(self._entries)
+		return len(changed) + len(removed)
+
+	def get(self, file_name: str) -> Optional[dict]:
+		with self._lock:
+			return self._entries.get(file_name)
+
+	def sizes(self) -> dict[str, int]:
+		"""
+		Sizes of every permitted file
+
+		:return: Dict of file name to size
+		"""
+		with self._lock:
+			return {file_name: entry["size"] for file_name, entry in self._entries.items()}
+
+	def changes(self, since: int) -> dict:
+		"""
+		Entries changed and removed after a catalog version
+
+		:param since: Catalog version the client already has, 0 for everything
+		:return: Dict with current version, changed files and removed file names
+		"""
+		with self._lock:
+			return {
+				"version": self.version,
+				"files": {file_name: dict(entry) for file_name, entry in self._entries.items() if entry["version"] > since},
+				"removed": [file_name for file_name, version in self._removed.items() if version > since]
+			}
+
+	def page(self, since: Optional[int] = None, prefix: Optional[str] = None, pattern: Optional[str] = None,
+			 after: Optional[str] = None, limit: int = LIST_PAGE_SIZE) -> dict:
+		"""
+		Entries in file name order, filtered and cut into pages, so a large catalog is listed a page at a time
+
+		:param since: Only entries changed after this catalog version, None for every entry
+		:param prefix: Only file names starting with it
+		:param pattern: Only file names matching this glob pattern
+		:param after: Cursor of the previous page, only file names after it
+		:param limit: Maximum number of entries
+		:return: Dict with current version, entries of the page, file names removed after since (last page only)
+			and the cursor of the next page (None on the last page)
+		"""
+		def selected(file_name: str) -> bool:
+			return (prefix is None or file_name.startswith(prefix)) and (pattern is None or fnmatch.fnmatchcase(file_name, pattern))
+
+		with self._lock:
+			index = bisect.bisect_right(self._names, after) if after is not None else 0
+			if prefix is not None:
+				index = max(index, bisect.bisect_left(self._names, prefix))
+
+			files = {}
+			cursor = None
+			for file_name in self._names[index:]:
+				if prefix is not None and not file_name.startswith(prefix):  # Past the names sharing the prefix
+					break
+				if len(files) == limit:
+					cursor = next(reversed(files))
+					break
+				entry = self._entries[file_name]
+				if (since is None or entry["version"] > since) and selected(file_name):
+					files[file_name] = dict(entry)
+
+			removed = []
+			if cursor is None and since is not None:
+				removed = [file_name for file_name, version in self._removed.items() if version > since and selected(file_name)]
+			return {"version": self.version, "files": files, "removed": removed, "cursor": cursor}
@@ -1,18 +1,55 @@
 import os
+import re
 import json
 import socket
+import time
 import struct
 import threading
-from typing import Optional
-
-from constants import SERVER_HOST, SERVER_PORT, ENCODE_FORMAT, RECEIVE_DIRECTORY  # , FILE_SIZE_UNITS
+from collections import deque
+from typing import Any, Callable, Optional
+
+from constants import SERVER_HOST, SERVER_PORT, ENCODE_FORMAT, RECEIVE_DIRECTORY, PIPELINE_DEPTH, \
+	VERIFY_RETRIES, COMPRESSION, MAX_CONNECTIONS, PROTOCOL_CHECKSUM, WRITER, STALL_TIMEOUT, MANIFEST_TIMEOUT, DELTA_DOWNLOAD, \
+	BULK_FILE_SIZE, MGET_BATCH_FILES, LIST_PAGE_SIZE, LIST_PRINT_LIMIT  # , FILE_SIZE_UNITS
+from writers import PwriteWriter, WRITERS
+from scheduler import Segment, SegmentScheduler
+from pool import Connection, ConnectionPool
+from resume import DownloadState
+from delta import find_blocks, copy_blocks
+from verify import BlockHasher, BlockVerifier
+from compression import COMPRESSORS, BLOCK_COMPRESSED
+from downloads import DownloadQueue
+from mirrors import MirrorSet
+from progress import ProgressMonitor, TerminalSink
+from buffers import ReceiveBuffer
+from protocol import PROTOCOL_VERSION, HEADER, CHECKSUM, OP_COMMAND, OP_REPLY, OP_DATA, OP_END, OP_ERROR, OP_ENTRY, \
+	FLAG_COMPRESSED, FLAG_CHECKSUM, checksum, pack_frame
 
 
 class Client:
-	def __init__(self):
+	def __init__(self, compression: Optional[str] = COMPRESSION, sinks: Optional[list] = None, writer: str = WRITER,
+				 delta: bool = DELTA_DOWNLOAD):
+		"""
+		:param compression: Algorithm to ask compressed transfers with, None for raw transfers
+		:param sinks: Receivers of progress events, see progress.py, default to a terminal status line
+		:param writer: Backend writing downloaded files, a name in writers.WRITERS
+		:param delta: Update existing local copies by downloading only the blocks that changed,
+			otherwise a file already downloaded is saved again under a numbered name
+		"""
+		self._compression = compression
+		self._writer = WRITERS[writer]
+		self._delta = delta
+		self._progress = ProgressMonitor(sinks if sinks is not None else [TerminalSink()])
 		self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self._protocol = 1  # Protocol version of the control connection
+		self._address = (SERVER_HOST, SERVER_PORT)
+		self._pool = ConnectionPool(self._open_connection, self._close_connection)
+		self._budget = threading.BoundedSemaphore(MAX_CONNECTIONS)  # Data connections in use over every download
+		self._mirrors = MirrorSet()
 
 		self._permitted_files = {}
+		self._catalog_version = 0
+		self._file_mtimes = {}  # Modification time in nanoseconds of permitted files, from servers listing it
 
 	@staticmethod
 	def _connect(client_socket: socket.socket, address: tuple[str, int]) -> bool:
@@ -31,28 +68,60 @@ class Client:
 		return True
 
 	@staticmethod
-	def _send(client_socket: socket.socket, data: str | bytes) -> None:
+	def _send(client_socket: socket.socket, data: str | bytes, protocol: int = 1) -> None:
 		"""
 		Send data to the client socket
 
 		:param client_socket: Socket to send
 		:param data: Data to send, encode to bytes if necessary
+		:param protocol: Protocol version of the connection
 		:return: None
 		"""
 		if isinstance(data, str):
 			data = data.encode(ENCODE_FORMAT)
 
-		packed_data = struct.pack("!I", len(data)) + data
+		if protocol == 2:
+			packed_data = pack_frame(OP_COMMAND, data)
+		else:
+			packed_data = struct.pack("!I", len(data)) + data
 		client_socket.sendall(packed_data)
 		return None
 
 	@staticmethod
-	def _recv(client_socket: socket.socket) -> tuple[int, str]:
+	def _recv(client_socket: socket.socket | ReceiveBuffer, protocol: int = 1) -> tuple[int, str]:
+		if protocol == 2:
+			frame = Client._recv_frame(client_socket)
+			if frame is None or frame[0] not in (OP_REPLY, OP_ERROR):
+				return 0, ""
+			return len(frame[3]), frame[3].decode(ENCODE_FORMAT)
+
 		size, raw_data = Client._recv_raw(client_socket)
 		return size, raw_data.decode(ENCODE_FORMAT)
 
 	@staticmethod
-	def _recv_raw(client_socket: socket.socket) -> tuple[int, bytes]:
+	def _recv_frame(client_socket: socket.socket | ReceiveBuffer) -> Optional[tuple[int, int, int, bytearray]]:
+		"""
+		Receive a whole protocol 2 frame, check its checksum if it has one
+
+		:param client_socket: Socket to receive
+		:return: Tuple of opcode, flags, offset and payload, None if connection closed
+		"""
+		header = Client._recv_n(client_socket, HEADER.size)
+		if header is None:
+			return None
+		opcode, flags, size, offset = HEADER.unpack(header)
+		payload = Client._recv_n(client_socket, size)
+		if payload is None:
+			return None
+		if flags & FLAG_CHECKSUM:
+			if (expected := Client._recv_n(client_socket, CHECKSUM.size)) is None:
+				return None
+			if checksum(payload) != expected:
+				raise ConnectionError(f"Checksum mismatch of frame at offset {offset}")
+		return opcode, flags, offset, payload
+
+	@staticmethod
+	def _recv_raw(client_socket: socket.socket | ReceiveBuffer) -> tuple[int, bytes]:
 		"""
 		Receive data from client socket
 
@@ -65,23 +134,27 @@ class Client:
 
 		size = struct.unpack("!I", header)[0]
 		data = Client._recv_n(client_socket, size)
+		if data is None:  # Connection closed in the middle of the message
+			return 0, "".encode(ENCODE_FORMAT)
 		return size, data
 
 	@staticmethod
-	def _recv_n(client_socket: socket.socket, size: int) -> Optional[bytes]:
+	def _recv_n(client_socket: socket.socket | ReceiveBuffer, size: int) -> Optional[bytearray]:
 		"""
 		Receive exactly size bytes from client socket
 
-		:param client_socket: Socket to receive
+		:param client_socket: Socket to receive, or the receive buffer of a data connection
 		:param size: Number of bytes to receive
 		:return: Data received
 		"""
-		data = bytearray()
-		while (current_size := len(data)) < size:
-			packet = client_socket.recv(size - current_size)
-			if not packet:
+		data = bytearray(size)
+		view = memoryview(data)
+		received = 0
+		while received < size:
+			current_received = client_socket.recv_into(view[received:], size - received)
+			if not current_received:
 				return None
-			data.extend(packet)
+			received += current_received
 		return data
 
 	@staticmethod
@@ -106,131 +179,750 @@ class Client:
 		if iteration == total:
 			print()
 
-	def _get_permitted_files(self) -> None:
+	def _get_permitted_files(self, prefix: Optional[str] = None, pattern: Optional[str] = None) -> dict[str, int]:
 		"""
-		Get list of permitted files from server
+		Get list of permitted files from server a page at a time, only the changes after the catalog version already known
 
-		:return: None
+		:param prefix: Only files whose name starts with it
+		:param pattern: Only files whose name matches this glob pattern
+		:return: Dict of file name to size of files changed since last call
 		"""
-		self._send(self._socket, "LIST")
-		msg = self._recv(self._socket)
-		if not msg[1].startswith("150"):
-			return None
+		filters = "".join(f" {keyword} {value}" for keyword, value in (("PREFIX", prefix), ("MATCH", pattern)) if value is not None)
+		changed = {}
+		removed = []
+		version = None  # Catalog version of the first page, changes made while paging are listed next call
+		cursor = None
+		while True:
+			after = f" AFTER {cursor}" if cursor is not None else ""
+			self._send(self._socket, f"LIST SINCE {self._catalog_version}{filters}{after} LIMIT {LIST_PAGE_SIZE}", self._protocol)
+			if not self._recv(self._socket, self._protocol)[1].startswith("150"):
+				if version is None:  # Older server lists everything at once
+					return self._get_catalog_changes()
+				break
+
+			while not (msg := self._recv(self._socket, self._protocol)[1]).startswith("226"):
+				data = json.loads(msg)
+				changed.update({file_name: entry["size"] for file_name, entry in data.get("files", {}).items()})
+				self._file_mtimes.update({file_name: entry.get("mtime") for file_name, entry in data.get("files", {}).items()})
+				if "cursor" in data:  # Last message of the page
+					version = data["version"] if version is None else version
+					removed += data["removed"]
+					cursor = data["cursor"]
+			if cursor is None:
+				for file_name in removed:
+					self._permitted_files.pop(file_name, None)
+					self._file_mtimes.pop(file_name, None)
+				self._catalog_version = version
+				break
+		self._permitted_files.update(changed)
+		self._print_permitted_files()
+		return changed
 
-		msg = self._recv(self._socket)
-		self._permitted_files = json.loads(msg[1])
+	def _get_catalog_changes(self) -> dict[str, int]:
+		"""
+		Get list of permitted files from a server without paged listings, in a single message
+
+		:return: Dict of file name to size of files changed since last call
+		"""
+		self._send(self._socket, f"LIST SINCE {self._catalog_version}", self._protocol)
+		msg = self._recv(self._socket, self._protocol)
+		if not msg[1].startswith("150"):
+			return {}
+
+		msg = self._recv(self._socket, self._protocol)
+		data = json.loads(msg[1])
+		if isinstance(data.get("version"), int) and isinstance(data.get("files"), dict):
+			changed = {file_name: entry["size"] for file_name, entry in data["files"].items()}
+			self._file_mtimes.update({file_name: entry.get("mtime") for file_name, entry in data["files"].items()})
+			for file_name in data.get("removed", []):
+				self._permitted_files.pop(file_name, None)
+				self._file_mtimes.pop(file_name, None)
+			self._permitted_files.update(changed)
+			self._catalog_version = data["version"]
+		else:  # Older server sends the whole list of file sizes
+			changed = data
+			self._permitted_files = data
 		# data = json.loads(msg[1])
 		# self._permitted_files = {key: self._parse_file_size(value) for key, value in data.items()}
 
-		self._recv(self._socket)
+		self._recv(self._socket, self._protocol)
+		self._print_permitted_files()
+		return changed
 
+	def _print_permitted_files(self) -> None:
 		# Print to console
 		print("Permitted files:")
-		for file_name, file_size in self._permitted_files.items():
-			print(f"{file_name}: {file_size} Bytes")
+		if len(self._permitted_files) > LIST_PRINT_LIMIT:
+			print(f"{len(self._permitted_files)} files, {sum(self._permitted_files.values())} Bytes")
+		else:
+			for file_name, file_size in self._permitted_files.items():
+				print(f"{file_name}: {file_size} Bytes")
 		print("--------------------------------------------------")
 		return None
 
-	@staticmethod
-	def display_progress(progress):
-		print("\rDownload Progress: ", end="")
-		for part in range(4):
-			print(f"Part {part + 1}: {progress[part]:.2f}% | ", end="")
-		print("", end="", flush=True)
+	def _negotiate(self, client_socket: socket.socket) -> tuple[int, bool]:
+		"""
+		Ask server to switch the connection to binary frames, older servers keep the text protocol
+
+		:param client_socket: Client socket, freshly connected
+		:return: Tuple of protocol version and whether data frames carry a checksum
+		"""
+		self._send(client_socket, f"PROTO {PROTOCOL_VERSION}{' CHECKSUM' if PROTOCOL_CHECKSUM else ''}")
+		reply = self._recv(client_socket)[1]
+		if not reply.startswith("200"):
+			return 1, False
+		return PROTOCOL_VERSION, "CHECKSUM" in reply.split()
+
+	def _set_mode(self, client_socket: socket.socket, protocol: int = 1) -> tuple[str, Optional[str]]:
+		"""
+		Ask server for compressed blocks if compression is enabled, else to stream RETR data raw instead of framing every block.
+		Protocol 2 data frames are already cheap to parse, mode "S" is kept unless compression is enabled
+
+		:param client_socket: Client socket
+		:param protocol: Protocol version of the connection
+		:return: Tuple of transfer mode server accepted and its compression algorithm
+		"""
+		if self._compression is not None:
+			self._send(client_socket, f"MODE Z {self._compression}", protocol)
+			if self._recv(client_socket, protocol)[1].startswith("200"):
+				return "Z", self._compression
+		if protocol == 2:
+			return "S", None
+
+		self._send(client_socket, "MODE R")
+		if self._recv(client_socket)[1].startswith("200"):
+			return "R", None
+		return "S", None
+
+	def _open_connection(self, address: tuple[str, int]) -> Connection:
+		"""
+		Open a data connection for the pool
+
+		:param address: Server address
+		:return: Connection
+		"""
+		sock = socket.create_connection(address, timeout=STALL_TIMEOUT)  # A server sending nothing for that long is stalled
+		try:
+			protocol, with_checksum = self._negotiate(sock)
+			mode, compression = self._set_mode(sock, protocol)
+		except OSError:
+			sock.close()
+			raise
+		return Connection(sock, address, mode, compression, protocol, with_checksum)
+
+	def _close_connection(self, connection: Connection) -> None:
+		self._disconnect(connection.socket, connection.protocol, connection.reader)
 		return None
 
-	def _handle_chunk(self, client_socket: socket.socket, file_name: str, offset: int, chunk_size: int, chunk_order: int, file_data: list,
-					  progresses: list) -> None:
-		self._send(client_socket, f"RETR {file_name} {offset} {chunk_size}")  # Request file from server
-		self._recv(client_socket)  # Guaranteed file available
-		# Receive file data to buffer
+	def _handle_chunk(self, connection: Connection, offset: int, chunk_size: int, writer: PwriteWriter, segment: Segment,
+					  hasher: Optional[BlockHasher] = None) -> int:
+		"""
+		Receive the reply to one RETR range request and write it to its place in the file as it arrives
+
+		:param connection: Data connection the request was sent on
+		:param offset: Starting byte offset
+		:param chunk_size: Number of bytes requested
+		:param writer: Writer of the output file
+		:param segment: Segment the range belongs to, advanced as data arrives
+		:param hasher: Hasher of the blocks in the range, None if not verified while streaming
+		:return: Number of bytes received, fewer than requested if server cut the range short, e.g. the file changed
+		"""
+		reader = connection.reader
+		if connection.protocol == 2:
+			return self._handle_frames(connection, offset, writer, segment, hasher)
+
+		_, reply = self._recv(reader)
+		if not reply:
+			raise EOFError(f"Connection closed before the reply to range {offset}")
+		if not reply.startswith("150"):
+			return 0
+		# Receive file data straight to its place in the file, through the receive buffer or into the writer's mapping
+		total_received = 0
+		if connection.mode == "R" and (match := re.search(r"\((\d+) bytes\)", reply)):
+			raw_size = int(match.group(1))
+			while total_received < raw_size:
+				if (data := writer.receive(reader, offset + total_received, raw_size - total_received)) is None:
+					raise EOFError(f"Connection closed in the middle of range {offset}")
+				current_received = len(data)
+				connection.wire_size += current_received
+				if hasher is not None:
+					hasher.update(data)
+				total_received += current_received
+				segment.advance(current_received)
+		else:
+			while True:
+				if (header := reader.read(4)) is None or (data := reader.read(struct.unpack_from("!I", header)[0])) is None:
+					raise EOFError(f"Connection closed in the middle of range {offset}")
+				if data == b"EOF":
+					break
+				current_received = len(data)
+				if connection.mode == "Z":  # Block flag, then raw or compressed payload
+					connection.wire_size += current_received - 1
+					data = COMPRESSORS[connection.compression][1](data[1:]) if data[0] == BLOCK_COMPRESSED else data[1:]
+					current_received = len(data)
+				else:
+					connection.wire_size += current_received
+				writer.write_at(offset + total_received, data)
+				if hasher is not None:
+					hasher.update(data)
+				total_received += current_received
+				segment.advance(current_received)
+
+		self._recv(reader)
+		return total_received
+
+	def _handle_frames(self, connection: Connection, offset: int, writer: PwriteWriter, segment: Segment,
+					   hasher: Optional[BlockHasher] = None) -> int:
+		"""
+		Receive the protocol 2 data frames answering one RETR range request, until its END or ERROR frame
+
+		:param connection: Data connection the request was sent on
+		:param offset: Starting byte offset
+		:param writer: Writer of the output file
+		:param segment: Segment the range belongs to, advanced as data arrives
+		:param hasher: Hasher of the blocks in the range, None if not verified while streaming
+		:return: Number of bytes received, fewer than requested if server cut the range short, e.g. the file changed
+		"""
+		reader = connection.reader
 		total_received = 0
-		file_buffer = bytearray()
-		# print(f"Begin download chunk {chunk_order}:")
 		while True:
-			current_received, data = self._recv_raw(client_socket)
-			if data == "EOF".encode(ENCODE_FORMAT):
-				# print("Finished\n")
-				break
-			file_buffer.extend(data)
-			total_received += current_received
-			progresses[chunk_order] = int(total_received / chunk_size * 100)
-			self.display_progress(progresses)
-
-		# print(f"Finish download chunk {chunk_order}: {total_received} / {chunk_size} Bytes, {total_received / chunk_size * 100} %")
-		file_data[chunk_order] = file_buffer
-		self._recv(client_socket)
-		self._disconnect(client_socket)
-		return None
+			if (header := reader.read(HEADER.size)) is None:
+				raise EOFError(f"Connection closed in the middle of range {offset}")
+			opcode, flags, size, frame_offset = HEADER.unpack(header)
+			if opcode != OP_DATA:
+				reader.read(size)
+				if opcode in (OP_END, OP_ERROR):  # Range complete, or cut short by an error on server
+					return total_received
+				raise ConnectionError(f"Unexpected frame {opcode} in data of range {offset}")
+			if frame_offset != offset + total_received:
+				raise ConnectionError(f"Data frame at offset {frame_offset}, expected {offset + total_received}")
+
+			if flags:  # Whole payload is needed to check or decompress it
+				if (frame := reader.read(size + (CHECKSUM.size if flags & FLAG_CHECKSUM else 0))) is None:
+					raise EOFError(f"Connection closed in the middle of range {offset}")
+				data = frame[:size]
+				if flags & FLAG_CHECKSUM and checksum(data) != frame[size:]:
+					raise ConnectionError(f"Checksum mismatch of frame at offset {frame_offset}")
+				connection.wire_size += size
+				if flags & FLAG_COMPRESSED:
+					data = COMPRESSORS[connection.compression][1](data)
+				writer.write_at(frame_offset, data)
+				if hasher is not None:
+					hasher.update(data)
+				total_received += len(data)
+				segment.advance(len(data))
+				continue
+
+			# Plain payload goes straight to its place in the file as it arrives
+			frame_received = 0
+			while frame_received < size:
+				if (data := writer.receive(reader, frame_offset + frame_received, size - frame_received)) is None:
+					raise EOFError(f"Connection closed in the middle of range {offset}")
+				current_received = len(data)
+				connection.wire_size += current_received
+				if hasher is not None:
+					hasher.update(data)
+				frame_received += current_received
+				total_received += current_received
+				segment.advance(current_received)
+
+	def _download_segments(self, file_name: str, writer: PwriteWriter, scheduler: SegmentScheduler, state: DownloadState,
+						   verifier: Optional[BlockVerifier], wire_sizes: list, mirrors: list[tuple[str, int]]) -> None:
+		"""
+		Download segments from the scheduler until nothing is left, each on a pooled data connection to the mirror
+		chosen for it, taken from the connection budget, up to PIPELINE_DEPTH range requests are in flight at once.
+		The rest of a segment a mirror fails goes back to the scheduler for another mirror. A range the server cuts short,
+		because the file changed or is gone, stops the download without counting against the mirror
 
-	def _download(self, file_name: str, file_size: int, to_directory: str = RECEIVE_DIRECTORY, rename: Optional[str] = None) -> bool:
+		:param file_name: File name on server
+		:param writer: Writer of the output file
+		:param scheduler: Scheduler of the download
+		:param state: Resume state recording the ranges written
+		:param verifier: Verifier of the blocks received, None if server has no manifest
+		:param wire_sizes: Bytes this connection received on the wire are appended to it
+		:param mirrors: Addresses of the servers holding the file
+		:return: None
 		"""
-		Download file from server
+		while True:
+			with self._budget:
+				if (segment := scheduler.next_segment()) is None:
+					return None
+				if (address := self._mirrors.acquire(mirrors)) is None:  # Every mirror failed
+					scheduler.release(segment)
+					return None
+
+				connection = None
+				try:
+					connection = self._pool.acquire(address)
+					wire_size = connection.wire_size
+					in_flight = deque()
+					while True:
+						while len(in_flight) < PIPELINE_DEPTH and (request := scheduler.next_request(segment)) is not None:
+							self._send(connection.socket, f"RETR {file_name} {request[0]} {request[1]}", connection.protocol)  # Request file from server
+							in_flight.append(request)
+						if not in_flight:
+							break
+
+						offset, size = in_flight.popleft()
+						hasher = verifier.hasher(offset, size) if verifier is not None else None
+						started_at = time.monotonic()
+						try:
+							received = self._handle_chunk(connection, offset, size, writer, segment, hasher)
+						finally:  # Keep what arrived before the connection closed
+							state.add(offset, segment.position)
+							state.save(sync=writer.sync)
+						self._mirrors.record(address, received, time.monotonic() - started_at)
+						if received < size:  # Replies to the other ranges in flight are still coming, drop the connection
+							self._progress.error(file_name, f"{address[0]}:{address[1]}: range {offset} + {size} cut short by server, the file changed or is gone")
+							scheduler.release(segment)
+							self._mirrors.release(address)
+							self._pool.discard(connection)
+							return None
+					scheduler.finish(segment)
+					self._mirrors.release(address)
+					wire_sizes.append(connection.wire_size - wire_size)
+					self._pool.release(connection)  # Back to the pool between segments, so other files can use it
+				except (OSError, EOFError) as error:  # Server closing the connection may just have cut a changed file short
+					self._progress.error(file_name, f"{address[0]}:{address[1]}: {error}")
+					scheduler.release(segment)  # Let other connections pick up the rest
+					self._mirrors.release(address, failed=not isinstance(error, EOFError))
+					if connection is not None:
+						self._pool.discard(connection)
+
+	def _get_file_info(self, connection: Connection, file_name: str) -> Optional[tuple[int, Optional[str]]]:
+		"""
+		Ask server for current size and modification time of a file
 
+		:param connection: Connection to ask on
 		:param file_name: File name on server
-		:param file_size: File size in bytes
-		:param to_directory: Download directory
-		:param rename: Rename downloaded file to this, default to original file name
-		:return: Whether download succeeded
+		:return: Tuple of size and modification time, None if file is unavailable
+		"""
+		self._send(connection.socket, f"SIZE {file_name}", connection.protocol)
+		reply = self._recv(connection.reader, connection.protocol)[1]
+		if not reply.startswith("213"):
+			return None
+		file_size = int(reply.split()[1])
+
+		self._send(connection.socket, f"MDTM {file_name}", connection.protocol)
+		reply = self._recv(connection.reader, connection.protocol)[1]
+		mtime = reply.split()[1] if reply.startswith("213") else None  # Older server, only size is checked
+		return file_size, mtime
+
+	def _request_document(self, connection: Connection, command: str) -> Optional[dict]:
+		"""
+		Send a command answered with 150, a JSON document and 226, such as HASH or SIGN. The server may hash the whole
+		file before answering, so the reply may take up to MANIFEST_TIMEOUT instead of STALL_TIMEOUT
+
+		:param connection: Connection to ask on, discard it if this raises as a late reply would still arrive on it
+		:param command: Command
+		:return: Document, None if server can't provide one
+		"""
+		connection.socket.settimeout(MANIFEST_TIMEOUT)
+		try:
+			self._send(connection.socket, command, connection.protocol)
+			if not self._recv(connection.reader, connection.protocol)[1].startswith("150"):
+				return None
+
+			document = json.loads(self._recv(connection.reader, connection.protocol)[1])
+			self._recv(connection.reader, connection.protocol)
+			return document
+		finally:
+			connection.socket.settimeout(STALL_TIMEOUT)
+
+	def _get_manifest(self, connection: Connection, file_name: str) -> Optional[dict]:
 		"""
-		file_data = [bytearray()] * 4
-		whole, quotient = divmod(file_size, 5)
-		first_3_chunks, last_chunk = divmod(whole + quotient, 3)
-		chunk_sizes = [whole + first_3_chunks] * 3 + [whole + last_chunk]
+		Get block hash manifest of a file from server
 
-		threads = []
-		progresses = [0] * 4
-		for chunk_order, chunk_size in enumerate(chunk_sizes):
-			sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-			sock.connect((SERVER_HOST, SERVER_PORT))
+		:param connection: Connection to ask on
+		:param file_name: File name on server
+		:return: Manifest, None if server can't provide one
+		"""
+		return self._request_document(connection, f"HASH {file_name}")
 
-			offset = sum(chunk_sizes[:chunk_order])
-			thread = threading.Thread(target=self._handle_chunk, args=(sock, file_name, offset, chunk_size, chunk_order, file_data, progresses))
-			threads.append(thread)
-			thread.start()
+	def _get_signature(self, address: tuple[str, int], file_name: str) -> Optional[dict]:
+		"""
+		Get rsync style block signature of a file from server
+
+		:param address: Server address
+		:param file_name: File name on server
+		:return: Signature, None if server can't provide one
+		"""
+		with self._budget:
+			connection = self._pool.acquire(address)
+			try:
+				signature = self._request_document(connection, f"SIGN {file_name}")
+			except OSError:
+				self._pool.discard(connection)
+				raise
+			self._pool.release(connection)
+		return signature
+
+	def _reuse_local_copy(self, file_name: str, file_path: str, file_size: int, mirrors: list[tuple[str, int]]) \
+			-> Optional[tuple[dict, dict[int, int]]]:
+		"""
+		Find which blocks of the server's file an existing local copy already holds
+
+		:param file_name: File name on server
+		:param file_path: Path of the local copy
+		:param file_size: File size on server
+		:param mirrors: Consistent mirrors, the signature is asked to the first one answering
+		:return: Tuple of the signature and the local offset of every block found, None if no mirror has a signature
+		"""
+		for address in mirrors:
+			try:
+				signature = self._get_signature(address, file_name)
+			except TimeoutError:  # Still computing the signature, download the whole file
+				return None
+			except OSError as error:
+				self._mirrors.report(address, failed=True)
+				self._progress.error(file_name, f"Mirror {address[0]}:{address[1]} unavailable: {error}")
+				continue
+			if signature is None or signature["size"] != file_size:
+				return None
+			return signature, find_blocks(file_path, signature)
+		return None
+
+	def _check_mirrors(self, file_name: str, addresses: list[tuple[str, int]]) \
+			-> tuple[list[tuple[str, int]], Optional[tuple[int, Optional[str]]], Optional[dict]]:
+		"""
+		Ask every mirror not dropped for the status and manifest of a file, keep the mirrors agreeing with the first one
+		having it: same size, and same block hashes where both have a manifest
+
+		:param file_name: File name on server
+		:param addresses: Mirror addresses
+		:return: Tuple of the consistent mirrors, size and modification time on the first one having the file
+			(None if no mirror has it), and the first manifest found (None if no mirror has one)
+		"""
+		def fingerprint(manifest: dict) -> tuple:
+			return manifest["algorithm"], manifest["block_size"], manifest["hashes"]
+
+		consistent = []
+		answered = False
+		reference = None  # [file info, manifest] of the first mirror having the file
+		for address in self._mirrors.available(addresses):
+			# Ask on a pooled connection, the control connection is not shared between downloads running at once
+			with self._budget:
+				connection = None
+				try:
+					connection = self._pool.acquire(address)
+					file_info = self._get_file_info(connection, file_name)
+				except OSError as error:
+					if connection is not None:
+						self._pool.discard(connection)
+					self._mirrors.report(address, failed=True)
+					self._progress.error(file_name, f"Mirror {address[0]}:{address[1]} unavailable: {error}")
+					continue
+				try:
+					manifest = self._get_manifest(connection, file_name) if file_info is not None else None
+				except TimeoutError:  # Still hashing a large file, the mirror answered so download without verifying
+					self._pool.discard(connection)
+					manifest = None
+				except OSError as error:
+					self._pool.discard(connection)
+					self._mirrors.report(address, failed=True)
+					self._progress.error(file_name, f"Mirror {address[0]}:{address[1]} unavailable: {error}")
+					continue
+				else:
+					self._pool.release(connection)
+				self._mirrors.report(address, failed=False)
+			answered = True
+
+			if file_info is None:  # Mirror doesn't have the file, or not anymore
+				continue
+			if reference is None:
+				reference = [file_info, manifest]
+			elif file_info[0] != reference[0][0] or \
+					(manifest is not None and reference[1] is not None and fingerprint(manifest) != fingerprint(reference[1])):
+				self._progress.error(file_name, f"Mirror {address[0]}:{address[1]} has a different file, not downloading from it")
+				continue
+			elif reference[1] is None:
+				reference[1] = manifest
+			consistent.append(address)
+
+		if not answered:
+			raise ConnectionError(f"No mirror of {file_name} answered")
+		if reference is None:  # Every mirror answering doesn't have the file
+			return consistent, None, None
+		return consistent, reference[0], reference[1]
+
+	def _target_path(self, file_name: str, to_directory: str, rename: Optional[str] = None) -> str:
+		"""
+		Path a download is saved to, an existing file is updated in delta mode and kept otherwise
 
-		for thread in threads:
-			thread.join()
+		:param file_name: File name on server
+		:param to_directory: Download directory
+		:param rename: Rename downloaded file to this, default to original file name
+		:return: File path
+		"""
 		# Handle duplicate file name
 		name, extension = os.path.splitext(file_name if rename is None else rename)
 
 		file_index = 1
 		file_path = os.path.join(to_directory, f"{name}{extension}",)
-		while os.path.exists(file_path):  # File already exists, create a new numbered name
+		while os.path.exists(file_path) and not self._delta:  # File already exists, create a new numbered name
 			file_path = os.path.join(to_directory, f"{name} ({file_index}){extension}")
 			file_index += 1
-		# Write data to file
-		with open(file_path, "wb") as file:
-			data = "".encode(ENCODE_FORMAT).join(file_data)
-			file.write(data)
+		return file_path
+
+	def _handle_entries(self, connection: Connection, files: dict[str, str], to_directory: str, received_files: list[str]) -> None:
+		"""
+		Receive the entries answering one MGET until the END frame closing its stream, every entry is written to its
+		.part file as its frames arrive and renamed once complete
+
+		:param connection: Data connection the MGET was sent on
+		:param files: Local file name of every file name on server
+		:param to_directory: Download directory
+		:param received_files: Name of every file received completely is appended to it as soon as it is renamed,
+			so the files before an error are known
+		:return: None
+		"""
+		reader = connection.reader
+		while True:
+			if (header := reader.read(HEADER.size)) is None:
+				raise ConnectionError("Connection closed in the middle of an MGET stream")
+			opcode, _, size, _ = HEADER.unpack(header)
+			if (payload := reader.read(size)) is None:
+				raise ConnectionError("Connection closed in the middle of an MGET stream")
+			if opcode in (OP_END, OP_ERROR):  # Every entry sent, or nothing matched
+				return None
+			if opcode != OP_ENTRY:
+				raise ConnectionError(f"Unexpected frame {opcode} in MGET stream")
+
+			entry = json.loads(bytes(payload).decode(ENCODE_FORMAT))
+			file_path = self._target_path(entry["name"], to_directory, files.get(entry["name"]))
+			part_path = f"{file_path}.part"
+			writer = self._writer(part_path, entry["size"])
+			try:
+				received = self._handle_frames(connection, 0, writer, Segment(0, entry["size"]))
+			except BaseException:
+				writer.close()
+				raise
+			if received == entry["size"]:
+				writer.commit(file_path)
+				if entry.get("mtime") is not None:  # Lets the next run tell the copy is up to date without asking
+					os.utime(file_path, ns=(entry["mtime"], entry["mtime"]))
+				received_files.append(entry["name"])
+			else:  # File changed on server during the transfer, downloaded again on its own
+				writer.close()
+				os.remove(part_path)
+
+	@staticmethod
+	def _is_up_to_date(file_path: str, file_size: int, mtime: Optional[int]) -> bool:
+		"""
+		Quick check of a local copy against the server's file, the way rsync skips files by default
+
+		:param file_path: Path of the local copy
+		:param file_size: File size on server
+		:param mtime: Modification time in nanoseconds on server, None if server doesn't list it
+		:return: Whether the local copy has the same size and modification time
+		"""
+		if mtime is None:
+			return False
+		try:
+			file_stat = os.stat(file_path)
+		except OSError:
+			return False
+		return file_stat.st_size == file_size and file_stat.st_mtime_ns == mtime
+
+	def _download_bulk(self, files: dict[str, str], to_directory: str = RECEIVE_DIRECTORY) -> list[str]:
+		"""
+		Download many small files back to back on one data connection with MGET, instead of paying a round trip and
+		fresh segment connections for every file
+
+		:param files: Local file name of every file name on server
+		:param to_directory: Download directory
+		:return: Names of the files downloaded, the others are left to _download
+		"""
+		file_names = list(files)
+		downloaded = []
+		with self._budget:
+			connection = None
+			try:
+				connection = self._pool.acquire(self._address)
+				if connection.protocol == 2:  # Entries need frames, older servers get every file on its own
+					for start in range(0, len(file_names), MGET_BATCH_FILES):
+						batch = file_names[start:start + MGET_BATCH_FILES]
+						self._send(connection.socket, f"MGET {' '.join(batch)}", connection.protocol)
+						self._handle_entries(connection, files, to_directory, downloaded)
+			except (OSError, EOFError) as error:
+				if pending := [file_name for file_name in file_names if file_name not in downloaded]:
+					self._progress.error(pending[0], f"Bulk download stopped, {len(pending)} files left: {error}")
+				if connection is not None:
+					self._pool.discard(connection)
+			else:
+				self._pool.release(connection)
+		return downloaded
+
+	def _download(self, file_name: str, file_size: int, to_directory: str = RECEIVE_DIRECTORY, rename: Optional[str] = None,
+				  mirrors: Optional[list[tuple[str, int]]] = None) -> bool:
+		"""
+		Download file from server into a preallocated .part file, renamed once every segment arrived.
+		Written ranges are recorded next to the .part file, so a later call only downloads what is missing.
+		In delta mode an existing local copy is compared against the rsync style block signature of the server's file,
+		its blocks still matching are copied into the .part file and only the rest is downloaded.
+		With several mirrors, segments are spread over the ones holding the same file, by their measured throughput
+
+		:param file_name: File name on server
+		:param file_size: File size in bytes
+		:param to_directory: Download directory
+		:param rename: Rename downloaded file to this, default to original file name
+		:param mirrors: Addresses of servers holding the file, default to the connected server
+		:return: Whether download succeeded
+		"""
+		file_path = self._target_path(file_name, to_directory, rename)
+		mirrors, file_info, manifest = self._check_mirrors(file_name, mirrors or [self._address])
+		if file_info is None:
+			self._progress.error(file_name, "No mirror has the file")
+			return False
+		file_size, mtime = file_info
+
+		part_path = f"{file_path}.part"
+		state = DownloadState.load(f"{part_path}.state", file_size, mtime)
+		if state.completed and not os.path.exists(part_path):  # Data of the state is gone
+			state = DownloadState(f"{part_path}.state", file_size, mtime)
+		elif state.completed:
+			self._progress.status(file_name, f"Resuming: {state.completed} / {file_size} Bytes on disk")
+
+		reused = None
+		if os.path.isfile(file_path) and not state.completed:  # Delta mode, update the local copy
+			reused = self._reuse_local_copy(file_name, file_path, file_size, mirrors)
+			if reused is not None and os.path.getsize(file_path) == file_size and \
+					all(reused[1].get(index) == index * reused[0]["block_size"] for index in range(len(reused[0]["strong"]))):
+				self._progress.status(file_name, "Up to date")
+				return True
+
+		writer = self._writer(part_path, file_size)
+		if reused is not None:  # Assemble the blocks already on disk, only the others are downloaded
+			for start, end in copy_blocks(file_path, *reused, writer.write_at):
+				state.add(start, end)
+			self._progress.status(file_name, f"Updating: {state.completed} / {file_size} Bytes reused from the local copy")
+		verifier = BlockVerifier(manifest, part_path) if manifest is not None and manifest["size"] == file_size else None
+		wire_sizes = []
+		try:
+			ranges = state.missing()
+			for _ in range(VERIFY_RETRIES + 1):
+				scheduler = SegmentScheduler(ranges, alignment=verifier.block_size if verifier is not None else 1)
+				self._progress.track(file_name, scheduler, file_size - scheduler.total_size, file_size)
+				threads = []
+				for _ in range(scheduler.connections):
+					thread = threading.Thread(target=self._download_segments, args=(file_name, writer, scheduler, state, verifier, wire_sizes, mirrors))
+					threads.append(thread)
+					thread.start()
+
+				for thread in threads:
+					thread.join()
+
+				if not scheduler.done:  # Keep the .part file to resume, some segments are incomplete
+					state.save(force=True, sync=writer.sync)
+					writer.close()
+					return False
+				if verifier is None or not (failed := verifier.finish()):
+					break
+
+				self._progress.error(file_name, f"{len(failed)} blocks failed verification, downloading them again")
+				verifier.retry(failed)
+				ranges = [verifier.block_range(index) for index in failed]
+			else:
+				writer.close()
+				return False
+		finally:
+			if verifier is not None:
+				verifier.close()
+
+		writer.commit(file_path)
+		state.remove()
+		if self._compression is not None and file_size:
+			self._progress.status(file_name, f"Compression ratio: {sum(wire_sizes) / file_size:.3f}")
 		return True
 
-	def _disconnect(self, client_socket: socket.socket) -> None:
+	def _disconnect(self, client_socket: socket.socket, protocol: int = 1, reader: Optional[ReceiveBuffer] = None) -> None:
 		"""
 		Disconnect from server
 
 		:param client_socket: Client socket
+		:param protocol: Protocol version of the connection
+		:param reader: Receive buffer of a data connection
 		:return: None
 		"""
-		self._send(client_socket, "QUIT")  # Send QUIT to notify server that client is disconnecting
-		self._recv(client_socket)
+		self._send(client_socket, "QUIT", protocol)  # Send QUIT to notify server that client is disconnecting
+		self._recv(reader or client_socket, protocol)
 		client_socket.close()
 		return None
 
-	def run(self, host: str, port: int) -> None:
+	@staticmethod
+	def _report_download(file_name: str, succeeded: bool) -> None:
+		if succeeded:
+			print(f"Download completed: {file_name}")
+		else:
+			print(f"Download failed: {file_name}")
+		return None
+
+	def run(self, host: str, port: int, priority: Optional[Callable[[str, int], Any]] = None,
+			on_complete: Optional[Callable[[str, bool], None]] = None, to_directory: str = RECEIVE_DIRECTORY,
+			mirrors: Optional[list[tuple[str, int]]] = None, prefix: Optional[str] = None, pattern: Optional[str] = None) -> None:
+		"""
+		Download every permitted file, several at once sharing MAX_CONNECTIONS data connections.
+		Files up to BULK_FILE_SIZE are streamed together with MGET first
+
+		:param host: Server host
+		:param port: Server port
+		:param priority: Sort key of a file given its name and size, default to smallest files first
+		:param on_complete: Called with file name and whether it succeeded as soon as a file finishes,
+			default to printing the result
+		:param to_directory: Download directory
+		:param mirrors: Addresses of other servers with the same files, downloads are spread over all of them
+		:param prefix: Only download files whose name starts with it
+		:param pattern: Only download files whose name matches this glob pattern
+		:return: None
+		"""
 		if not self._connect(self._socket, (host, port)):
 			print(f"Couldn't connect to server: IP {host} on port {port}")
 			return None
 
-		self._get_permitted_files()
-
+		self._address = (host, port)
+		self._protocol, _ = self._negotiate(self._socket)
+		self._get_permitted_files(prefix, pattern)
+
+		def download(file_name: str, file_size: int) -> bool:
+			succeeded = False
+			try:
+				succeeded = self._download(file_name, file_size, to_directory, f"RECV_{file_name}", [self._address, *(mirrors or [])])
+			finally:
+				self._progress.complete(file_name, succeeded)
+			return succeeded
+
+		on_complete = on_complete or self._report_download
+		# Small files are streamed together first, file names with spaces don't fit in a command line.
+		# In delta mode a small file whose local copy has its size and modification time is up to date
+		bulk = {}
+		up_to_date = set()
 		for file_name, file_size in self._permitted_files.items():
-			if self._download(file_name, file_size, rename=f"RECV_{file_name}"):
-				print(f"Download completed: {file_name}")
+			if file_size > BULK_FILE_SIZE or any(character.isspace() for character in file_name):
+				continue
+			if self._delta and self._is_up_to_date(self._target_path(file_name, to_directory, f"RECV_{file_name}"),
+												   file_size, self._file_mtimes.get(file_name)):
+				up_to_date.add(file_name)
+				self._progress.status(file_name, "Up to date")
 			else:
-				print(f"Download failed: {file_name}")
+				bulk[file_name] = f"RECV_{file_name}"
+		downloaded = set(self._download_bulk(bulk, to_directory)) if len(bulk) > 1 else set()
+		downloaded |= up_to_date
+		for file_name in downloaded:
+			self._progress.complete(file_name, True)
+			on_complete(file_name, True)
+
+		queue = DownloadQueue(download, priority=priority, on_complete=on_complete, on_error=self._progress.error)
+		for file_name, file_size in self._permitted_files.items():
+			if file_name not in downloaded:
+				queue.put(file_name, file_size)
+		self._progress.start()
+		try:
+			queue.run()
+		finally:
+			self._progress.stop()
 
-		self._disconnect(self._socket)
+		self._pool.close()
+		self._disconnect(self._socket, self._protocol)
 		return None
 
 
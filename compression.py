@@ -0,0 +1,27 @@
+import zlib
+from typing import Callable
+
+COMPRESSORS: dict[str, tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]] = {
+	"zlib": (lambda data: zlib.compress(data, 6), zlib.decompress),
+}
+"""
+dict = {
+	algorithm name: (compress, decompress)
+}
+"""
+
+# lzma and bz2 are optional parts of the standard library, offer them only where Python was built with them
+try:
+	import lzma
+	COMPRESSORS["lzma"] = (lzma.compress, lzma.decompress)
+except ImportError:
+	pass
+
+try:
+	import bz2
+	COMPRESSORS["bz2"] = (bz2.compress, bz2.decompress)
+except ImportError:
+	pass
+
+BLOCK_RAW = 0  # Block payload is stored as is
+BLOCK_COMPRESSED = 1  # Block payload is compressed with the negotiated algorithm
@@ -5,6 +5,7 @@ SERVER_HOST = socket.gethostbyname(socket.gethostname())
 SERVER_PORT = 21
 
 BUFFER_SIZE = 4096
+RECEIVE_BUFFER_SIZE = 2 ** 16  # Fixed buffer each download thread receives into before writing to disk
 ENCODE_FORMAT = "utf-8"
 
 DATA_DIRECTORY = os.path.join("..", "data")
@@ -13,3 +14,60 @@ RECEIVE_DIRECTORY = os.path.join("..", "download")
 FILE_SIZE_UNITS = units = {
 	"B": 1, "KB": 2 ** 10, "MB": 2 ** 20, "GB": 2 ** 30, "TB": 2 ** 40,
 }
+
+SEND_QUANTUM = 2 ** 16  # Bytes a transfer may push per writable event before yielding to other connections
+
+SERVER_WORKERS = 1  # Worker processes sharing the listening port, 1 to serve from a single process
+WORKER_SHUTDOWN_TIMEOUT = 10  # Seconds a worker may spend finishing its transfers before being killed
+
+MIN_SEGMENT_SIZE = 2 ** 20  # Segments are never split below this size
+MAX_SEGMENT_CONNECTIONS = 8  # Connections opened for a single file
+REQUEST_SIZE = 4 * 2 ** 20  # Bytes requested per RETR, a split segment stops at the next request boundary
+PIPELINE_DEPTH = 2  # RETR requests a data connection sends ahead without waiting for the previous 226
+STATE_SAVE_INTERVAL = 1  # Seconds between saves of a download's resume state
+
+HASH_BLOCK_SIZE = 4 * 2 ** 20  # Bytes covered by one hash of a file's block hash manifest
+MANIFEST_DIRECTORY = os.path.join("..", "manifest")  # Server cache of computed block hash manifests
+SERVER_THREADS = 2  # Threads the server runs slow jobs such as hashing in, outside its event loop
+DELTA_BLOCK_SIZE = 2 ** 16  # Bytes covered by one entry of a file's rsync style block signature
+DELTA_SEARCH_LIMIT = 2 ** 20  # Bytes the client rolls its checksum over without a match before checking whole blocks only
+DELTA_DOWNLOAD = True  # Update an existing local copy by downloading only the blocks that changed, instead of saving a numbered duplicate
+VERIFY_RETRIES = 3  # Times a client downloads blocks failing verification again before giving up
+CATALOG_REFRESH_INTERVAL = 2  # Seconds between checks of permitted files for changes
+LIST_PAGE_SIZE = 10000  # Entries a client asks per LIST page, the most a server sends in one page
+LIST_FRAME_ENTRIES = 1000  # Entries per message of a LIST page
+LIST_PRINT_LIMIT = 50  # Permitted files a client prints one by one, larger catalogs are only counted
+
+COMPRESSION = None  # Algorithm the client asks compressed transfers with ("zlib", "lzma" or "bz2"), None for raw transfers
+COMPRESSION_SAMPLE_BLOCKS = 4  # Blocks compressed before deciding whether the rest of a transfer is worth compressing
+COMPRESSION_THRESHOLD = 0.9  # Sampled compressed / raw size above which a transfer falls back to raw blocks
+
+GLOBAL_RATE_LIMIT = None  # Bytes per second the server sends in total, None for unlimited
+CLIENT_RATE_LIMIT = None  # Bytes per second sent to one client IP over all its connections, None for unlimited
+FILE_RATE_LIMIT = None  # Bytes per second sent of one file over all transfers, None for unlimited
+RATE_LIMIT_BURST = 0.25  # Seconds of rate a limit lets through at once after being idle
+
+MAX_CONNECTIONS = 8  # Data connections a client keeps open at once over every file it downloads
+MAX_CONCURRENT_FILES = 4  # Files a client downloads at the same time
+BULK_FILE_SIZE = 2 ** 20  # Files up to this size are streamed together with MGET instead of downloaded one by one, 0 to disable
+MGET_BATCH_FILES = 1000  # File names a client asks per MGET command
+
+METRICS_DIRECTORY = os.path.join("..", "metrics")  # Server dumps its metrics here in Prometheus text format
+METRICS_DUMP_INTERVAL = 10  # Seconds between metrics dumps
+
+PROGRESS_INTERVAL = 0.2  # Seconds between progress samples of the client
+PROGRESS_SMOOTHING = 0.3  # Weight of the latest sample in the smoothed download rate
+
+PROTOCOL_CHECKSUM = False  # Ask servers speaking protocol 2 for a checksum on every data frame
+
+WRITER = "pwrite"  # Backend writing downloaded data, "pwrite" for write calls at each offset or "mmap" for a mapped file
+
+BLOCK_CACHE_SIZE = 256 * 2 ** 20  # Bytes of file blocks the server keeps in memory for transfers not using sendfile, 0 to disable
+CACHE_BLOCK_SIZE = 2 ** 20  # Bytes per cached block, read from disk at once
+READ_AHEAD_BLOCKS = 2  # Blocks after the one a transfer is sending that are read into the cache ahead of it
+
+STALL_TIMEOUT = 10  # Seconds a data connection may receive nothing before its server is considered stalled
+MANIFEST_TIMEOUT = 300  # Seconds a client waits for a manifest or signature, which the server may first have to compute
+MIRROR_MAX_FAILURES = 2  # Failures in a row after which a mirror gets no more segments of a download
+MIRROR_RETRY_DELAY = 30  # Seconds after its last failure a dropped mirror is tried again
+MIRROR_RATE_SMOOTHING = 0.3  # Weight of the latest request in a mirror's smoothed per-connection throughput
@@ -0,0 +1,104 @@
+import os
+import mmap
+import zlib
+import hashlib
+from typing import Callable
+
+from constants import DELTA_SEARCH_LIMIT
+
+ADLER_MODULUS = 65521  # Modulus of the Adler-32 sums
+
+
+def find_blocks(file_path: str, signature: dict) -> dict[int, int]:
+	"""
+	Find blocks of the server's file anywhere in a local file, the way rsync does: an Adler-32 weak checksum rolls over
+	the local file one byte at a time, a strong hash confirms every weak match, and a match jumps a whole block ahead.
+	After DELTA_SEARCH_LIMIT bytes rolled without a match the search only checks every block_size bytes until it
+	matches again, so a local file unrelated to the server's one costs about as much as hashing it.
+	The last block, shorter than block_size, is only looked for at its own offset and at the end of the local file
+
+	:param file_path: Path of the local copy
+	:param signature: Block signature sent by server
+	:return: dict = {block index: offset of the same bytes in the local file}
+	"""
+	block_size = signature["block_size"]
+	file_size = signature["size"]
+	algorithm = signature["algorithm"]
+	strong = signature["strong"]
+	full_blocks = file_size // block_size
+
+	weak_index = {}  # Weak checksum: indexes of the full blocks having it
+	for index in range(full_blocks):
+		weak_index.setdefault(signature["weak"][index], []).append(index)
+
+	found = {}
+	with open(file_path, "rb") as file:
+		local_size = os.fstat(file.fileno()).st_size
+		if not local_size:  # Empty files can't be mapped
+			return found
+
+		with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+			if tail := file_size - full_blocks * block_size:
+				for offset in (full_blocks * block_size, local_size - tail):
+					if 0 <= offset <= local_size - tail and \
+							hashlib.new(algorithm, data[offset:offset + tail]).hexdigest() == strong[full_blocks]:
+						found[full_blocks] = offset
+						break
+
+			last = local_size - block_size  # Last offset a whole block starts at
+			if not weak_index or last < 0:
+				return found
+
+			position = 0
+			checksum = zlib.adler32(data[:block_size])
+			low, high = checksum & 0xffff, checksum >> 16
+			budget = DELTA_SEARCH_LIMIT
+			while True:
+				matched = False
+				if (indexes := weak_index.get(high << 16 | low)) is not None:
+					digest = hashlib.new(algorithm, data[position:position + block_size]).hexdigest()
+					for index in indexes:
+						if strong[index] == digest:
+							found.setdefault(index, position)
+							matched = True
+
+				if matched or budget <= 0:  # Jump to the next block, its checksum is computed from scratch
+					if matched:
+						budget = DELTA_SEARCH_LIMIT
+					position += block_size
+					if position > last:
+						break
+					checksum = zlib.adler32(data[position:position + block_size])
+					low, high = checksum & 0xffff, checksum >> 16
+				else:  # Roll the checksum one byte forward
+					if position == last:
+						break
+					removed, added = data[position], data[position + block_size]
+					low = (low - removed + added) % ADLER_MODULUS
+					high = (high - block_size * removed + low - 1) % ADLER_MODULUS
+					position += 1
+					budget -= 1
+	return found
+
+
+def copy_blocks(file_path: str, signature: dict, found: dict[int, int],
+				write_at: Callable[[int, bytes], None]) -> list[tuple[int, int]]:
+	"""
+	Copy the blocks found in a local file to their offset in the new file
+
+	:param file_path: Path of the local copy
+	:param signature: Block signature sent by server
+	:param found: Local offset of every block found, from find_blocks
+	:param write_at: Called with the offset in the new file and the bytes of a block, e.g. a writer's write_at
+	:return: List of (start, end) byte ranges of the new file written
+	"""
+	block_size = signature["block_size"]
+	copied = []
+	with open(file_path, "rb") as file:
+		for index, offset in sorted(found.items()):
+			start = index * block_size
+			end = min(signature["size"], start + block_size)
+			file.seek(offset)
+			write_at(start, file.read(end - start))
+			copied.append((start, end))
+	return copied
@@ -0,0 +1,81 @@
+import heapq
+import threading
+from typing import Any, Callable, Optional
+
+from constants import MAX_CONCURRENT_FILES
+
+
+class DownloadQueue:
+	def __init__(self,
+				 download: Callable[[str, int], bool],
+				 max_files: int = MAX_CONCURRENT_FILES,
+				 priority: Optional[Callable[[str, int], Any]] = None,
+				 on_complete: Optional[Callable[[str, bool], None]] = None,
+				 on_error: Optional[Callable[[str, str], None]] = None):
+		"""
+		Download several files at once, the ones with the lowest priority key first
+
+		:param download: Download a file given its name and size, return whether it succeeded
+		:param max_files: Maximum files downloaded at the same time
+		:param priority: Sort key of a file given its name and size, default to smallest files first
+		:param on_complete: Called with file name and whether it succeeded as soon as a file finishes
+		:param on_error: Called with file name and message when a download raises, default to printing it
+		"""
+		self._download = download
+		self._max_files = max_files
+		self._priority = priority if priority is not None else lambda file_name, file_size: file_size
+		self._on_complete = on_complete
+		self._on_error = on_error if on_error is not None else lambda file_name, message: print(f"{file_name}: {message}")
+
+		self._lock = threading.Lock()
+		self._heap = []  # Heap of (priority key, sequence, file name, file size)
+		self._sequence = 0
+		self.results = {}
+		"""
+		dict = {
+			file name: whether download succeeded
+		}
+		"""
+
+	def put(self, file_name: str, file_size: int) -> None:
+		with self._lock:
+			heapq.heappush(self._heap, (self._priority(file_name, file_size), self._sequence, file_name, file_size))
+			self._sequence += 1
+		return None
+
+	def _take(self) -> Optional[tuple[str, int]]:
+		with self._lock:
+			if not self._heap:
+				return None
+			_, _, file_name, file_size = heapq.heappop(self._heap)
+			return file_name, file_size
+
+	def _work(self) -> None:
+		while (item := self._take()) is not None:
+			file_name, file_size = item
+			try:
+				succeeded = self._download(file_name, file_size)
+			except Exception as error:  # Keep the worker alive for the rest of the queue, e.g. on a bad reply from server
+				self._on_error(file_name, f"Download stopped: {error}")
+				succeeded = False
+
+			with self._lock:
+				self.results[file_name] = succeeded
+			if self._on_complete is not None:
+				self._on_complete(file_name, succeeded)
+		return None
+
+	def run(self) -> dict[str, bool]:
+		"""
+		Download every queued file, return once all of them finished
+
+		:return: Dict of file name to whether its download succeeded
+		"""
+		with self._lock:
+			workers = max(1, min(self._max_files, len(self._heap)))
+		threads = [threading.Thread(target=self._work) for _ in range(workers)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		return self.results
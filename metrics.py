@@ -0,0 +1,202 @@
+import os
+import math
+from typing import Callable, Optional
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+THROUGHPUT_BUCKETS = tuple(2 ** power for power in range(16, 35, 2))  # 64KB/s to 16GB/s
+
+
+def _escape(value) -> str:
+	return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: tuple[tuple[str, str], ...], extra: Optional[tuple[str, str]] = None) -> str:
+	pairs = [*labels, extra] if extra is not None else labels
+	if not pairs:
+		return ""
+	return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+	if math.isinf(value):
+		return "+Inf" if value > 0 else "-Inf"
+	return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+	type = "counter"
+
+	def __init__(self, name: str, description: str):
+		"""
+		Value that only goes up, one per set of labels
+
+		:param name: Metric name
+		:param description: Help text
+		"""
+		self.name = name
+		self.description = description
+		self._values = {}
+		"""
+		dict = {
+			((label, value), ...): counted value
+		}
+		"""
+
+	def inc(self, amount: float = 1, **labels) -> None:
+		key = tuple(sorted(labels.items()))
+		self._values[key] = self._values.get(key, 0) + amount
+		return None
+
+	def snapshot(self) -> list[dict]:
+		return [{"labels": dict(key), "value": value} for key, value in self._values.items()]
+
+	def render(self) -> list[str]:
+		return [f"{self.name}{_format_labels(key)} {_format_value(value)}" for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+	type = "gauge"
+
+	def __init__(self, name: str, description: str):
+		"""
+		Value that goes up and down, or is read from a function when collected
+
+		:param name: Metric name
+		:param description: Help text
+		"""
+		super().__init__(name, description)
+		self._function = None
+
+	def set(self, value: float, **labels) -> None:
+		self._values[tuple(sorted(labels.items()))] = value
+		return None
+
+	def set_function(self, function: Callable[[], float]) -> None:
+		self._function = function
+		return None
+
+	def snapshot(self) -> list[dict]:
+		if self._function is not None:
+			self.set(self._function())
+		return super().snapshot()
+
+	def render(self) -> list[str]:
+		if self._function is not None:
+			self.set(self._function())
+		return super().render()
+
+
+class Histogram:
+	type = "histogram"
+
+	def __init__(self, name: str, description: str, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+		"""
+		Distribution of observed values counted in buckets, one per set of labels
+
+		:param name: Metric name
+		:param description: Help text
+		:param buckets: Sorted upper bounds of the buckets
+		"""
+		self.name = name
+		self.description = description
+		self.buckets = buckets
+		self._values = {}
+		"""
+		dict = {
+			((label, value), ...): [count per bucket, sum, count]
+		}
+		"""
+
+	def observe(self, value: float, **labels) -> None:
+		key = tuple(sorted(labels.items()))
+		if (entry := self._values.get(key)) is None:
+			entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+		for index, bound in enumerate(self.buckets):
+			if value <= bound:
+				entry[0][index] += 1
+				break
+		entry[1] += value
+		entry[2] += 1
+		return None
+
+	def snapshot(self) -> list[dict]:
+		return [{"labels": dict(key), "buckets": dict(zip(self.buckets, counts)), "sum": total, "count": count}
+				for key, (counts, total, count) in self._values.items()]
+
+	def render(self) -> list[str]:
+		lines = []
+		for key, (counts, total, count) in self._values.items():
+			cumulative = 0
+			for bound, bucket_count in zip(self.buckets, counts):
+				cumulative += bucket_count
+				lines.append(f"{self.name}_bucket{_format_labels(key, ('le', _format_value(bound)))} {cumulative}")
+			lines.append(f"{self.name}_bucket{_format_labels(key, ('le', '+Inf'))} {count}")
+			lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(total)}")
+			lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+		return lines
+
+
+class MetricsRegistry:
+	def __init__(self):
+		"""
+		In-process metrics, updated from a single thread such as the server event loop
+		"""
+		self._metrics = {}
+		"""
+		dict = {
+			metric name: Counter, Gauge or Histogram
+		}
+		"""
+
+	def _register(self, metric):
+		if metric.name in self._metrics:
+			raise ValueError(f"Metric {metric.name} is already registered")
+		self._metrics[metric.name] = metric
+		return metric
+
+	def counter(self, name: str, description: str) -> Counter:
+		return self._register(Counter(name, description))
+
+	def gauge(self, name: str, description: str) -> Gauge:
+		return self._register(Gauge(name, description))
+
+	def histogram(self, name: str, description: str, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+		return self._register(Histogram(name, description, buckets))
+
+	def snapshot(self) -> dict:
+		"""
+		Current value of every metric
+
+		:return: Dict of metric name to its type, help text and values per set of labels
+		"""
+		return {name: {"type": metric.type, "help": metric.description, "values": metric.snapshot()}
+				for name, metric in self._metrics.items()}
+
+	def to_prometheus(self) -> str:
+		"""
+		Render every metric in Prometheus text exposition format
+
+		:return: Text
+		"""
+		lines = []
+		for name, metric in self._metrics.items():
+			lines.append(f"# HELP {name} {metric.description}")
+			lines.append(f"# TYPE {name} {metric.type}")
+			lines.extend(metric.render())
+		return "\n".join(lines) + "\n"
+
+	@staticmethod
+	def write(path: str, text: str) -> None:
+		"""
+		Replace a file atomically, so a scraper never reads half of it
+
+		:param path: File path
+		:param text: Content
+		:return: None
+		"""
+		os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+		temp_path = f"{path}.tmp"
+		with open(temp_path, "w") as file:
+			file.write(text)
+		os.replace(temp_path, path)
+		return None
@@ -0,0 +1,115 @@
+import math
+import time
+import threading
+from typing import Optional
+
+from constants import MIRROR_MAX_FAILURES, MIRROR_RETRY_DELAY, MIRROR_RATE_SMOOTHING
+
+
+class MirrorSet:
+	def __init__(self, max_failures: int = MIRROR_MAX_FAILURES, retry_delay: float = MIRROR_RETRY_DELAY):
+		"""
+		Health and throughput of the servers a client downloads from, shared by every download so a mirror that
+		keeps failing, e.g. stalling past STALL_TIMEOUT, gets no more segments of any file until retry_delay passed
+
+		:param max_failures: Failures in a row after which a mirror is dropped
+		:param retry_delay: Seconds after its last failure a dropped mirror is tried again
+		"""
+		self._lock = threading.Lock()
+		self._max_failures = max_failures
+		self._retry_delay = retry_delay
+		self._mirrors = {}
+		"""
+		dict = {
+			server address: {
+				"rate": smoothed bytes per second of one connection, None until measured,
+				"active": segments being downloaded from it,
+				"failures": failures in a row,
+				"failed_at": monotonic time of the last failure, None if it never failed
+			}
+		}
+		"""
+
+	def _get(self, address: tuple[str, int]) -> dict:
+		return self._mirrors.setdefault(address, {"rate": None, "active": 0, "failures": 0, "failed_at": None})
+
+	def _usable(self, address: tuple[str, int]) -> bool:
+		mirror = self._get(address)
+		return mirror["failures"] < self._max_failures or time.monotonic() - mirror["failed_at"] >= self._retry_delay
+
+	def available(self, addresses: list[tuple[str, int]]) -> list[tuple[str, int]]:
+		"""
+		Mirrors not dropped, or dropped long enough ago to be tried again
+
+		:param addresses: Server addresses
+		:return: The addresses usable, in the same order
+		"""
+		with self._lock:
+			return [address for address in addresses if self._usable(address)]
+
+	def acquire(self, addresses: list[tuple[str, int]]) -> Optional[tuple[str, int]]:
+		"""
+		Choose the mirror of the next segment: mirrors that just failed last, unmeasured mirrors first so every mirror
+		gets measured, then the one with the highest throughput per connection, which adding a connection is expected
+		to help most
+
+		:param addresses: Servers holding the file
+		:return: Server address, None if every mirror is dropped
+		"""
+		def score(address: tuple[str, int]) -> tuple[int, float, int]:
+			mirror = self._mirrors[address]
+			return -mirror["failures"], (mirror["rate"] if mirror["rate"] is not None else math.inf), -mirror["active"]
+
+		with self._lock:
+			candidates = [address for address in addresses if self._usable(address)]
+			if not candidates:
+				return None
+			address = max(candidates, key=score)
+			self._mirrors[address]["active"] += 1
+			return address
+
+	def record(self, address: tuple[str, int], size: int, elapsed: float) -> None:
+		"""
+		Add a measurement of one request
+
+		:param address: Server address
+		:param size: Bytes received
+		:param elapsed: Seconds it took
+		:return: None
+		"""
+		if elapsed <= 0:
+			return None
+		with self._lock:
+			mirror = self._get(address)
+			rate = size / elapsed
+			mirror["rate"] = rate if mirror["rate"] is None else \
+				MIRROR_RATE_SMOOTHING * rate + (1 - MIRROR_RATE_SMOOTHING) * mirror["rate"]
+		return None
+
+	def release(self, address: tuple[str, int], failed: bool = False) -> None:
+		"""
+		End a segment taken with acquire
+
+		:param address: Server address
+		:param failed: Whether the mirror failed the segment
+		:return: None
+		"""
+		with self._lock:
+			self._mirrors[address]["active"] -= 1
+		return self.report(address, failed)
+
+	def report(self, address: tuple[str, int], failed: bool) -> None:
+		"""
+		Record whether a mirror answered a request. Only transport errors are failures, e.g. connection refused,
+		reset or timed out, a mirror answering that a file is missing or changed answered
+
+		:param address: Server address
+		:param failed: Whether it failed
+		:return: None
+		"""
+		with self._lock:
+			mirror = self._get(address)
+			mirror["failures"] = mirror["failures"] + 1 if failed else 0
+			if failed:
+				mirror["failed_at"] = time.monotonic()
+		return None
@@ -0,0 +1,135 @@
+import select
+import socket
+import threading
+from typing import Callable, Optional
+
+from constants import MAX_CONNECTIONS
+from buffers import ReceiveBuffer
+
+
+class Connection:
+	def __init__(self,
+				 sock: socket.socket,
+				 address: tuple[str, int],
+				 mode: str,
+				 compression: Optional[str] = None,
+				 protocol: int = 1,
+				 checksum: bool = False):
+		"""
+		Data connection to a server, kept open between segments and files
+
+		:param sock: Connected socket
+		:param address: Server address
+		:param mode: Transfer mode server accepted, "S" for framed stream, "R" for raw or "Z" for compressed blocks
+		:param compression: Compression algorithm of mode "Z"
+		:param protocol: Protocol version server accepted
+		:param checksum: Whether protocol 2 data frames carry a checksum
+		"""
+		self.socket = sock
+		self.reader = ReceiveBuffer(sock)  # Every reply on this connection is received through it
+		self.address = address
+		self.mode = mode
+		self.compression = compression
+		self.protocol = protocol
+		self.checksum = checksum
+		self.wire_size = 0  # Bytes of file data received on the wire, before decompression
+
+
+class ConnectionPool:
+	def __init__(self,
+				 open_connection: Callable[[tuple[str, int]], Connection],
+				 close_connection: Callable[[Connection], None],
+				 max_idle: int = MAX_CONNECTIONS):
+		"""
+		Keep idle data connections per server address for reuse
+
+		:param open_connection: Open and set up a new connection to an address
+		:param close_connection: Say goodbye to server and close a connection
+		:param max_idle: Maximum idle connections kept per address
+		"""
+		self._open_connection = open_connection
+		self._close_connection = close_connection
+		self._max_idle = max_idle
+
+		self._lock = threading.Lock()
+		self._idle = {}
+		"""
+		dict = {
+			server address: [idle Connection]
+		}
+		"""
+
+	@staticmethod
+	def _is_alive(connection: Connection) -> bool:
+		"""
+		An idle connection must not be readable, otherwise server closed it or sent something unexpected
+
+		:param connection: Idle connection
+		:return: Whether connection can be reused
+		"""
+		if connection.reader.buffered:
+			return False
+		try:
+			readable, _, _ = select.select([connection.socket], [], [], 0)
+		except (OSError, ValueError):
+			return False
+		return not readable
+
+	def acquire(self, address: tuple[str, int]) -> Connection:
+		"""
+		Take an idle connection to address, open a new one if there is none
+
+		:param address: Server address
+		:return: Connection
+		"""
+		while True:
+			with self._lock:
+				idle = self._idle.get(address)
+				connection = idle.pop() if idle else None
+			if connection is None:
+				return self._open_connection(address)
+			if self._is_alive(connection):
+				return connection
+			connection.socket.close()
+
+	def release(self, connection: Connection) -> None:
+		"""
+		Return a healthy connection to the pool
+
+		:param connection: Connection with no request in flight
+		:return: None
+		"""
+		with self._lock:
+			idle = self._idle.setdefault(connection.address, [])
+			if len(idle) < self._max_idle:
+				idle.append(connection)
+				return None
+		self._close_connection(connection)
+		return None
+
+	@staticmethod
+	def discard(connection: Connection) -> None:
+		"""
+		Drop a connection in an unknown state
+
+		:param connection: Connection
+		:return: None
+		"""
+		connection.socket.close()
+		return None
+
+	def close(self) -> None:
+		"""
+		Close every idle connection
+
+		:return: None
+		"""
+		with self._lock:
+			connections = [connection for idle in self._idle.values() for connection in idle]
+			self._idle.clear()
+		for connection in connections:
+			try:
+				self._close_connection(connection)
+			except OSError:
+				connection.socket.close()
+		return None
@@ -0,0 +1,222 @@
+import sys
+import json
+import time
+import queue
+import threading
+from typing import Callable, Optional, TextIO
+
+from constants import PROGRESS_INTERVAL, PROGRESS_SMOOTHING
+from scheduler import SegmentScheduler
+
+
+class TerminalSink:
+	def __init__(self, stream: TextIO = sys.stdout):
+		"""
+		Redraw one status line with every download in progress
+
+		:param stream: Terminal stream
+		"""
+		self._stream = stream
+		self._lines = {}
+		"""
+		dict = {
+			file name: status text
+		}
+		"""
+
+	def handle(self, event: dict) -> None:
+		if event["type"] == "progress":
+			eta = f"{event['eta']:.0f}s" if event["eta"] is not None else "--"
+			self._lines[event["file"]] = (f"{event['file']} {event['received'] / (event['total'] or 1) * 100:.1f}% "
+										 f"{event['rate'] / 2 ** 20:.1f} MB/s ETA {eta} ({len(event['segments'])} connections)")
+		elif event["type"] == "complete":
+			self._lines.pop(event["file"], None)
+		elif event["type"] in ("error", "status"):
+			self._stream.write(f"\n{event['file']}: {event['message']}\n")
+		elif event["type"] == "sample" and self._lines:
+			self._stream.write("\r\033[K" + " | ".join(self._lines.values()))
+			self._stream.flush()
+		return None
+
+	def close(self) -> None:
+		self._stream.write("\n")
+		self._stream.flush()
+		return None
+
+
+class CallbackSink:
+	def __init__(self, callback: Callable[[dict], None]):
+		"""
+		Hand every event to a function, e.g. to show progress in an application embedding Client
+
+		:param callback: Called with each event, from the aggregator thread
+		"""
+		self._callback = callback
+
+	def handle(self, event: dict) -> None:
+		self._callback(event)
+		return None
+
+	def close(self) -> None:
+		return None
+
+
+class JsonLinesSink:
+	def __init__(self, path: str):
+		"""
+		Append every event to a file, one JSON object per line
+
+		:param path: Log file path
+		"""
+		self._path = path
+		self._file = None
+
+	def handle(self, event: dict) -> None:
+		if event["type"] == "sample":
+			return None
+		if self._file is None:
+			self._file = open(self._path, "a")
+		self._file.write(json.dumps(event) + "\n")
+		return None
+
+	def close(self) -> None:
+		if self._file is not None:
+			self._file.close()
+			self._file = None
+		return None
+
+
+class ProgressMonitor:
+	def __init__(self,
+				 sinks: list,
+				 interval: float = PROGRESS_INTERVAL):
+		"""
+		Sample download progress at a fixed rate and publish events to sinks.
+		Transfer threads only advance their segments, which the aggregator thread reads without locking,
+		completions and errors are queued. Sinks are only called from the aggregator thread
+
+		Events are dicts with a "type" and "time":
+			"progress": file, received, total bytes, rate in bytes per second, eta in seconds or None,
+				segments as [start, position, end]
+			"complete": file, succeeded
+			"error": file, message
+			"status": file, message, e.g. how much of a local copy a delta download reuses
+			"sample": end of one round of progress events
+
+		:param sinks: Objects with handle(event) and close()
+		:param interval: Seconds between samples
+		"""
+		self._sinks = sinks
+		self._interval = interval
+		self._events = queue.SimpleQueue()
+		self._stopped = threading.Event()
+		self._thread = None
+
+		self._downloads = {}
+		"""
+		dict = {
+			file name: [SegmentScheduler, bytes received before it, file size, last received sample, last sample time, smoothed rate]
+		}
+		"""
+
+	def track(self, file_name: str, scheduler: SegmentScheduler, received: int = 0, total: Optional[int] = None) -> None:
+		"""
+		Report progress of a scheduler, replacing the one tracked before for the same file
+
+		:param file_name: File name
+		:param scheduler: Scheduler of the download
+		:param received: Bytes of the file already on disk outside of the scheduler's ranges
+		:param total: File size, default to the scheduler's total size
+		:return: None
+		"""
+		self._events.put(("track", file_name, scheduler, received, total, time.monotonic()))
+		return None
+
+	def complete(self, file_name: str, succeeded: bool) -> None:
+		self._events.put(("complete", file_name, succeeded))
+		return None
+
+	def error(self, file_name: str, message: str) -> None:
+		self._events.put(("error", file_name, message))
+		return None
+
+	def status(self, file_name: str, message: str) -> None:
+		self._events.put(("status", file_name, message))
+		return None
+
+	def _publish(self, event: dict) -> None:
+		event["time"] = time.time()
+		for sink in self._sinks:
+			sink.handle(event)
+		return None
+
+	def _drain(self) -> None:
+		while True:
+			try:
+				item = self._events.get_nowait()
+			except queue.Empty:
+				return None
+
+			match item:
+				case ("track", file_name, scheduler, received, total, tracked_at):
+					previous = self._downloads.get(file_name)
+					rate = previous[5] if previous is not None else 0.0
+					total = total if total is not None else scheduler.total_size
+					self._downloads[file_name] = [scheduler, received, total, received, tracked_at, rate]
+				case ("complete", file_name, succeeded):
+					if file_name in self._downloads:
+						self._sample(file_name)
+						del self._downloads[file_name]
+					self._publish({"type": "complete", "file": file_name, "succeeded": succeeded})
+				case ("error" | "status" as kind, file_name, message):
+					self._publish({"type": kind, "file": file_name, "message": message})
+
+	def _sample(self, file_name: str) -> None:
+		download = self._downloads[file_name]
+		scheduler, before, total, last_received, last_time, rate = download
+		received = before + scheduler.received
+		now = time.monotonic()
+		if now > last_time:
+			current_rate = max(0, received - last_received) / (now - last_time)
+			rate = current_rate if not rate else PROGRESS_SMOOTHING * current_rate + (1 - PROGRESS_SMOOTHING) * rate
+		download[3:] = [received, now, rate]
+		self._publish({
+			"type": "progress",
+			"file": file_name,
+			"received": received,
+			"total": total,
+			"rate": rate,
+			"eta": (total - received) / rate if rate else None,
+			"segments": scheduler.segments()
+		})
+		return None
+
+	def _work(self) -> None:
+		while True:
+			stopping = self._stopped.wait(self._interval)
+			self._drain()
+			for file_name in self._downloads:
+				self._sample(file_name)
+			self._publish({"type": "sample"})
+			if stopping:
+				return None
+
+	def start(self) -> None:
+		self._stopped.clear()
+		self._thread = threading.Thread(target=self._work, daemon=True)
+		self._thread.start()
+		return None
+
+	def stop(self) -> None:
+		"""
+		Publish what is left, then close every sink
+
+		:return: None
+		"""
+		if self._thread is not None:
+			self._stopped.set()
+			self._thread.join()
+			self._thread = None
+		for sink in self._sinks:
+			sink.close()
+		return None
@@ -0,0 +1,40 @@
+import zlib
+import struct
+
+# Protocol 2 frames: header, payload, then a CRC32 of the payload if FLAG_CHECKSUM is set.
+# Protocol 1 is the text protocol of 4 byte length prefixed messages, clients start with it and switch with "PROTO 2"
+PROTOCOL_VERSION = 2
+HEADER = struct.Struct("!BBIQ")  # Opcode, flags, payload length, file offset of the payload
+CHECKSUM = struct.Struct("!I")
+
+OP_COMMAND = 1  # Client command, text payload
+OP_REPLY = 2  # Server reply, text payload starting with a status code
+OP_DATA = 3  # File data starting at the frame offset
+OP_END = 4  # End of a RETR, offset is where the data stopped
+OP_ERROR = 5  # Command failed, text payload starting with a status code
+OP_ENTRY = 6  # Next file of an MGET stream, JSON payload of its name, size and mtime, offset is where its data starts in the stream
+
+FLAG_COMPRESSED = 1  # Payload is compressed with the algorithm of mode "Z"
+FLAG_CHECKSUM = 2  # Payload is followed by its CRC32
+
+MAX_FRAME_SIZE = 2 ** 32 - 1
+
+
+def checksum(payload: bytes | memoryview) -> bytes:
+	return CHECKSUM.pack(zlib.crc32(payload))
+
+
+def pack_frame(opcode: int, payload: bytes | memoryview = b"", offset: int = 0, flags: int = 0) -> bytes:
+	"""
+	Build a complete protocol 2 frame
+
+	:param opcode: Frame type
+	:param payload: Payload
+	:param offset: File offset of the payload
+	:param flags: FLAG_COMPRESSED and FLAG_CHECKSUM, the checksum is computed here
+	:return: Frame bytes
+	"""
+	frame = HEADER.pack(opcode, flags, len(payload), offset) + payload
+	if flags & FLAG_CHECKSUM:
+		frame += checksum(payload)
+	return frame
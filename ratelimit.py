@@ -0,0 +1,47 @@
+import time
+from typing import Optional
+
+from constants import BUFFER_SIZE, RATE_LIMIT_BURST
+
+
+class TokenBucket:
+	def __init__(self,
+				 rate: float,
+				 burst: Optional[float] = None):
+		"""
+		Token bucket refilled with rate bytes per second, holding at most burst bytes.
+		Tokens may go negative when more was sent than allowed, later sends then wait longer
+
+		:param rate: Bytes per second
+		:param burst: Maximum bytes sent at once after being idle, default to RATE_LIMIT_BURST seconds of rate
+		"""
+		self.rate = rate
+		self.burst = burst if burst is not None else max(BUFFER_SIZE, rate * RATE_LIMIT_BURST)
+		self._tokens = self.burst
+		self._updated_at = time.monotonic()
+
+	def _refill(self) -> None:
+		now = time.monotonic()
+		self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+		self._updated_at = now
+		return None
+
+	@property
+	def available(self) -> float:
+		self._refill()
+		return max(0.0, self._tokens)
+
+	def consume(self, size: int) -> None:
+		self._refill()
+		self._tokens -= size
+		return None
+
+	def delay(self, size: int) -> float:
+		"""
+		Seconds until size bytes may be sent
+
+		:param size: Number of bytes
+		:return: Seconds to wait
+		"""
+		self._refill()
+		return max(0.0, (size - self._tokens) / self.rate)
@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import bisect
+import threading
+from typing import Optional, Callable
+
+from constants import STATE_SAVE_INTERVAL
+
+
+class DownloadState:
+	def __init__(self,
+				 state_path: str,
+				 file_size: int,
+				 mtime: Optional[str]):
+		"""
+		Completed byte ranges of a .part file, kept in a sidecar file so an interrupted download can resume
+
+		:param state_path: Path of the sidecar state file
+		:param file_size: File size reported by server
+		:param mtime: Modification time reported by server, None if server doesn't report it
+		"""
+		self._state_path = state_path
+		self.file_size = file_size
+		self.mtime = mtime
+
+		self._lock = threading.Lock()
+		self._ranges = []  # Sorted, non overlapping [start, end] byte ranges already on disk
+		self._saved_at = 0.0
+
+	@classmethod
+	def load(cls, state_path: str, file_size: int, mtime: Optional[str]) -> "DownloadState":
+		"""
+		Load state of a previous attempt, discard it if the file changed on server since
+
+		:param state_path: Path of the sidecar state file
+		:param file_size: File size reported by server
+		:param mtime: Modification time reported by server
+		:return: Download state, empty if there is nothing to resume
+		"""
+		state = cls(state_path, file_size, mtime)
+		try:
+			with open(state_path, "r") as file:
+				data = json.load(file)
+		except (OSError, ValueError):
+			return state
+
+		if data.get("size") != file_size or data.get("mtime") != mtime:  # Stale state, start over
+			return state
+
+		for start, end in data.get("ranges", []):
+			state.add(start, end)
+		return state
+
+	@property
+	def ranges(self) -> list[tuple[int, int]]:
+		with self._lock:
+			return [(start, end) for start, end in self._ranges]
+
+	@property
+	def completed(self) -> int:
+		with self._lock:
+			return sum(end - start for start, end in self._ranges)
+
+	def add(self, start: int, end: int) -> None:
+		"""
+		Record a byte range as written, merging it with adjacent ranges
+
+		:param start: First byte offset
+		:param end: Byte offset after the last byte
+		:return: None
+		"""
+		start, end = max(0, start), min(self.file_size, end)
+		if start >= end:
+			return None
+
+		with self._lock:
+			index = bisect.bisect_left(self._ranges, [start, end])
+			if index and self._ranges[index - 1][1] >= start:  # Merge with previous range
+				index -= 1
+				start = self._ranges[index][0]
+				end = max(end, self._ranges[index][1])
+			stop = index
+			while stop < len(self._ranges) and self._ranges[stop][0] <= end:  # Merge with following ranges
+				end = max(end, self._ranges[stop][1])
+				stop += 1
+			self._ranges[index:stop] = [[start, end]]
+		return None
+
+	def missing(self) -> list[tuple[int, int]]:
+		"""
+		Byte ranges not written yet
+
+		:return: List of (start, end) byte ranges
+		"""
+		missing = []
+		position = 0
+		for start, end in self.ranges:
+			if start > position:
+				missing.append((position, start))
+			position = end
+		if position < self.file_size:
+			missing.append((position, self.file_size))
+		return missing
+
+	def save(self, force: bool = False, sync: Optional[Callable[[], None]] = None) -> bool:
+		"""
+		Atomically write state to disk, at most once every STATE_SAVE_INTERVAL seconds unless forced
+
+		:param force: Save even if the last save was recent
+		:param sync: Flush the recorded ranges to disk first, so state never claims data that could be lost
+		:return: Whether state was written
+		"""
+		with self._lock:
+			if not force and time.monotonic() - self._saved_at < STATE_SAVE_INTERVAL:
+				return False
+			self._saved_at = time.monotonic()
+			if sync is not None:
+				sync()
+			data = {"size": self.file_size, "mtime": self.mtime, "ranges": [list(byte_range) for byte_range in self._ranges]}
+
+			temp_path = f"{self._state_path}.tmp"
+			with open(temp_path, "w") as file:
+				json.dump(data, file)
+			os.replace(temp_path, self._state_path)
+		return True
+
+	def remove(self) -> None:
+		try:
+			os.remove(self._state_path)
+		except FileNotFoundError:
+			pass
+		return None
@@ -0,0 +1,182 @@
+import math
+import time
+import threading
+from collections import deque
+from typing import Optional
+
+from constants import MIN_SEGMENT_SIZE, MAX_SEGMENT_CONNECTIONS, REQUEST_SIZE
+
+
+class Segment:
+	def __init__(self,
+				 start: int,
+				 end: int):
+		"""
+		Byte range of a file downloaded by one connection, its end moves back when another connection steals the tail
+
+		:param start: First byte offset
+		:param end: Byte offset after the last byte
+		"""
+		self.start = start
+		self.end = end
+		self.position = start  # Next byte to receive, only advanced by the owning connection
+		self.requested = start  # Bytes before this offset are already requested from server
+		self.started_at = None
+
+	@property
+	def remaining(self) -> int:
+		return self.end - self.position
+
+	@property
+	def rate(self) -> float:
+		"""
+		Bytes per second received since the segment started
+		"""
+		if self.started_at is None:
+			return 0.0
+		elapsed = time.monotonic() - self.started_at
+		return (self.position - self.start) / elapsed if elapsed > 0 else 0.0
+
+	def advance(self, size: int) -> None:
+		self.position += size
+		return None
+
+
+class SegmentScheduler:
+	def __init__(self,
+				 ranges: list[tuple[int, int]],
+				 connections: Optional[int] = None,
+				 alignment: int = 1):
+		"""
+		Hand out segments of the missing byte ranges to connections, split the slowest segment for connections finishing early
+
+		:param ranges: List of (start, end) byte ranges to download
+		:param connections: Number of connections, chosen from the total size if not given
+		:param alignment: Segments are split and requests end at multiples of this, e.g. the hash block size
+		"""
+		self._lock = threading.Lock()
+		self._alignment = alignment
+		self._pending = deque()
+		self._active = []
+		self.total_size = sum(end - start for start, end in ranges)
+		self.connections = connections or self.choose_connections(self.total_size)
+
+		segment_size = max(MIN_SEGMENT_SIZE, math.ceil(self.total_size / self.connections))
+		for start, end in ranges:
+			while start < end:
+				stop = self._align(start + segment_size, start)
+				if end - stop < MIN_SEGMENT_SIZE:  # Don't leave a tiny segment behind
+					stop = end
+				self._pending.append(Segment(start, stop))
+				start = stop
+		self.connections = min(self.connections, len(self._pending))
+
+	def _align(self, offset: int, lower: int) -> int:
+		"""
+		Round offset down to the alignment, unless that moves it to or below lower
+
+		:param offset: Byte offset
+		:param lower: Offset the result must stay above
+		:return: Aligned offset
+		"""
+		aligned = offset - offset % self._alignment
+		return aligned if aligned > lower else offset
+
+	@staticmethod
+	def choose_connections(size: int) -> int:
+		"""
+		Choose number of connections for a download, small files don't need more than one
+
+		:param size: Number of bytes to download
+		:return: Number of connections
+		"""
+		return max(1, min(MAX_SEGMENT_CONNECTIONS, size // MIN_SEGMENT_SIZE))
+
+	@property
+	def received(self) -> int:
+		with self._lock:
+			return self.total_size - sum(segment.remaining for segment in (*self._pending, *self._active))
+
+	@property
+	def done(self) -> bool:
+		return self.received == self.total_size
+
+	@property
+	def active(self) -> int:
+		return len(self._active)
+
+	def segments(self) -> list[list[int]]:
+		"""
+		State of the active segments
+
+		:return: List of [start, position, end]
+		"""
+		with self._lock:
+			return [[segment.start, segment.position, segment.end] for segment in self._active]
+
+	def next_segment(self) -> Optional[Segment]:
+		"""
+		Take a pending segment, or split the remaining range of the slowest active one
+
+		:return: Segment to download, None if nothing is left to hand out
+		"""
+		with self._lock:
+			segment = self._pending.popleft() if self._pending else self._steal()
+			if segment is not None:
+				segment.started_at = time.monotonic()
+				self._active.append(segment)
+			return segment
+
+	def _steal(self) -> Optional[Segment]:
+		"""
+		Split the not yet requested range of the segment expected to finish last, lock must be held
+
+		:return: New segment for the tail, None if no segment is large enough to split
+		"""
+		def time_left(segment: Segment) -> float:
+			return segment.remaining / segment.rate if segment.rate else math.inf
+
+		for victim in sorted(self._active, key=time_left, reverse=True):
+			unrequested = victim.end - victim.requested
+			if unrequested < 2 * MIN_SEGMENT_SIZE:
+				continue
+
+			split = self._align(victim.requested + unrequested // 2, victim.requested)
+			segment = Segment(split, victim.end)
+			victim.end = split
+			return segment
+		return None
+
+	def next_request(self, segment: Segment) -> Optional[tuple[int, int]]:
+		"""
+		Reserve the next range of a segment to request from server
+
+		:param segment: Segment owned by the caller
+		:return: Tuple of offset and size, None if the whole segment is requested
+		"""
+		with self._lock:
+			if segment.requested >= segment.end:
+				return None
+
+			offset = segment.requested
+			stop = segment.end if segment.end - offset <= REQUEST_SIZE else self._align(offset + REQUEST_SIZE, offset)
+			segment.requested = stop
+			return offset, stop - offset
+
+	def finish(self, segment: Segment) -> None:
+		with self._lock:
+			self._active.remove(segment)
+		return None
+
+	def release(self, segment: Segment) -> None:
+		"""
+		Give back the part of a segment its connection failed to receive
+
+		:param segment: Segment owned by the caller
+		:return: None
+		"""
+		with self._lock:
+			self._active.remove(segment)
+			if segment.remaining > 0:
+				self._pending.append(Segment(segment.position, segment.end))
+		return None
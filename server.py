@@ -1,105 +1,320 @@
 import os
 import json
-import select
+import time
+import errno
+import fnmatch
+import signal
 import socket
+import heapq
+import zlib
 import struct
-import time
-from typing import Optional
+import hashlib
+import selectors
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from datetime import datetime, timezone
+from typing import Optional, BinaryIO, Callable
+
+from constants import SERVER_HOST, SERVER_PORT, BUFFER_SIZE, ENCODE_FORMAT, DATA_DIRECTORY, SEND_QUANTUM, SERVER_WORKERS, \
+	WORKER_SHUTDOWN_TIMEOUT, HASH_BLOCK_SIZE, DELTA_BLOCK_SIZE, MANIFEST_DIRECTORY, SERVER_THREADS, CATALOG_REFRESH_INTERVAL, \
+	COMPRESSION_SAMPLE_BLOCKS, COMPRESSION_THRESHOLD, GLOBAL_RATE_LIMIT, CLIENT_RATE_LIMIT, FILE_RATE_LIMIT, \
+	LIST_PAGE_SIZE, LIST_FRAME_ENTRIES, METRICS_DIRECTORY, METRICS_DUMP_INTERVAL, BLOCK_CACHE_SIZE, CACHE_BLOCK_SIZE, READ_AHEAD_BLOCKS
+from cache import BlockCache
+from catalog import Catalog
+from compression import COMPRESSORS, BLOCK_RAW, BLOCK_COMPRESSED
+from ratelimit import TokenBucket
+from metrics import MetricsRegistry, THROUGHPUT_BUCKETS
+from protocol import PROTOCOL_VERSION, HEADER, CHECKSUM, OP_COMMAND, OP_REPLY, OP_DATA, OP_END, OP_ERROR, OP_ENTRY, \
+	FLAG_COMPRESSED, FLAG_CHECKSUM, MAX_FRAME_SIZE, pack_frame
+
+COMMANDS = ("PROTO", "LIST", "SIZE", "MDTM", "HASH", "SIGN", "MODE", "STAT", "QUIT", "RETR", "MGET")  # Commands with their own latency histogram
+
+
+class Transfer:
+	def __init__(self,
+				 file_name: str,
+				 file: BinaryIO,
+				 offset: int,
+				 size: int,
+				 mode: str,
+				 compression: Optional[str] = None,
+				 protocol: int = 1,
+				 checksum: bool = False,
+				 version: Optional[tuple[int, int]] = None):
+		"""
+		State of a RETR in progress, advanced a little every time the client socket is writable
+
+		:param file_name: File name
+		:param file: File opened in binary mode
+		:param offset: Next byte offset to send
+		:param size: Number of bytes to send
+		:param mode: Transfer mode of the connection
+		:param compression: Compression algorithm of mode "Z"
+		:param protocol: Protocol version of the connection
+		:param checksum: Whether protocol 2 data frames carry a checksum
+		:param version: File size and modification time in nanoseconds when opened, None to bypass the block cache
+		"""
+		self.file_name = file_name
+		self.file = file
+		self.started_at = time.monotonic()
+		self.first_byte_at = None
+		self.offset = offset
+		self.size = size
+		self.remaining = size
+		self.mode = mode
+		self.protocol = protocol
+		self.checksum = checksum
+		# Protocol 2 frames the data of mode "S" with one header, so the kernel can copy the payload as well
+		self.use_sendfile = hasattr(os, "sendfile") and (mode == "R" or (protocol == 2 and mode == "S" and not checksum))
+		self.frame_remaining = 0  # Payload bytes of the current sendfile data frame not yet sent
+		# Data copied through the outbox is read through the server block cache, until the file changes under it
+		self.version = version
+		self.cached = version is not None
+		self.waited_block = None  # Key of the block the transfer last waited for, found in the cache once it arrives
+
+		self.compression = compression
+		self.compressing = mode == "Z"  # Turned off when the sampled blocks don't compress well
+		self.sampled_blocks = 0
+		self.sampled_size = 0
+		self.sampled_compressed_size = 0
+		self.wire_size = 0  # Bytes of block payloads actually sent
+		self.encoded = None  # (data, whether compressed, payload) of the block at offset, compressed in a server thread
+
+	@property
+	def total_sent(self) -> int:
+		return self.size - self.remaining
+
+	@property
+	def done(self) -> bool:
+		return self.remaining <= 0
+
+	@property
+	def compression_ratio(self) -> float:
+		return self.wire_size / self.total_sent if self.total_sent else 1.0
+
+	def encode_block(self, data: bytes) -> tuple[bool, bytes]:
+		"""
+		Compress a block of mode "Z", send it as is if compression doesn't pay off
+
+		:param data: File data
+		:return: Tuple of whether the payload is compressed and the payload
+		"""
+		if self.compressing:
+			compressed = COMPRESSORS[self.compression][0](data)
+			if self.sampled_blocks < COMPRESSION_SAMPLE_BLOCKS:
+				self.sampled_blocks += 1
+				self.sampled_size += len(data)
+				self.sampled_compressed_size += len(compressed)
+				if self.sampled_blocks == COMPRESSION_SAMPLE_BLOCKS and \
+						self.sampled_compressed_size > self.sampled_size * COMPRESSION_THRESHOLD:  # Incompressible, stop spending CPU
+					self.compressing = False
+			if len(compressed) < len(data):
+				self.wire_size += len(compressed)
+				return True, compressed
 
-from constants import SERVER_HOST, SERVER_PORT, BUFFER_SIZE, ENCODE_FORMAT, DATA_DIRECTORY
+		self.wire_size += len(data)
+		return False, data
+
+	def close(self) -> None:
+		self.file.close()
+		return None
 
 
 class Server:
 	def __init__(self,
 				 host: str,
-				 port: int):
+				 port: int,
+				 control_socket: Optional[socket.socket] = None):
+		"""
+		:param host: Server IP
+		:param port: Server port
+		:param control_socket: Already bound listening socket to serve on, e.g. one shared by worker processes
+		"""
 		self._host = host
 		self._port = port
 
-		self._control_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-		self._control_socket.bind(self.address)
+		if control_socket is None:
+			control_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			control_socket.bind(self.address)
+		self._control_socket = control_socket
+		self._running = False
+
+		self._selector = selectors.DefaultSelector()
+		# Slow jobs run in threads, their results are handed back to the event loop through the wakeup socket
+		self._executor = ThreadPoolExecutor(max_workers=SERVER_THREADS)
+		self._callbacks = deque()
+		self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+		self._wakeup_reader.setblocking(False)
+		self._wakeup_writer.setblocking(False)
 
+		self._receive_view = memoryview(bytearray(BUFFER_SIZE))  # Shared by every client, the event loop reads one at a time
 		self._clients = {}
 		"""
 		dict = {
 			client_socket: {
 				"host": client ip,
 				"port": client port,
-				"message": client message
-				"sockets": [Sockets for download]
+				"inbox": received bytes not yet parsed into messages,
+				"outbox": bytes waiting for the socket to become writable,
+				"commands": deque of (receipt time, client message) waiting to be processed,
+				"mode": transfer mode, "S" for framed stream, "R" for raw or "Z" for compressed blocks,
+				"compression": compression algorithm of mode "Z",
+				"protocol": protocol version, 1 for length prefixed text messages or 2 for binary frames,
+				"checksum": whether protocol 2 data frames carry a checksum,
+				"transfer": Transfer in progress or None,
+				"archive": {"entries": deque of file names an MGET still has to send, "offset": stream offset of the next one}
+					or None,
+				"throttled": whether the transfer waits for rate limit tokens,
+				"loading": whether the transfer waits for a block read into the cache or compressed in a server thread,
+				"waiting": whether a background job is preparing the reply to the current command,
+				"closing": whether to close the connection once outbox is empty
 			}
 		}
 		"""
 
-		self._inputs = [self._control_socket]
-		self._outputs = []
+		self._catalog = Catalog()
+		self._timers = []  # Heap of (due time, sequence, callback, args)
+		self._timer_sequence = 0
 
-		self._permitted_files = {}
-		self._load_file_permissions()
+		# Token buckets shaping bandwidth, None where unlimited
+		self._global_bucket = TokenBucket(GLOBAL_RATE_LIMIT) if GLOBAL_RATE_LIMIT else None
+		self._client_buckets = {}
+		"""
+		dict = {
+			client ip: [TokenBucket or None, number of connections]
+		}
+		"""
+		self._file_buckets = {}
+		"""
+		dict = {
+			file name: TokenBucket
+		}
+		"""
+
+		self._manifests = {}
+		"""
+		dict = {
+			(command, file name): block hash manifest of HASH or block signature of SIGN
+		}
+		"""
+		self._manifest_jobs = {}
+		"""
+		dict = {
+			(command, file name): [client sockets waiting for its manifest or signature]
+		}
+		"""
+
+		self._block_cache = BlockCache(BLOCK_CACHE_SIZE)
+		self._block_jobs = {}
+		"""
+		dict = {
+			(file name, file version, block index): [client sockets waiting for the block]
+		}
+		"""
+
+		self.metrics = MetricsRegistry()
+		self._bytes_sent = self.metrics.counter("server_file_bytes_sent_total", "File bytes sent per file")
+		self._client_bytes_sent = self.metrics.counter("server_client_bytes_sent_total", "File bytes sent per client IP")
+		self._accepted = self.metrics.counter("server_connections_accepted_total", "Connections accepted")
+		self.metrics.gauge("server_active_connections", "Connected clients").set_function(lambda: len(self._clients))
+		self.metrics.gauge("server_active_transfers", "Transfers in progress").set_function(
+			lambda: sum(client["transfer"] is not None for client in self._clients.values()))
+		self._command_latency = self.metrics.histogram("server_command_duration_seconds", "Time from receiving a command to its reply")
+		self._first_byte = self.metrics.histogram("server_transfer_first_byte_seconds", "Time from RETR to the first data byte sent")
+		self._throughput = self.metrics.histogram("server_transfer_throughput_bytes_per_second", "Throughput of finished transfers",
+												  THROUGHPUT_BUCKETS)
+		self._cache_lookups = self.metrics.counter("server_block_cache_lookups_total", "Block cache lookups by result, hit or miss")
+		self._cache_evictions = self.metrics.counter("server_block_cache_evictions_total", "Blocks evicted from the block cache")
+		self.metrics.gauge("server_block_cache_bytes", "Bytes held by the block cache").set_function(lambda: self._block_cache.size)
+		self._metrics_path = os.path.join(METRICS_DIRECTORY, f"server_{os.getpid()}.prom")
 
 	@property
 	def address(self) -> tuple[str, int]:
 		return self._host, self._port
 
-	@staticmethod
-	def _send(client_socket: socket.socket, data: str | bytes, retries: int = 5, delay: float = 0.1) -> int:
+	def _send(self, client_socket: socket.socket, data: str | bytes, opcode: int = OP_REPLY) -> int:
 		"""
-		Send data to the client socket
+		Queue data to be sent to the client socket
 
 		:param client_socket: Socket to send
 		:param data: Data to send, encode to bytes if necessary
-		:return: Number of bytes sent
+		:param opcode: Frame type for protocol 2 clients
+		:return: Number of bytes queued
 		"""
 		if isinstance(data, str):
 			data = data.encode(ENCODE_FORMAT)
 
-		packed_data = struct.pack("!I", len(data)) + data
+		client = self._clients[client_socket]
+		if client["protocol"] == 2:
+			frame = pack_frame(opcode, data)
+		else:
+			frame = struct.pack("!I", len(data)) + data
+		client["outbox"] += frame
+		self._update_events(client_socket)
+		return len(frame)
 
-		total_sent = 0
-		while total_sent < len(packed_data):
-			try:
-				current_sent = client_socket.send(packed_data[total_sent:])
-				total_sent += current_sent
-			except socket.error:
-				if retries > 0:
-					retries -= 1
-					time.sleep(delay)
-				else:
-					break
-		return total_sent
+	def _send_error(self, client_socket: socket.socket, message: str) -> int:
+		"""
+		Queue an error reply, protocol 2 clients get it as an ERROR frame
 
-	@staticmethod
-	def _recv(client_socket: socket.socket) -> Optional[tuple[int, str]]:
+		:param client_socket: Socket to send
+		:param message: Reply starting with its status code
+		:return: Number of bytes queued
+		"""
+		return self._send(client_socket, message, OP_ERROR)
+
+	def _recv(self, client_socket: socket.socket) -> Optional[tuple[int, Optional[str]]]:
 		"""
-		Receive data from client socket
+		Take one complete message out of the client's received bytes
 
 		:param client_socket: Socket to receive
-		:return: Tuple of data received and its size
+		:return: Tuple of data received and its size, data is None if not valid text. None if message is incomplete
 		"""
-		header = Server._recv_n(client_socket, 4)
-		if not header:
+		client = self._clients[client_socket]
+		inbox = client["inbox"]
+		if client["protocol"] == 2:
+			if len(inbox) < HEADER.size:
+				return None
+			opcode, flags, size, _ = HEADER.unpack_from(inbox)
+			frame_size = HEADER.size + size + (CHECKSUM.size if flags & FLAG_CHECKSUM else 0)
+			if len(inbox) < frame_size:
+				return None
+
+			data = self._decode(inbox[HEADER.size:HEADER.size + size]) if opcode == OP_COMMAND else ""
+			del inbox[:frame_size]
+			return size, data
+
+		if len(inbox) < 4:
 			return None
 
-		size = struct.unpack("!I", header)[0]
-		data = Server._recv_n(client_socket, size).decode(ENCODE_FORMAT)
+		size = struct.unpack_from("!I", inbox)[0]
+		if len(inbox) < size + 4:
+			return None
+
+		data = self._decode(inbox[4:size + 4])
+		del inbox[:size + 4]
 		return size, data
 
 	@staticmethod
-	def _recv_n(client_socket: socket.socket, size: int) -> Optional[bytes]:
+	def _decode(data: bytes | bytearray) -> Optional[str]:
+		try:
+			return data.decode(ENCODE_FORMAT)
+		except UnicodeDecodeError:  # Answered with 501 when its turn comes
+			return None
+
+	@staticmethod
+	def _sendfile(client_socket: socket.socket, file: BinaryIO, offset: int, size: int) -> int:
 		"""
-		Receive exactly size bytes from client socket
+		Send a byte range of a file to the client socket without framing, let the kernel copy the data
 
-		:param client_socket: Socket to receive
-		:param size: Number of bytes to receive
-		:return: Data received
+		:param client_socket: Socket to send
+		:param file: File opened in binary mode
+		:param offset: Starting byte offset
+		:param size: Maximum number of bytes to send
+		:return: Number of bytes sent, raise BlockingIOError if socket is not writable
 		"""
-		data = bytearray()
-		while (current_size := len(data)) < size:
-			packet = client_socket.recv(size - current_size)
-			if not packet:
-				return None
-			data.extend(packet)
-		return data
+		return os.sendfile(client_socket.fileno(), file.fileno(), offset, size)
 
 	@staticmethod
 	def _get_open_port() -> Optional[int]:
@@ -116,22 +331,17 @@ class Server:
 			print(f"Service unavailable, please reconnect later")
 		return None
 
-	def _load_file_permissions(self) -> None:
+	def _refresh_catalog(self) -> None:
 		"""
-		Load file permissions
+		Check permitted files for changes in a server thread, so stat calls never block the event loop
 
 		:return: None
 		"""
-		with open("file_permission.json", "r") as file:
-			data = json.load(file).get("permitted_files")
-			if not data:
-				return None
+		def done(future: Future) -> None:
+			self._call_later(CATALOG_REFRESH_INTERVAL, self._refresh_catalog)
+			return None
 
-			self._permitted_files.clear()
-			for file_name in set(data.keys()):
-				file_path = os.path.join(DATA_DIRECTORY, file_name)
-				if os.path.exists(file_path):
-					self._permitted_files[file_name] = os.path.getsize(file_path)
+		self._run_in_thread(done, self._catalog.refresh)
 		return None
 
 	def _get_file_status(self, client_socket: socket.socket, file_name: str) -> tuple[bool, Optional[str]]:
@@ -143,97 +353,761 @@ class Server:
 		:return: Tuple of file status and file path on server
 		"""
 		# Check file permissions
-		if self._permitted_files and self._permitted_files.get(file_name) is None:
-			self._send(client_socket, f"550 File unavailable: {file_name}")
+		if len(self._catalog) and self._catalog.get(file_name) is None:
+			self._send_error(client_socket, f"550 File unavailable: {file_name}")
 			return False, None
 		# Check file existence
 		return True, os.path.join(DATA_DIRECTORY, file_name)
 
-	def _handle_chunk(self, client_socket: socket.socket, file_path: str) -> None:
-		msg = self._recv(client_socket)
-		split_msg = msg[1].split()
-		if split_msg[0].upper() == "RETR":
-			try:
-				file_name = split_msg[1]
-				try:
-					offset = int(split_msg[2])
-				except IndexError:
-					offset = 0
-				try:
-					size = int(split_msg[3])
-				except IndexError:
-					size = self._permitted_files[file_name]
-			except IndexError:  # Command missing parameter
-				self._send(client_socket, "501 Syntax error: Expected file name after RETR command")
-			else:
-				self._retr(client_socket, file_path, offset, size)
-
-		self._recv(client_socket)
-		self._send(client_socket, "226 Goodbye!")
-		client_socket.close()
-		return None
-
-	def _list(self, client_socket: socket.socket) -> None:
+	def _list(self, client_socket: socket.socket, since: Optional[int] = None, options: Optional[dict] = None) -> None:
 		"""
 		Send list of permitted files to client
 
 		:param client_socket: Client socket
+		:param since: Catalog version the client already has, only changes after it are sent. None for plain file sizes
+		:param options: Filters and pagination of a paged listing, see _list_page. None for the whole list in one message
 		:return:
 		"""
-		if not self._permitted_files:
-			self._send(client_socket, f"550 File permissions unavailable")
+		if not len(self._catalog) and since is None:
+			self._send_error(client_socket, f"550 File permissions unavailable")
 			return None
 
 		self._send(client_socket, "150 File status ok")
-		self._send(client_socket, json.dumps(self._permitted_files))
+		if options is not None:
+			self._list_page(client_socket, since, **options)
+		elif since is None:
+			self._send(client_socket, json.dumps(self._catalog.sizes()))
+		else:
+			self._send(client_socket, json.dumps(self._catalog.changes(since)))
 		self._send(client_socket, "226 File permissions sent")
 		return None
 
+	def _list_page(self, client_socket: socket.socket, since: Optional[int], prefix: Optional[str] = None,
+				   pattern: Optional[str] = None, after: Optional[str] = None, limit: int = LIST_PAGE_SIZE) -> None:
+		"""
+		Send a page of the catalog as a sequence of messages of at most LIST_FRAME_ENTRIES entries each, then a last
+		message with the catalog version, the removed file names and the cursor of the next page
+
+		:param client_socket: Client socket
+		:param since: Catalog version the client already has, None for every entry
+		:param prefix: Only file names starting with it
+		:param pattern: Only file names matching this glob pattern
+		:param after: Cursor of the previous page, hex of the last file name it had
+		:param limit: Maximum number of entries, at most LIST_PAGE_SIZE
+		:return: None
+		"""
+		after = bytes.fromhex(after).decode(ENCODE_FORMAT) if after is not None else None
+		page = self._catalog.page(since, prefix, pattern, after, min(limit, LIST_PAGE_SIZE))
+		files = list(page["files"].items())
+		for start in range(0, len(files), LIST_FRAME_ENTRIES):
+			self._send(client_socket, json.dumps({"files": dict(files[start:start + LIST_FRAME_ENTRIES])}))
+
+		cursor = page["cursor"].encode(ENCODE_FORMAT).hex() if page["cursor"] is not None else None
+		self._send(client_socket, json.dumps({"version": page["version"], "removed": page["removed"], "cursor": cursor}))
+		return None
+
+	@staticmethod
+	def _list_options(arguments: list[str]) -> Optional[tuple[Optional[int], Optional[dict]]]:
+		"""
+		Parse arguments of LIST [SINCE <version>] [PREFIX <prefix>] [MATCH <glob>] [AFTER <cursor>] [LIMIT <page size>]
+
+		:param arguments: Arguments after LIST
+		:return: Tuple of since and the options of a paged listing (None without any), None if arguments are invalid
+		"""
+		if len(arguments) % 2:
+			return None
+
+		since = None
+		options = {}
+		for keyword, value in zip(arguments[::2], arguments[1::2]):
+			match keyword.upper():
+				case "SINCE" if value.isdigit():
+					since = int(value)
+				case "PREFIX":
+					options["prefix"] = value
+				case "MATCH":
+					options["pattern"] = value
+				case "AFTER":
+					try:
+						bytes.fromhex(value).decode(ENCODE_FORMAT)
+					except ValueError:
+						return None
+					options["after"] = value
+				case "LIMIT" if value.isdigit() and int(value):
+					options["limit"] = int(value)
+				case _:
+					return None
+		return since, options or None
+
+	def _stat_file(self, client_socket: socket.socket, file_name: str) -> Optional[os.stat_result]:
+		"""
+		Get current status of a permitted file, send error message if file is unavailable
+
+		:param client_socket: Client socket
+		:param file_name: File name
+		:return: File status, None if unavailable
+		"""
+		file_status, file_path = self._get_file_status(client_socket, file_name)
+		if not file_status:
+			return None
+
+		try:
+			return os.stat(file_path)
+		except OSError:
+			self._send_error(client_socket, f"550 File unavailable: {file_name}")
+		return None
+
+	def _size(self, client_socket: socket.socket, file_name: str) -> None:
+		"""
+		Send current size of a file
+
+		:param client_socket: Client socket
+		:param file_name: File name
+		:return: None
+		"""
+		if (file_stat := self._stat_file(client_socket, file_name)) is not None:
+			self._send(client_socket, f"213 {file_stat.st_size}")
+		return None
+
+	def _mdtm(self, client_socket: socket.socket, file_name: str) -> None:
+		"""
+		Send last modification time of a file as YYYYMMDDHHMMSS.ffffff in UTC
+
+		:param client_socket: Client socket
+		:param file_name: File name
+		:return: None
+		"""
+		if (file_stat := self._stat_file(client_socket, file_name)) is not None:
+			modified = datetime.fromtimestamp(file_stat.st_mtime, timezone.utc)
+			self._send(client_socket, f"213 {modified:%Y%m%d%H%M%S.%f}")
+		return None
+
+	def _mode(self, client_socket: socket.socket, mode: str, compression: Optional[str] = None) -> None:
+		"""
+		Set transfer mode of the following RETR commands
+
+		:param client_socket: Client socket
+		:param mode: "S" for framed stream, "R" for raw data streamed with sendfile, "Z" for compressed blocks
+		:param compression: Compression algorithm of mode "Z", default to zlib
+		:return: None
+		"""
+		mode = mode.upper()
+		if mode not in ("S", "R", "Z"):
+			self._send_error(client_socket, f"504 Mode not implemented: {mode}")
+			return None
+
+		if mode == "Z":
+			compression = (compression or "zlib").lower()
+			if compression not in COMPRESSORS:
+				self._send_error(client_socket, f"504 Compression not implemented: {compression}")
+				return None
+			self._clients[client_socket]["compression"] = compression
+			mode = f"Z {compression}"
+
+		self._clients[client_socket]["mode"] = mode[0]
+		self._send(client_socket, f"200 Mode set to {mode}")
+		return None
+
+	def _protocol(self, client_socket: socket.socket, version: str, options: list[str]) -> None:
+		"""
+		Switch the connection to another protocol version, the reply is the last message in the old one
+
+		:param client_socket: Client socket
+		:param version: "1" for length prefixed text messages, "2" for binary frames
+		:param options: "CHECKSUM" to add a checksum to every protocol 2 data frame
+		:return: None
+		"""
+		if version not in ("1", str(PROTOCOL_VERSION)):
+			self._send_error(client_socket, f"504 Protocol not implemented: {version}")
+			return None
+
+		client = self._clients[client_socket]
+		client["checksum"] = version == "2" and "CHECKSUM" in options
+		self._send(client_socket, f"200 Protocol {version}{' CHECKSUM' if client['checksum'] else ''}")
+		client["protocol"] = int(version)
+		return None
+
+	def _stat(self, client_socket: socket.socket) -> None:
+		"""
+		Send a snapshot of the server metrics
+
+		:param client_socket: Client socket
+		:return: None
+		"""
+		self._send(client_socket, "150 Metrics follow")
+		self._send(client_socket, json.dumps(self.metrics.snapshot()))
+		self._send(client_socket, "226 Metrics sent")
+		return None
+
+	def _dump_metrics(self) -> None:
+		"""
+		Write metrics to METRICS_DIRECTORY in Prometheus text format, render in the event loop and write in a server thread
+
+		:return: None
+		"""
+		def done(future: Future) -> None:
+			try:
+				future.result()
+			except OSError as error:
+				print(f"Couldn't write metrics: {error}")
+			self._call_later(METRICS_DUMP_INTERVAL, self._dump_metrics)
+			return None
+
+		self._run_in_thread(done, self.metrics.write, self._metrics_path, self.metrics.to_prometheus())
+		return None
+
 	def _quit(self, client_socket: socket.socket) -> None:
 		"""
-		Client disconnect, close sockets
+		Client disconnect, close the connection once the goodbye is sent
 
 		:param client_socket: Client socket
 		:return: None
 		"""
 		self._send(client_socket, "221 Goodbye!")
-		client_socket.close()
+		self._clients[client_socket]["closing"] = True
 		return None
 
-	def _retr(self, client_socket: socket.socket, file_name: str, offset: int, size: int) -> None:
+	def _retr(self, client_socket: socket.socket, file_name: str, offset: int, size: Optional[int]) -> None:
 		"""
-		Send requested file to client
+		Start sending requested file to client, the data itself is sent by _advance_transfer
 
 		:param client_socket: Client socket
 		:param file_name: File name
 		:param offset: Starting byte offset
-		:param size: Number of bytes to download
+		:param size: Number of bytes to download, None for the rest of the file
 		:return: None
 		"""
 		file_status, file_path = self._get_file_status(client_socket, file_name)
 		if not file_status:
 			return None
-		self._send(client_socket, "150 File status ok")
-		# Send file data
-		total_sent = 0
+
+		try:
+			file = open(file_path, "rb")
+		except OSError:
+			self._send_error(client_socket, f"550 File unavailable: {file_name}")
+			return None
+
+		file_stat = os.fstat(file.fileno())
+		file_size = file_stat.st_size
+		size = max(0, min(file_size if size is None else size, file_size - offset))
+		client = self._clients[client_socket]
+		mode = client["mode"]
+		if client["protocol"] == 2:  # Data frames follow right away
+			pass
+		elif mode == "R":  # Client must know exactly how many raw bytes follow
+			self._send(client_socket, f"150 Opening raw data transfer ({size} bytes)")
+		else:
+			self._send(client_socket, "150 File status ok")
+		version = (file_size, file_stat.st_mtime_ns) if BLOCK_CACHE_SIZE else None
+		client["transfer"] = Transfer(file_name, file, offset, size, mode, client["compression"], client["protocol"], client["checksum"], version)
+		self._update_events(client_socket)
+		return None
+
+	def _mget(self, client_socket: socket.socket, patterns: list[str]) -> None:
+		"""
+		Send every permitted file matching names or glob patterns back to back on one connection. Each file is an ENTRY
+		frame with its name, size and modification time, then the DATA frames and the END or ERROR frame a RETR of the
+		whole file gets. A last END frame, with the stream size as offset, closes the stream
+
+		:param client_socket: Client socket
+		:param patterns: File names or glob patterns
+		:return: None
+		"""
+		client = self._clients[client_socket]
+		if client["protocol"] != 2:  # Entries need frames
+			self._send_error(client_socket, "503 Bad sequence of commands: MGET needs protocol 2")
+			return None
+		if not len(self._catalog):
+			self._send_error(client_socket, "550 File permissions unavailable")
+			return None
+
+		sizes = self._catalog.sizes()
+		file_names = {}  # Ordered set of matching file names
+		for pattern in patterns:
+			if pattern in sizes:
+				file_names[pattern] = None
+			else:
+				file_names.update(dict.fromkeys(sorted(fnmatch.filter(sizes, pattern))))
+		if not file_names:
+			self._send_error(client_socket, f"550 No permitted file matches: {' '.join(patterns)}")
+			return None
+
+		client["archive"] = {"entries": deque(file_names), "offset": 0}
+		self._next_entry(client_socket)
+		return None
+
+	def _next_entry(self, client_socket: socket.socket) -> None:
+		"""
+		Start the transfer of the next file of an MGET, close the stream after the last one.
+		Files that can't be opened anymore are skipped, they get no entry
+
+		:param client_socket: Client socket
+		:return: None
+		"""
+		client = self._clients[client_socket]
+		archive = client["archive"]
+		while archive["entries"]:
+			file_name = archive["entries"].popleft()
+			try:
+				file = open(os.path.join(DATA_DIRECTORY, file_name), "rb")
+			except OSError:
+				continue
+
+			file_stat = os.fstat(file.fileno())
+			entry = json.dumps({"name": file_name, "size": file_stat.st_size, "mtime": file_stat.st_mtime_ns}).encode(ENCODE_FORMAT)
+			client["outbox"] += pack_frame(OP_ENTRY, entry, archive["offset"])
+			archive["offset"] += file_stat.st_size
+			version = (file_stat.st_size, file_stat.st_mtime_ns) if BLOCK_CACHE_SIZE else None
+			client["transfer"] = Transfer(file_name, file, 0, file_stat.st_size, client["mode"], client["compression"],
+										  client["protocol"], client["checksum"], version)
+			self._update_events(client_socket)
+			return None
+
+		client["archive"] = None
+		client["outbox"] += pack_frame(OP_END, offset=archive["offset"])
+		self._update_events(client_socket)
+		return None
+
+	def _advance_transfer(self, client_socket: socket.socket, quantum: int = SEND_QUANTUM) -> int:
+		"""
+		Push at most quantum bytes of the client's transfer, finish it when nothing remains
+
+		:param client_socket: Client socket
+		:param quantum: Maximum number of file bytes to send
+		:return: Number of bytes sent or queued to the outbox
+		"""
+		client = self._clients[client_socket]
+		transfer = client["transfer"]
+		outbox_size = len(client["outbox"])
+		current_sent = 0
+		quantum = min(quantum, transfer.remaining)
+		if quantum and transfer.use_sendfile:
+			if transfer.protocol == 2 and not transfer.frame_remaining:  # One data frame header, the payload follows by sendfile
+				transfer.frame_remaining = min(transfer.remaining, MAX_FRAME_SIZE)
+				client["outbox"] += HEADER.pack(OP_DATA, 0, transfer.frame_remaining, transfer.offset)
+				return len(client["outbox"]) - outbox_size
+			if transfer.protocol == 2:
+				quantum = min(quantum, transfer.frame_remaining)
+
+			try:
+				current_sent = self._sendfile(client_socket, transfer.file, transfer.offset, quantum)
+			except (BlockingIOError, InterruptedError):
+				return 0
+			except OSError as error:
+				if error.errno not in (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP):
+					raise
+				transfer.use_sendfile = False  # Socket or file type cannot use sendfile, copy through outbox instead
+				return 0
+			if not current_sent:  # File shrank since the transfer started
+				quantum = 0
+			transfer.offset += current_sent
+			transfer.remaining -= current_sent
+			transfer.frame_remaining = max(0, transfer.frame_remaining - current_sent)
+		elif quantum:
+			size = min(quantum, transfer.frame_remaining) if transfer.frame_remaining else quantum
+			encoded, transfer.encoded = transfer.encoded, None
+			if encoded is not None:  # Block compressed in a server thread
+				data = encoded[0]
+			elif not transfer.cached:
+				transfer.file.seek(transfer.offset)
+				data = transfer.file.read(size)
+			elif (data := self._read_block(client_socket, transfer, size)) is None:  # Waiting for the block to be read
+				return 0
+			if encoded is None and transfer.mode == "Z" and transfer.compressing and data:
+				self._encode_block(client_socket, transfer, data)
+				return 0
+			# Rest of a sendfile data frame, or raw data of protocol 1. Protocol 2 frames every mode
+			if transfer.frame_remaining or (transfer.protocol == 1 and transfer.mode == "R"):
+				client["outbox"] += data
+				transfer.frame_remaining = max(0, transfer.frame_remaining - len(data))
+			elif transfer.protocol == 2 and data:
+				flags = FLAG_CHECKSUM if transfer.checksum else 0
+				payload = data
+				if transfer.mode == "Z":
+					compressed, payload = encoded[1:] if encoded is not None else transfer.encode_block(data)
+					flags |= FLAG_COMPRESSED if compressed else 0
+				client["outbox"] += pack_frame(OP_DATA, payload, transfer.offset, flags)
+			elif transfer.mode == "Z" and data:
+				compressed, payload = encoded[1:] if encoded is not None else transfer.encode_block(data)
+				client["outbox"] += struct.pack("!I", len(payload) + 1)
+				client["outbox"].append(BLOCK_COMPRESSED if compressed else BLOCK_RAW)
+				client["outbox"] += payload
+			else:
+				view = memoryview(data)
+				for start in range(0, len(data), BUFFER_SIZE):
+					block = view[start:start + BUFFER_SIZE]
+					client["outbox"] += struct.pack("!I", len(block))
+					client["outbox"] += block
+			if not data:  # File shrank since the transfer started
+				quantum = 0
+			transfer.offset += len(data)
+			transfer.remaining -= len(data)
+
+		sent = current_sent + len(client["outbox"]) - outbox_size
+		if sent and transfer.first_byte_at is None:
+			transfer.first_byte_at = time.monotonic()
+			self._first_byte.observe(transfer.first_byte_at - transfer.started_at)
+		if quantum and not transfer.done:
+			return sent
+
+		transfer.close()
+		client["transfer"] = None
+		if (elapsed := time.monotonic() - transfer.started_at) > 0 and transfer.total_sent:
+			self._throughput.observe(transfer.total_sent / elapsed)
+		if not transfer.done and (transfer.frame_remaining or (transfer.protocol == 1 and transfer.mode == "R")):
+			# Client can't resynchronize a short raw stream or data frame
+			client["outbox"].clear()
+			client["closing"] = True
+			return sent
+
+		if transfer.protocol == 2:
+			if transfer.done:
+				client["outbox"] += pack_frame(OP_END, offset=transfer.offset)
+			else:
+				self._send_error(client_socket, "451 File changed during transfer")
+			if client["archive"] is not None:  # The entry ended, go on with the next one
+				self._next_entry(client_socket)
+		else:
+			if transfer.mode != "R":
+				self._send(client_socket, "EOF")  # Mark the end of file, notify client to stop receiving
+			if transfer.mode == "Z":
+				self._send(client_socket, f"226 Transfer complete (compression ratio {transfer.compression_ratio:.3f})")
+			else:
+				self._send(client_socket, "226 Transfer complete")
+		self._process_commands(client_socket)
+		return sent
+
+	def _encode_block(self, client_socket: socket.socket, transfer: Transfer, data: bytes | memoryview) -> None:
+		"""
+		Compress the next block of a mode "Z" transfer in a server thread, lzma and bz2 take milliseconds per block
+		the event loop can't spend. The transfer waits for it the way it waits for a block read into the cache
+
+		:param client_socket: Client socket
+		:param transfer: Transfer of the client
+		:param data: File data at the transfer offset
+		:return: None
+		"""
+		def done(future: Future) -> None:
+			if client_socket not in self._clients or self._clients[client_socket]["transfer"] is not transfer:  # Client left
+				return None
+			transfer.encoded = (data, *future.result())
+			self._clients[client_socket]["loading"] = False
+			self._update_events(client_socket)
+			return None
+
+		self._clients[client_socket]["loading"] = True
+		self._update_events(client_socket)
+		self._run_in_thread(done, transfer.encode_block, data)
+		return None
+
+	def _read_block(self, client_socket: socket.socket, transfer: Transfer, size: int) -> Optional[memoryview]:
+		"""
+		Take the next bytes of a transfer from the block cache, up to the end of the block they start in.
+		On a miss the block is read in a server thread and the transfer waits for it, only one read runs per block
+		however many transfers need it. The blocks following it are read ahead as well
+
+		:param client_socket: Client socket
+		:param transfer: Transfer of the client
+		:param size: Maximum number of bytes
+		:return: View of the bytes, None if the transfer waits for its block
+		"""
+		index, start = divmod(transfer.offset, CACHE_BLOCK_SIZE)
+		key = (transfer.file_name, transfer.version, index)
+		block = self._block_cache.get(key)
+		if key != transfer.waited_block:  # Lookup of a transfer woken by its block was already counted as a miss
+			self._cache_lookups.inc(result="hit" if block is not None else "miss")
+		transfer.waited_block = None
+		if block is None:
+			transfer.waited_block = key
+			self._clients[client_socket]["loading"] = True
+			self._load_block(key, client_socket)
+			self._update_events(client_socket)
+
+		end = transfer.offset + transfer.remaining
+		for ahead in range(index + 1, index + 1 + READ_AHEAD_BLOCKS):
+			if ahead * CACHE_BLOCK_SIZE >= end:
+				break
+			self._load_block((transfer.file_name, transfer.version, ahead))
+		return memoryview(block)[start:start + size] if block is not None else None
+
+	def _load_block(self, key: tuple[str, tuple[int, int], int], client_socket: Optional[socket.socket] = None) -> None:
+		"""
+		Read a block into the cache in a server thread, unless it is cached or already being read
+
+		:param key: Block key
+		:param client_socket: Client socket whose transfer waits for the block, None to read ahead
+		:return: None
+		"""
+		if key in self._block_jobs:
+			if client_socket is not None:
+				self._block_jobs[key].append(client_socket)
+			return None
+		if key in self._block_cache:
+			return None
+
+		self._block_jobs[key] = [client_socket] if client_socket is not None else []
+		self._run_in_thread(lambda future: self._finish_block(key, future), self._read_file_block, *key)
+		return None
+
+	@staticmethod
+	def _read_file_block(file_name: str, version: tuple[int, int], index: int) -> Optional[bytes]:
+		"""
+		Read a block of a file, runs in a server thread
+
+		:param file_name: File name
+		:param version: File size and modification time in nanoseconds the block must come from
+		:param index: Block index
+		:return: Block, None if the file changed since the version
+		"""
+		with open(os.path.join(DATA_DIRECTORY, file_name), "rb") as file:
+			file_stat = os.fstat(file.fileno())
+			if (file_stat.st_size, file_stat.st_mtime_ns) != version:
+				return None
+			file.seek(index * CACHE_BLOCK_SIZE)
+			return file.read(CACHE_BLOCK_SIZE)
+
+	def _finish_block(self, key: tuple[str, tuple[int, int], int], future: Future) -> None:
+		"""
+		Cache a block read, and wake the transfers waiting for it
+
+		:param key: Block key
+		:param future: Future of _read_file_block
+		:return: None
+		"""
+		try:
+			block = future.result()
+		except OSError:
+			block = None
+		if block:
+			self._cache_evictions.inc(self._block_cache.put(key, block))
+
+		for client_socket in self._block_jobs.pop(key, []):
+			if client_socket not in self._clients or (transfer := self._clients[client_socket]["transfer"]) is None:
+				continue
+
+			if block is None or key not in self._block_cache:  # File changed, or block can't be cached, read it directly
+				transfer.cached = False
+			self._clients[client_socket]["loading"] = False
+			self._update_events(client_socket)
+		return None
+
+	def _run_in_thread(self, callback: Callable[[Future], None], function: Callable, *args) -> None:
+		"""
+		Run function in a server thread, then call callback with its future from the event loop
+
+		:param callback: Called in the event loop once function finished
+		:param function: Slow function to run
+		:param args: Arguments of function
+		:return: None
+		"""
+		def done(future: Future) -> None:
+			self._callbacks.append((callback, future))
+			try:
+				self._wakeup_writer.send(b"\0")
+			except (BlockingIOError, OSError):  # Already woken up, or server is shutting down
+				pass
+			return None
+
+		self._executor.submit(function, *args).add_done_callback(done)
+		return None
+
+	def _run_callbacks(self) -> None:
+		"""
+		Run callbacks of finished background jobs
+
+		:return: None
+		"""
+		try:
+			while self._wakeup_reader.recv(BUFFER_SIZE):
+				pass
+		except BlockingIOError:
+			pass
+
+		while self._callbacks:
+			callback, future = self._callbacks.popleft()
+			callback(future)
+		return None
+
+	@staticmethod
+	def _load_manifest_cache(cache_path: str, file_stat: os.stat_result, block_size: int) -> Optional[dict]:
+		"""
+		Load a manifest or signature from disk cache
+
+		:param cache_path: Path of the cached JSON
+		:param file_stat: Current file status, the cache must match its size and modification time
+		:param block_size: Block size the cache must have been built with
+		:return: Cached manifest, None if missing or stale
+		"""
+		try:
+			with open(cache_path, "r") as file:
+				manifest = json.load(file)
+			if (manifest.get("size"), manifest.get("mtime"), manifest.get("block_size")) == \
+					(file_stat.st_size, file_stat.st_mtime_ns, block_size):
+				return manifest
+		except (OSError, ValueError):
+			pass
+		return None
+
+	@staticmethod
+	def _manifest_cache_path(command: str, file_name: str) -> str:
+		"""
+		Path of the cached manifest (HASH) or signature (SIGN) of a file. The name is a hash of both, so every cache
+		file sits directly in MANIFEST_DIRECTORY, whatever subdirectory the file is in, and no two collide
+
+		:param command: HASH or SIGN
+		:param file_name: File name
+		:return: Path of the cached JSON
+		"""
+		key = hashlib.sha256(f"{command} {file_name}".encode(ENCODE_FORMAT)).hexdigest()
+		return os.path.join(MANIFEST_DIRECTORY, f"{key}.json")
+
+	@staticmethod
+	def _store_manifest_cache(cache_path: str, manifest: dict) -> None:
+		"""
+		Store a manifest or signature in disk cache. The cache is best-effort, if it can't be written the manifest is
+		still sent and only built again after a restart
+
+		:param cache_path: Path of the cached JSON
+		:param manifest: Manifest or signature
+		:return: None
+		"""
+		temp_path = f"{cache_path}.{os.getpid()}.tmp"
+		try:
+			os.makedirs(MANIFEST_DIRECTORY, exist_ok=True)
+			with open(temp_path, "w") as file:
+				json.dump(manifest, file)
+			os.replace(temp_path, cache_path)
+		except OSError as error:
+			print(f"Couldn't cache manifest of {manifest['file']}: {error}")
+			try:
+				os.remove(temp_path)
+			except OSError:
+				pass
+		return None
+
+	@staticmethod
+	def _build_manifest(file_path: str, file_name: str, file_stat: os.stat_result) -> dict:
+		"""
+		Load block hash manifest of a file from disk cache, hash the file if the cache is missing or stale
+
+		:param file_path: File path on server
+		:param file_name: File name
+		:param file_stat: Current file status, the cache must match its size and modification time
+		:return: Manifest
+		"""
+		cache_path = Server._manifest_cache_path("HASH", file_name)
+		if (manifest := Server._load_manifest_cache(cache_path, file_stat, HASH_BLOCK_SIZE)) is not None:
+			return manifest
+
+		hashes = []
 		with open(file_path, "rb") as file:
-			file.seek(offset)
-			# i = 0
-			while True:
-				data = file.read(min(BUFFER_SIZE, size - total_sent))
-				if not data:
-					break
+			while block := file.read(HASH_BLOCK_SIZE):
+				hashes.append(hashlib.sha256(block).hexdigest())
+		manifest = {
+			"file": file_name,
+			"size": file_stat.st_size,
+			"mtime": file_stat.st_mtime_ns,
+			"block_size": HASH_BLOCK_SIZE,
+			"algorithm": "sha256",
+			"hashes": hashes
+		}
+		Server._store_manifest_cache(cache_path, manifest)
+		return manifest
 
-				current_sent = self._send(client_socket, data) - 4
-				total_sent += current_sent
-				if total_sent >= size:
-					break
-				# print(f"Sent chunk {i} from offset {offset}: {len(data)} Bytes")
-				# i += 1
-			self._send(client_socket, "EOF")  # Mark the end of file, notify client to stop receiving
-		print(f"Sent {total_sent} / {size} = {total_sent / size * 100} %")
+	@staticmethod
+	def _build_signature(file_path: str, file_name: str, file_stat: os.stat_result) -> dict:
+		"""
+		Load rsync style block signature of a file from disk cache, compute it if the cache is missing or stale.
+		Every DELTA_BLOCK_SIZE block gets an Adler-32 checksum, which a client can roll over its local copy,
+		and a strong hash confirming the matches
+
+		:param file_path: File path on server
+		:param file_name: File name
+		:param file_stat: Current file status, the cache must match its size and modification time
+		:return: Signature
+		"""
+		cache_path = Server._manifest_cache_path("SIGN", file_name)
+		if (signature := Server._load_manifest_cache(cache_path, file_stat, DELTA_BLOCK_SIZE)) is not None:
+			return signature
+
+		weak, strong = [], []
+		with open(file_path, "rb") as file:
+			while block := file.read(DELTA_BLOCK_SIZE):
+				weak.append(zlib.adler32(block))
+				strong.append(hashlib.sha256(block).hexdigest())
+		signature = {
+			"file": file_name,
+			"size": file_stat.st_size,
+			"mtime": file_stat.st_mtime_ns,
+			"block_size": DELTA_BLOCK_SIZE,
+			"algorithm": "sha256",
+			"weak": weak,
+			"strong": strong
+		}
+		Server._store_manifest_cache(cache_path, signature)
+		return signature
+
+	def _send_manifest(self, client_socket: socket.socket, manifest: dict) -> None:
+		self._send(client_socket, "150 File status ok")
+		self._send(client_socket, json.dumps(manifest))
+		self._send(client_socket, "226 Manifest sent")
+		return None
+
+	def _hash(self, client_socket: socket.socket, file_name: str, command: str = "HASH") -> None:
+		"""
+		Send block hash manifest (HASH) or block signature (SIGN) of a file, build it in a server thread if needed
+
+		:param client_socket: Client socket
+		:param file_name: File name
+		:param command: HASH or SIGN
+		:return: None
+		"""
+		if (file_stat := self._stat_file(client_socket, file_name)) is None:
+			return None
 
-		self._send(client_socket, "226 Transfer complete")
+		key = (command, file_name)
+		manifest = self._manifests.get(key)
+		if manifest is not None and (manifest["size"], manifest["mtime"]) == (file_stat.st_size, file_stat.st_mtime_ns):
+			self._send_manifest(client_socket, manifest)
+			return None
+
+		self._clients[client_socket]["waiting"] = True
+		if key in self._manifest_jobs:  # Already being built for another client
+			self._manifest_jobs[key].append(client_socket)
+			return None
+
+		self._manifest_jobs[key] = [client_socket]
+		file_path = os.path.join(DATA_DIRECTORY, file_name)
+		build = self._build_signature if command == "SIGN" else self._build_manifest
+		self._run_in_thread(lambda future: self._finish_manifest(key, future), build, file_path, file_name, file_stat)
+		return None
+
+	def _finish_manifest(self, key: tuple[str, str], future: Future) -> None:
+		"""
+		Reply to every client waiting for a manifest or signature
+
+		:param key: Tuple of command and file name
+		:param future: Future of _build_manifest or _build_signature
+		:return: None
+		"""
+		try:
+			manifest = future.result()
+		except OSError:
+			manifest = None
+		else:
+			self._manifests[key] = manifest
+
+		file_name = key[1]
+		for client_socket in self._manifest_jobs.pop(key, []):
+			if client_socket not in self._clients:  # Client left while waiting
+				continue
+
+			if manifest is None:
+				self._send_error(client_socket, f"550 File unavailable: {file_name}")
+			else:
+				self._send_manifest(client_socket, manifest)
+			self._clients[client_socket]["waiting"] = False
+			self._process_commands(client_socket)
 		return None
 
 	def _accept_client(self) -> None:
@@ -242,52 +1116,257 @@ class Server:
 
 		:return: None
 		"""
-		client_socket, (client_host, client_port) = self._control_socket.accept()
+		try:
+			client_socket, (client_host, client_port) = self._control_socket.accept()
+		except BlockingIOError:  # Connection already taken or reset
+			return None
 		client_socket.setblocking(False)
 
 		client_data = {
 			"host": client_host,
 			"port": client_port,
-			"message": None
+			"inbox": bytearray(),
+			"outbox": bytearray(),
+			"commands": deque(),
+			"mode": "S",
+			"compression": None,
+			"protocol": 1,
+			"checksum": False,
+			"transfer": None,
+			"archive": None,
+			"throttled": False,
+			"loading": False,
+			"waiting": False,
+			"closing": False
 		}
 		self._clients[client_socket] = client_data
-		self._inputs.append(client_socket)
-		print(f"Client connected: IP {client_host} on port {client_port}\n")
+		client_bucket = self._client_buckets.setdefault(client_host, [TokenBucket(CLIENT_RATE_LIMIT) if CLIENT_RATE_LIMIT else None, 0])
+		client_bucket[1] += 1
+		self._selector.register(client_socket, selectors.EVENT_READ)
+		self._accepted.inc()
 		return None
 
 	def _remove_client(self, client_socket: socket.socket) -> None:
 		"""
-		Remove client record on server
+		Remove client record on server, close its socket and transfer in progress
 
 		:param client_socket: Client socket
 		:return: None
 		"""
-		print(f"Client disconnected. IP {self._clients[client_socket]['host']} on port {self._clients[client_socket]['port']}\n")
+		client = self._clients.pop(client_socket)
+		if client["transfer"] is not None:
+			client["transfer"].close()
+		client_bucket = self._client_buckets[client["host"]]
+		client_bucket[1] -= 1
+		if not client_bucket[1]:  # Last connection of this IP
+			del self._client_buckets[client["host"]]
+		self._selector.unregister(client_socket)
+		client_socket.close()
+		return None
 
-		self._clients.pop(client_socket)
-		for record in (self._inputs, self._outputs):
-			try:
-				record.remove(client_socket)
-			except ValueError:
-				pass
+	def _update_events(self, client_socket: socket.socket) -> None:
+		"""
+		Only wait for the client socket to be writable when there is something to write
+
+		:param client_socket: Client socket
+		:return: None
+		"""
+		client = self._clients[client_socket]
+		events = selectors.EVENT_READ
+		if client["outbox"] or (client["transfer"] is not None and not client["throttled"] and not client["loading"]) or client["closing"]:
+			events |= selectors.EVENT_WRITE
+
+		if self._selector.get_key(client_socket).events != events:
+			self._selector.modify(client_socket, events)
+		return None
+
+	def _read_client(self, client_socket: socket.socket) -> None:
+		"""
+		Receive available bytes from client, queue every complete message
+
+		:param client_socket: Client socket
+		:return: None
+		"""
+		try:
+			current_received = client_socket.recv_into(self._receive_view)
+		except (BlockingIOError, InterruptedError):
+			return None
+		except OSError:
+			current_received = 0
+		if not current_received:  # Client closed the connection
+			self._remove_client(client_socket)
+			return None
+
+		client = self._clients[client_socket]
+		client["inbox"] += self._receive_view[:current_received]
+		while (message := self._recv(client_socket)) is not None:
+			client["commands"].append((time.monotonic(), message[1]))
+		self._process_commands(client_socket)
+		return None
+
+	def _write_client(self, client_socket: socket.socket) -> bool:
+		"""
+		Flush queued bytes to client
+
+		:param client_socket: Client socket
+		:return: Whether the client's transfer is ready to send its next quantum
+		"""
+		client = self._clients[client_socket]
+		try:
+			if client["outbox"]:
+				current_sent = client_socket.send(client["outbox"])
+				del client["outbox"][:current_sent]
+		except (BlockingIOError, InterruptedError):
+			pass
+		except OSError:  # Client went away in the middle of sending
+			self._remove_client(client_socket)
+			return False
+
+		if client["closing"] and not client["outbox"]:
+			self._remove_client(client_socket)
+			return False
+		self._update_events(client_socket)
+		return not client["outbox"] and client["transfer"] is not None and not client["throttled"] and not client["loading"]
+
+	def _call_later(self, delay: float, callback: Callable, *args) -> None:
+		"""
+		Call callback from the event loop after delay seconds
+
+		:param delay: Seconds to wait
+		:param callback: Function to call
+		:param args: Arguments of callback
+		:return: None
+		"""
+		self._timer_sequence += 1
+		heapq.heappush(self._timers, (time.monotonic() + delay, self._timer_sequence, callback, args))
 		return None
 
-	def _process_client_message(self, client_socket: socket.socket, message: str) -> bool:
+	def _run_timers(self) -> None:
+		now = time.monotonic()
+		while self._timers and self._timers[0][0] <= now:
+			_, _, callback, args = heapq.heappop(self._timers)
+			callback(*args)
+		return None
+
+	def _unthrottle(self, client_socket: socket.socket) -> None:
+		if client_socket in self._clients:
+			self._clients[client_socket]["throttled"] = False
+			self._update_events(client_socket)
+		return None
+
+	def _schedule_transfers(self, ready: list[socket.socket]) -> None:
+		"""
+		Share the rate limit tokens available fairly between client IPs, then between the connections of each IP,
+		and let every ready transfer send its share
+
+		:param ready: Sockets whose transfer can send its next quantum
+		:return: None
+		"""
+		if not ready:
+			return None
+
+		hosts = {}
+		for client_socket in ready:
+			hosts.setdefault(self._clients[client_socket]["host"], []).append(client_socket)
+
+		global_share = self._global_bucket.available / len(hosts) if self._global_bucket is not None else float("inf")
+		for host, sockets in hosts.items():
+			client_bucket = self._client_buckets[host][0]
+			host_tokens = min(global_share, client_bucket.available if client_bucket is not None else float("inf"))
+			for client_socket in sockets:
+				if client_socket not in self._clients:
+					continue
+				transfer = self._clients[client_socket]["transfer"]
+				file_bucket = self._get_file_bucket(transfer.file_name)
+				allowance = min(host_tokens / len(sockets), file_bucket.available if file_bucket is not None else float("inf"))
+
+				quantum = int(min(SEND_QUANTUM, transfer.remaining, allowance))
+				if quantum < min(BUFFER_SIZE, transfer.remaining):  # Not worth sending, wait for tokens
+					buckets = [bucket for bucket in (self._global_bucket, client_bucket, file_bucket) if bucket is not None]
+					self._clients[client_socket]["throttled"] = True
+					self._update_events(client_socket)
+					self._call_later(max(0.01, max(bucket.delay(BUFFER_SIZE) for bucket in buckets)), self._unthrottle, client_socket)
+					continue
+
+				sent = self._advance_transfer(client_socket, quantum)
+				self._bytes_sent.inc(sent, file=transfer.file_name)
+				self._client_bytes_sent.inc(sent, client=host)
+				for bucket in (self._global_bucket, client_bucket, file_bucket):
+					if bucket is not None:
+						bucket.consume(sent)
+				if client_socket in self._clients:
+					self._write_client(client_socket)
+		return None
+
+	def _get_file_bucket(self, file_name: str) -> Optional[TokenBucket]:
+		if not FILE_RATE_LIMIT:
+			return None
+		if file_name not in self._file_buckets:
+			self._file_buckets[file_name] = TokenBucket(FILE_RATE_LIMIT)
+		return self._file_buckets[file_name]
+
+	def _process_commands(self, client_socket: socket.socket) -> None:
+		"""
+		Process queued client messages in order until one of them starts a transfer
+
+		:param client_socket: Client socket
+		:return: None
+		"""
+		client = self._clients[client_socket]
+		while client["commands"] and client["transfer"] is None and not client["waiting"] and not client["closing"]:
+			received_at, message = client["commands"].popleft()
+			self._process_client_message(client_socket, message)
+			command = message.split(maxsplit=1)[0].upper() if message is not None and message.strip() else ""
+			self._command_latency.observe(time.monotonic() - received_at, command=command if command in COMMANDS else "OTHER")
+		return None
+
+	def _process_client_message(self, client_socket: socket.socket, message: Optional[str]) -> bool:
 		"""
 		Process a message from client
 
 		:param client_socket: Client socket
-		:param message: Message received
+		:param message: Message received, None if it wasn't valid text
 		:return: Whether client still connecting
 		"""
+		if message is None:
+			self._send_error(client_socket, f"501 Syntax error: Command is not valid {ENCODE_FORMAT}")
+			return True
+
 		split_msg = message.split()
-		match split_msg[0].upper():
+		match split_msg[0].upper() if split_msg else "":
 			case "LIST":
-				self._list(client_socket)
+				if (list_options := self._list_options(split_msg[1:])) is None:
+					self._send_error(client_socket, "501 Syntax error: Expected LIST [SINCE <version>] [PREFIX <prefix>] "
+													"[MATCH <glob>] [AFTER <cursor>] [LIMIT <page size>]")
+				else:
+					self._list(client_socket, *list_options)
+			case "SIZE" | "MDTM" | "HASH" | "SIGN" as command:
+				try:
+					file_name = split_msg[1]
+				except IndexError:  # Command missing parameter
+					self._send_error(client_socket, f"501 Syntax error: Expected file name after {command} command")
+				else:
+					if command == "SIZE":
+						self._size(client_socket, file_name)
+					elif command == "MDTM":
+						self._mdtm(client_socket, file_name)
+					else:
+						self._hash(client_socket, file_name, command)
+			case "MODE":
+				if len(split_msg) < 2:  # Command missing parameter
+					self._send_error(client_socket, "501 Syntax error: Expected mode after MODE command")
+				else:
+					self._mode(client_socket, *split_msg[1:3])
+			case "PROTO":
+				if len(split_msg) < 2:  # Command missing parameter
+					self._send_error(client_socket, "501 Syntax error: Expected version after PROTO command")
+				else:
+					self._protocol(client_socket, split_msg[1], [option.upper() for option in split_msg[2:]])
+			case "STAT":
+				self._stat(client_socket)
 			case "QUIT":
 				self._quit(client_socket)
-				self._remove_client(client_socket)
-				return True
+				return False
 			case "RETR":
 				try:
 					file_name = split_msg[1]
@@ -297,44 +1376,232 @@ class Server:
 						offset = 0
 					try:
 						size = int(split_msg[3])
-					except IndexError:
-						size = self._permitted_files[file_name]
+					except IndexError:  # Until end of file
+						size = None
 				except IndexError:  # Command missing parameter
-					self._send(client_socket, "501 Syntax error: Expected file name after RETR command")
+					self._send_error(client_socket, "501 Syntax error: Expected file name after RETR command")
+				except ValueError:
+					self._send_error(client_socket, f"501 Syntax error: Invalid RETR arguments {message}")
 				else:
-					self._retr(client_socket, file_name, offset, size)
+					if offset < 0 or (size is not None and size < 0):
+						self._send_error(client_socket, f"501 Syntax error: Negative RETR offset or size {message}")
+					else:
+						self._retr(client_socket, file_name, offset, size)
+			case "MGET":
+				if len(split_msg) < 2:  # Command missing parameter
+					self._send_error(client_socket, "501 Syntax error: Expected file names or patterns after MGET command")
+				else:
+					self._mget(client_socket, split_msg[1:])
 			case _:
-				self._send(client_socket, f"501 Syntax error: Unknown command {message}")
-
-		self._clients[client_socket]["message"] = None
-		self._outputs.remove(client_socket)
+				self._send_error(client_socket, f"501 Syntax error: Unknown command {message}")
 		return True
 
+	def stop(self) -> None:
+		"""
+		Stop accepting new clients, run() returns once connected clients are gone
+
+		:return: None
+		"""
+		self._running = False
+		return None
+
 	def run(self) -> None:
 		self._control_socket.listen()
 		self._control_socket.setblocking(False)
+		self._selector.register(self._control_socket, selectors.EVENT_READ)
+		self._selector.register(self._wakeup_reader, selectors.EVENT_READ)
+		self._running = True
 		print(f"Server listening: IP {self._host} on port {self._port}")
 
-		while self._inputs:
-			readable, writable, exceptional = select.select(self._inputs, self._outputs, self._inputs)
+		self._call_later(CATALOG_REFRESH_INTERVAL, self._refresh_catalog)
+		self._call_later(METRICS_DUMP_INTERVAL, self._dump_metrics)
+		while self._running or self._clients:
+			if not self._running:
+				if self._control_socket.fileno() != -1:
+					self._selector.unregister(self._control_socket)
+					self._control_socket.close()
+				# Idle clients have nothing left to finish
+				for client_socket in [sock for sock, client in self._clients.items()
+									  if client["transfer"] is None and not client["waiting"] and not client["outbox"]]:
+					self._remove_client(client_socket)
+				if not self._clients:
+					break
 
-			for sock in readable:
+			timeout = min(1.0, max(0.0, self._timers[0][0] - time.monotonic())) if self._timers else 1.0
+			ready = []
+			for key, events in self._selector.select(timeout=timeout):
+				sock = key.fileobj
 				if sock is self._control_socket:
 					self._accept_client()
-				else:
-					message = self._recv(sock)
-					self._clients[sock]["message"] = message[1]
-					self._outputs.append(sock)
+					continue
+				if sock is self._wakeup_reader:
+					self._run_callbacks()
+					continue
+				if sock not in self._clients:  # Removed earlier in this round
+					continue
+
+				if events & selectors.EVENT_READ:
+					self._read_client(sock)
+				if events & selectors.EVENT_WRITE and sock in self._clients and self._write_client(sock):
+					ready.append(sock)
+
+			self._schedule_transfers([sock for sock in ready if sock in self._clients])
+			self._run_timers()
+
+		if self._control_socket.fileno() != -1:
+			self._selector.unregister(self._control_socket)
+			self._control_socket.close()
+		self._executor.shutdown(wait=False, cancel_futures=True)
+		self._selector.close()
+		self._wakeup_reader.close()
+		self._wakeup_writer.close()
+		return None
+
+
+class PreforkServer:
+	def __init__(self,
+				 host: str,
+				 port: int,
+				 workers: int = SERVER_WORKERS):
+		"""
+		Fork worker processes that each run a Server on the same port
+
+		:param host: Server IP
+		:param port: Server port
+		:param workers: Number of worker processes
+		"""
+		self._host = host
+		self._port = port
+		self._workers = workers
+		# Let the kernel balance connections between worker sockets if possible, else share one socket
+		self._reuse_port = hasattr(socket, "SO_REUSEPORT")
+
+		self._control_socket = None
+		self._pids = {}
+		"""
+		dict = {
+			worker pid: worker index
+		}
+		"""
+		self._running = False
+
+	def _create_socket(self) -> socket.socket:
+		"""
+		Create socket bound to the server address
+
+		:return: Bound socket
+		"""
+		sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		if self._reuse_port:
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+		sock.bind((self._host, self._port))
+		return sock
+
+	def _spawn_worker(self, index: int) -> None:
+		"""
+		Fork a worker process, the worker loads its own file permissions and serves until told to stop
+
+		:param index: Worker index
+		:return: None
+		"""
+		pid = os.fork()
+		if pid:
+			self._pids[pid] = index
+			return None
+
+		exit_code = 1
+		try:
+			signal.signal(signal.SIGINT, signal.SIG_IGN)  # Parent decides when workers stop
+			control_socket = self._create_socket() if self._reuse_port else self._control_socket
+			server = Server(self._host, self._port, control_socket=control_socket)
+			signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+			server.run()
+			exit_code = 0
+		except Exception:
+			traceback.print_exc()
+		finally:
+			os._exit(exit_code)
+
+	def _handle_signal(self, signum: int, frame) -> None:
+		self._running = False
+		return None
+
+	def _reap_workers(self) -> list[int]:
+		"""
+		Collect exited workers
+
+		:return: Indexes of workers that exited
+		"""
+		exited = []
+		while self._pids:
+			try:
+				pid, status = os.waitpid(-1, os.WNOHANG)
+			except ChildProcessError:
+				break
+			if not pid:
+				break
+
+			index = self._pids.pop(pid)
+			exited.append(index)
+			if self._running:
+				print(f"Worker {index} (pid {pid}) exited with status {os.waitstatus_to_exitcode(status)}, restarting")
+		return exited
+
+	def _shutdown(self) -> None:
+		"""
+		Ask every worker to finish its clients, kill the ones still running after WORKER_SHUTDOWN_TIMEOUT
+
+		:return: None
+		"""
+		for pid in self._pids:
+			os.kill(pid, signal.SIGTERM)
+
+		deadline = time.monotonic() + WORKER_SHUTDOWN_TIMEOUT
+		while self._pids and time.monotonic() < deadline:
+			self._reap_workers()
+			time.sleep(0.1)
+
+		for pid in self._pids:
+			os.kill(pid, signal.SIGKILL)
+		while self._pids:
+			pid, _ = os.waitpid(-1, 0)
+			self._pids.pop(pid, None)
+		return None
+
+	def run(self) -> None:
+		if not hasattr(os, "fork"):  # Platform can't fork, serve from this process
+			Server(self._host, self._port).run()
+			return None
+
+		if not self._reuse_port:
+			self._control_socket = self._create_socket()
+			self._control_socket.listen()
+
+		self._running = True
+		signal.signal(signal.SIGTERM, self._handle_signal)
+		signal.signal(signal.SIGINT, self._handle_signal)
+		for index in range(self._workers):
+			self._spawn_worker(index)
+		print(f"Started {self._workers} workers: IP {self._host} on port {self._port}")
 
-			for sock in writable:
-				if (message := self._clients[sock]["message"]) is not None:
-					self._process_client_message(sock, message)
+		while self._running:
+			for index in self._reap_workers():
+				if self._running:
+					time.sleep(1)  # Don't spin if the worker dies right away
+					self._spawn_worker(index)
+			time.sleep(0.5)
 
-			for sock in exceptional:
-				self._remove_client(sock)
+		print("Shutting down workers")
+		self._shutdown()
+		if self._control_socket is not None:
+			self._control_socket.close()
 		return None
 
 
 if __name__ == "__main__":
-	server = Server(host=SERVER_HOST, port=SERVER_PORT)
+	if SERVER_WORKERS > 1:
+		server = PreforkServer(host=SERVER_HOST, port=SERVER_PORT, workers=SERVER_WORKERS)
+	else:
+		server = Server(host=SERVER_HOST, port=SERVER_PORT)
 	server.run()
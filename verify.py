@@ -0,0 +1,141 @@
+import queue
+import hashlib
+import threading
+from typing import Optional
+
+
+class BlockHasher:
+	def __init__(self,
+				 verifier: "BlockVerifier",
+				 offset: int,
+				 size: int):
+		"""
+		Hash the blocks of a block aligned range as its bytes arrive, hand every finished block to the verifier
+
+		:param verifier: Verifier of the download
+		:param offset: Starting byte offset, multiple of the block size
+		:param size: Number of bytes in the range
+		"""
+		self._verifier = verifier
+		self._index = offset // verifier.block_size
+		self._position = offset
+		self._end = offset + size
+		self._block_end = min(self._end, verifier.block_range(self._index)[1])
+		self._hash = hashlib.new(verifier.algorithm)
+
+	def update(self, data: bytes | memoryview) -> None:
+		view = memoryview(data)
+		while view and self._position < self._end:
+			size = min(len(view), self._block_end - self._position)
+			self._hash.update(view[:size])
+			self._position += size
+			view = view[size:]
+
+			if self._position == self._block_end and self._block_end == self._verifier.block_range(self._index)[1]:
+				self._verifier.submit(self._index, self._hash.digest())
+				self._index += 1
+				self._block_end = min(self._end, self._verifier.block_range(self._index)[1])
+				self._hash = hashlib.new(self._verifier.algorithm)
+		return None
+
+
+class BlockVerifier:
+	def __init__(self,
+				 manifest: dict,
+				 file_path: str):
+		"""
+		Compare block hashes of a download against the server manifest in a worker thread
+
+		:param manifest: Block hash manifest sent by server
+		:param file_path: Path of the file being written, blocks not hashed while streaming are read back from it
+		"""
+		self.block_size = manifest["block_size"]
+		self.algorithm = manifest["algorithm"]
+		self._file_size = manifest["size"]
+		self._hashes = [bytes.fromhex(block_hash) for block_hash in manifest["hashes"]]
+		self._file_path = file_path
+
+		self._lock = threading.Lock()
+		self._verified = set()
+		self._failed = set()
+
+		self._queue = queue.Queue()
+		self._thread = threading.Thread(target=self._work, daemon=True)
+		self._thread.start()
+
+	def block_range(self, index: int) -> tuple[int, int]:
+		start = index * self.block_size
+		return start, min(self._file_size, start + self.block_size)
+
+	def hasher(self, offset: int, size: int) -> Optional[BlockHasher]:
+		"""
+		Create a hasher for a requested range
+
+		:param offset: Starting byte offset
+		:param size: Number of bytes requested
+		:return: Hasher, None if the range doesn't start at a block boundary
+		"""
+		if offset % self.block_size:
+			return None
+		return BlockHasher(self, offset, size)
+
+	def submit(self, index: int, digest: bytes) -> None:
+		self._queue.put((index, digest))
+		return None
+
+	def _work(self) -> None:
+		while (item := self._queue.get()) is not None:
+			index, digest = item
+			if digest is None:  # Block wasn't hashed while streaming, read it back from disk
+				digest = self._hash_from_disk(index)
+			with self._lock:
+				if digest == self._hashes[index]:
+					self._verified.add(index)
+					self._failed.discard(index)
+				else:
+					self._failed.add(index)
+			self._queue.task_done()
+		self._queue.task_done()
+		return None
+
+	def _hash_from_disk(self, index: int) -> bytes:
+		start, end = self.block_range(index)
+		block_hash = hashlib.new(self.algorithm)
+		with open(self._file_path, "rb") as file:
+			file.seek(start)
+			block_hash.update(file.read(end - start))
+		return block_hash.digest()
+
+	def finish(self) -> list[int]:
+		"""
+		Wait for submitted blocks, verify from disk the blocks that were never hashed
+
+		:return: Indexes of blocks failing verification
+		"""
+		self._queue.join()
+		with self._lock:
+			checked = self._verified | self._failed
+		for index in range(len(self._hashes)):
+			if index not in checked:
+				self._queue.put((index, None))
+		self._queue.join()
+
+		with self._lock:
+			return sorted(self._failed)
+
+	def retry(self, indexes: list[int]) -> None:
+		"""
+		Forget results of blocks that are downloaded again
+
+		:param indexes: Block indexes
+		:return: None
+		"""
+		with self._lock:
+			self._failed.difference_update(indexes)
+			self._verified.difference_update(indexes)
+		return None
+
+	def close(self) -> None:
+		self._queue.put(None)
+		self._thread.join()
+		return None
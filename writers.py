@@ -0,0 +1,154 @@
+import os
+import mmap
+import threading
+from typing import Optional
+
+from buffers import ReceiveBuffer
+
+
+class PwriteWriter:
+	def __init__(self,
+				 file_path: str,
+				 file_size: int):
+		"""
+		Write downloaded segments straight to their offsets in a preallocated file
+
+		:param file_path: Path of the file to write, usually a .part file
+		:param file_size: Final file size
+		"""
+		self._file_path = file_path
+		self._file_size = file_size
+
+		self._fd = os.open(file_path, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+		self._lock = threading.Lock()  # Only needed where seek + write replaces pwrite
+		self._preallocate()
+
+	@property
+	def file_path(self) -> str:
+		return self._file_path
+
+	def _preallocate(self) -> None:
+		"""
+		Reserve disk space for the whole file up front
+
+		:return: None
+		"""
+		if os.fstat(self._fd).st_size == self._file_size:
+			return None
+
+		os.ftruncate(self._fd, self._file_size)
+		if self._file_size and hasattr(os, "posix_fallocate"):
+			try:
+				os.posix_fallocate(self._fd, 0, self._file_size)
+			except OSError:  # File system doesn't support allocation, sparse file is good enough
+				pass
+		return None
+
+	def write_at(self, offset: int, data: bytes | memoryview) -> None:
+		"""
+		Write data at the given offset, safe to call from several threads at once
+
+		:param offset: Byte offset in file
+		:param data: Data to write
+		:return: None
+		"""
+		view = memoryview(data)
+		while view:
+			if hasattr(os, "pwrite"):
+				written = os.pwrite(self._fd, view, offset)
+			else:
+				with self._lock:
+					os.lseek(self._fd, offset, os.SEEK_SET)
+					written = os.write(self._fd, view)
+			view = view[written:]
+			offset += written
+		return None
+
+	def receive(self, reader: ReceiveBuffer, offset: int, size: int) -> Optional[memoryview]:
+		"""
+		Receive at most size bytes of a connection and write them at the given offset
+
+		:param reader: Receive buffer of the connection
+		:param offset: Byte offset in file
+		:param size: Maximum number of bytes
+		:return: View of the bytes written, None if connection closed
+		"""
+		if (data := reader.read_some(size)) is not None:
+			self.write_at(offset, data)
+		return data
+
+	def sync(self) -> None:
+		"""
+		Flush written data to disk
+
+		:return: None
+		"""
+		os.fsync(self._fd)
+		return None
+
+	def close(self) -> None:
+		if self._fd != -1:
+			os.close(self._fd)
+			self._fd = -1
+		return None
+
+	def commit(self, file_path: str) -> None:
+		"""
+		Close the file and atomically move it to its final name
+
+		:param file_path: Final file path
+		:return: None
+		"""
+		self.close()
+		os.replace(self._file_path, file_path)
+		return None
+
+
+class MmapWriter(PwriteWriter):
+	def __init__(self,
+				 file_path: str,
+				 file_size: int):
+		"""
+		Map a preallocated file into memory, segments are received straight into their slice of the mapping,
+		without passing through a receive buffer or a write call. Suits large files on fast local links
+
+		:param file_path: Path of the file to write, usually a .part file
+		:param file_size: Final file size
+		"""
+		super().__init__(file_path, file_size)
+		self._map = mmap.mmap(self._fd, file_size) if file_size else None  # Empty files can't be mapped
+		self._view = memoryview(self._map) if self._map is not None else memoryview(b"")
+
+	def write_at(self, offset: int, data: bytes | memoryview) -> None:
+		self._view[offset:offset + len(data)] = data
+		return None
+
+	def receive(self, reader: ReceiveBuffer, offset: int, size: int) -> Optional[memoryview]:
+		target = self._view[offset:offset + size]
+		if not (current_received := reader.recv_into(target)):
+			return None
+		return target[:current_received]
+
+	def sync(self) -> None:
+		if self._map is not None:
+			self._map.flush()
+		return None
+
+	def close(self) -> None:
+		if self._map is not None:
+			self._view.release()
+			self._map.close()
+			self._map = None
+		super().close()
+		return None
+
+
+WRITERS: dict[str, type[PwriteWriter]] = {
+	"pwrite": PwriteWriter,
+	"mmap": MmapWriter,
+}
+"""
+dict = {
+	backend name: writer class
+}
+"""